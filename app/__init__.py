@@ -1,44 +1,78 @@
 from flask import Flask, request
 from flask_login import LoginManager
-from flask_mail import Mail
-from .models import db, User , Product , Order , OrderItem , CartItem
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wrappers import Response
+from .models import db
 from .routes import main_bp
+from .schema import init_schema
+from .email_outbox import init_email_outbox
+from .inventory import init_inventory
+from .cart_store import init_cart_store
+from .auth import init_auth, get_user_cache
+from .payments import init_payments
+from .analytics import init_analytics
+from .pricing import init_pricing
+from .catalog import init_catalog
+from .http_cache import init_http_cache
+from .throttling import init_throttling
+from .search import init_search
+from .replicas import init_replicas
+from .rendering import init_rendering
+from .instrumentation import TimedQueuePool, init_instrumentation, log_event
 from dotenv import load_dotenv
 import os
-from flask_admin import Admin
-from flask_admin.contrib.sqla import ModelView
-from flask_login import current_user
-from flask import redirect, url_for
+import threading
+import logging
 
-load_dotenv()
 
 
-
-mail = Mail()
 login_manager = LoginManager()
 login_manager.login_view = 'main.login'
 
-def create_app():
-    print("Starting create_app()...")
+def engine_options(database_url, environ=os.environ):
+    # Pool tuning for server databases (Supabase/PostgreSQL); SQLite keeps SQLAlchemy's defaults.
+    if database_url.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true',
+    }
+    statement_timeout = int(environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout and database_url.startswith('postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
 
+def create_app(config=None):
+    load_dotenv()
     app = Flask(__name__)
 
     try:
         app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-for-local-only')
-        print("✓ SECRET_KEY loaded")
-        
+
         # Use Supabase PostgreSQL database
         database_url = os.environ.get('SUPABASE_DATABASE_URL') or os.environ.get('DATABASE_URL')
         if not database_url:
-            # Fallback to SQLite for local development
-            database_url = 'sqlite:///instance/order_system.db'
-            print("✓ Using SQLite for local development")
-        else:
-            print("✓ Using Supabase PostgreSQL database")
-        
+            # Fallback to SQLite for local development (relative to the instance folder)
+            database_url = 'sqlite:///order_system.db'
+
         app.config['SQLALCHEMY_DATABASE_URI'] = database_url
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        print("✓ SQLALCHEMY_DATABASE_URI loaded")
+        # Comma-separated read replicas of the database above (see app/replicas.py)
+        app.config['DATABASE_REPLICA_URLS'] = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+        # Seconds a client reads from the primary after its own writes, to cover replication lag
+        app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+        # Tables are created by `flask init-db`; set this to also create them at startup
+        app.config['AUTO_CREATE_SCHEMA'] = os.environ.get('AUTO_CREATE_SCHEMA', 'false').lower() == 'true'
+
+        # Per-request DB instrumentation and the /metrics endpoint
+        app.config['DB_SLOW_QUERY_MS'] = float(os.environ.get('DB_SLOW_QUERY_MS', 200))
+        app.config['DB_SLOW_QUERY_SAMPLES'] = int(os.environ.get('DB_SLOW_QUERY_SAMPLES', 20))
+        app.config['METRICS_ALLOW_REMOTE'] = os.environ.get('METRICS_ALLOW_REMOTE', 'false').lower() == 'true'
 
         app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'localhost')
         app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
@@ -47,48 +81,165 @@ def create_app():
         app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', '')
         app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'noreply@example.com')
 
-        print("✓ Mail config loaded")
+        # Outbound email queue (see app/email_outbox.py)
+        app.config['EMAIL_DELIVERY'] = os.environ.get('EMAIL_DELIVERY')
+        app.config['EMAIL_WORKERS'] = int(os.environ.get('EMAIL_WORKERS', 2))
+        app.config['EMAIL_BATCH_SIZE'] = int(os.environ.get('EMAIL_BATCH_SIZE', 20))
+        app.config['EMAIL_POLL_INTERVAL'] = float(os.environ.get('EMAIL_POLL_INTERVAL', 2.0))
+        app.config['EMAIL_MAX_ATTEMPTS'] = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+        app.config['EMAIL_RETRY_BACKOFF'] = float(os.environ.get('EMAIL_RETRY_BACKOFF', 30))
+        app.config['EMAIL_RETRY_BACKOFF_MAX'] = float(os.environ.get('EMAIL_RETRY_BACKOFF_MAX', 3600))
+
+        # Seconds a checkout may hold stock while the payment runs
+        app.config['STOCK_RESERVATION_TTL'] = int(os.environ.get('STOCK_RESERVATION_TTL', 600))
+
+        # Order history paging and the admin order export
+        app.config['ORDER_HISTORY_PAGE_SIZE'] = int(os.environ.get('ORDER_HISTORY_PAGE_SIZE', 20))
+        app.config['ORDER_HISTORY_MAX_PAGE_SIZE'] = int(os.environ.get('ORDER_HISTORY_MAX_PAGE_SIZE', 100))
+        app.config['ORDER_EXPORT_BATCH'] = int(os.environ.get('ORDER_EXPORT_BATCH', 1000))
+
+        # Pricing: tax and an optional order discount, as percentages (see app/pricing.py)
+        app.config['TAX_RATE'] = os.environ.get('TAX_RATE', '0')
+        app.config['DISCOUNT_PERCENT'] = os.environ.get('DISCOUNT_PERCENT', '0')
+        app.config['DISCOUNT_MIN_SUBTOTAL_CENTS'] = int(os.environ.get('DISCOUNT_MIN_SUBTOTAL_CENTS', 0))
+
+        # Sales rollups and low-stock alerts (see app/analytics.py)
+        app.config['LOW_STOCK_THRESHOLD'] = int(os.environ.get('LOW_STOCK_THRESHOLD', 5))
+        app.config['ANALYTICS_DASHBOARD_DAYS'] = int(os.environ.get('ANALYTICS_DASHBOARD_DAYS', 30))
+
+        # Password hashing pool and the user_loader cache (see app/auth.py)
+        app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+        app.config['PASSWORD_WORKERS'] = os.environ.get('PASSWORD_WORKERS')
+        app.config['PASSWORD_MAX_PENDING'] = int(os.environ.get('PASSWORD_MAX_PENDING', 0)) or None
+        app.config['PASSWORD_QUEUE_TIMEOUT'] = float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', 2))
+        app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+        app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+
+        # Cart storage: 'sql', 'memory' or a redis:// URL (see app/cart_store.py)
+        app.config['CART_STORE'] = os.environ.get('CART_STORE', 'sql')
+        app.config['CART_TTL'] = int(os.environ.get('CART_TTL', 30 * 24 * 3600))
+        app.config['CART_FLUSH_INTERVAL'] = float(os.environ.get('CART_FLUSH_INTERVAL', 30))
+
+        # Payment gateway (see app/payments.py)
+        app.config['PAYMENT_GATEWAY'] = os.environ.get('PAYMENT_GATEWAY', 'mock')
+        app.config['PAYMENT_MODE'] = os.environ.get('PAYMENT_MODE', 'sync')
+        app.config['PAYMENT_TIMEOUT'] = float(os.environ.get('PAYMENT_TIMEOUT', 10))
+        app.config['PAYMENT_CIRCUIT_FAILURES'] = int(os.environ.get('PAYMENT_CIRCUIT_FAILURES', 5))
+        app.config['PAYMENT_CIRCUIT_RESET'] = float(os.environ.get('PAYMENT_CIRCUIT_RESET', 30))
+        app.config['PAYMENT_WORKERS'] = int(os.environ.get('PAYMENT_WORKERS', 4))
+        app.config['PAYMENT_MAX_PENDING'] = int(os.environ.get('PAYMENT_MAX_PENDING', 100))
+        app.config['MOCK_PAYMENT_LATENCY_MS'] = float(os.environ.get('MOCK_PAYMENT_LATENCY_MS', 0))
+        app.config['MOCK_PAYMENT_JITTER_MS'] = float(os.environ.get('MOCK_PAYMENT_JITTER_MS', 0))
+        app.config['MOCK_PAYMENT_SUCCESS_RATE'] = os.environ.get('MOCK_PAYMENT_SUCCESS_RATE')
+
+        # Catalog listing pages and the rendered-page cache in front of them
+        app.config['CATALOG_PAGE_SIZE'] = int(os.environ.get('CATALOG_PAGE_SIZE', 24))
+        app.config['CATALOG_MAX_PAGE_SIZE'] = int(os.environ.get('CATALOG_MAX_PAGE_SIZE', 100))
+        app.config['CATALOG_CACHE_SIZE'] = int(os.environ.get('CATALOG_CACHE_SIZE', 256))
+        app.config['CATALOG_CACHE_TTL'] = float(os.environ.get('CATALOG_CACHE_TTL', 60))
+
+        # Conditional GETs, CDN caching of anonymous catalog pages and static file URLs (see app/http_cache.py)
+        app.config['HTTP_CACHE_RELEASE'] = os.environ.get('HTTP_CACHE_RELEASE') or os.environ.get('VERCEL_GIT_COMMIT_SHA')
+        app.config['HTTP_SHARED_MAX_AGE'] = int(os.environ.get('HTTP_SHARED_MAX_AGE', 60))
+        app.config['HTTP_BROWSER_MAX_AGE'] = int(os.environ.get('HTTP_BROWSER_MAX_AGE', 0))
+        app.config['STATIC_MAX_AGE'] = int(os.environ.get('STATIC_MAX_AGE', 365 * 24 * 3600))
+
+        # Per-client rate limits and load shedding (see app/throttling.py)
+        app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED')
+        app.config['RATE_LIMIT_STORE'] = os.environ.get('RATE_LIMIT_STORE', 'memory')
+        app.config['RATE_LIMIT_LOGIN'] = os.environ.get('RATE_LIMIT_LOGIN', '10/minute')
+        app.config['RATE_LIMIT_REGISTER'] = os.environ.get('RATE_LIMIT_REGISTER', '5/hour')
+        app.config['RATE_LIMIT_CART'] = os.environ.get('RATE_LIMIT_CART', '120/minute')
+        app.config['RATE_LIMIT_CHECKOUT'] = os.environ.get('RATE_LIMIT_CHECKOUT', '10/minute')
+        app.config['ADMISSION_CONTROL'] = os.environ.get('ADMISSION_CONTROL', 'true').lower() == 'true'
+        app.config['ADMISSION_MAX_IN_FLIGHT'] = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 64))
+        app.config['ADMISSION_SHED_LOW'] = float(os.environ.get('ADMISSION_SHED_LOW', 0.75))
+        app.config['ADMISSION_SHED_NORMAL'] = float(os.environ.get('ADMISSION_SHED_NORMAL', 0.9))
+        # Number of proxies (e.g. Vercel's edge) in front of the app whose X-Forwarded-For to trust
+        app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+
+        # Product search: 'memory' (in-process index) or 'database' (FTS) (see app/search.py)
+        app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'memory')
+        app.config['SEARCH_WARM'] = os.environ.get('SEARCH_WARM')
+        # Seconds before the memory index is rebuilt to pick up other processes' changes; 0 never
+        app.config['SEARCH_INDEX_TTL'] = float(os.environ.get('SEARCH_INDEX_TTL', 300))
+
+        # Template compilation and the rendered order-line cache (see app/rendering.py)
+        app.config['RENDER_PRECOMPILE'] = os.environ.get('RENDER_PRECOMPILE')
+        app.config['RENDER_BYTECODE_CACHE'] = os.environ.get('RENDER_BYTECODE_CACHE', 'tmp')
+        app.config['RENDER_CACHE_SIZE'] = int(os.environ.get('RENDER_CACHE_SIZE', 1024))
+
+        # Limits for POST /api/bulk_orders
+        app.config['BULK_ORDER_MAX_ORDERS'] = int(os.environ.get('BULK_ORDER_MAX_ORDERS', 1000))
+        app.config['BULK_ORDER_MAX_LINES'] = int(os.environ.get('BULK_ORDER_MAX_LINES', 20000))
     except Exception as e:
-        print("✗ Error loading config:", e)
+        log_event('config_error', logging.ERROR, error=str(e))
         # Don't raise here, continue with defaults
 
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    if not app.config.get('EMAIL_DELIVERY'):
+        app.config['EMAIL_DELIVERY'] = 'inline' if app.testing else 'background'
+    if app.config.get('PASSWORD_WORKERS') is None:
+        app.config['PASSWORD_WORKERS'] = 0 if app.testing else 2
+    app.config['PASSWORD_WORKERS'] = int(app.config['PASSWORD_WORKERS'])
+    if app.config.get('MOCK_PAYMENT_SUCCESS_RATE') is None:
+        app.config['MOCK_PAYMENT_SUCCESS_RATE'] = 1.0 if app.testing else 0.75
+    app.config['MOCK_PAYMENT_SUCCESS_RATE'] = float(app.config['MOCK_PAYMENT_SUCCESS_RATE'])
+    if app.config.get('SEARCH_WARM') is None:
+        app.config['SEARCH_WARM'] = not app.testing
+    elif isinstance(app.config['SEARCH_WARM'], str):
+        app.config['SEARCH_WARM'] = app.config['SEARCH_WARM'].lower() == 'true'
+    if app.config.get('RENDER_PRECOMPILE') is None:
+        app.config['RENDER_PRECOMPILE'] = not app.testing
+    elif isinstance(app.config['RENDER_PRECOMPILE'], str):
+        app.config['RENDER_PRECOMPILE'] = app.config['RENDER_PRECOMPILE'].lower() == 'true'
+    if app.config.get('RATE_LIMIT_ENABLED') is None:
+        app.config['RATE_LIMIT_ENABLED'] = not app.testing
+    elif isinstance(app.config['RATE_LIMIT_ENABLED'], str):
+        app.config['RATE_LIMIT_ENABLED'] = app.config['RATE_LIMIT_ENABLED'].lower() == 'true'
+
     try:
         db.init_app(app)
-        with app.app_context():
-            db.create_all()
-        mail.init_app(app)
+        init_instrumentation(app)
+        init_replicas(app)
+        init_schema(app)
+        init_email_outbox(app)
+        init_inventory(app)
+        init_pricing(app)
+        init_cart_store(app)
+        init_payments(app)
+        init_catalog(app)
+        init_search(app)
+        init_rendering(app)
+        init_http_cache(app)
+        init_throttling(app)
+        init_analytics(app)
+        init_auth(app)
         login_manager.init_app(app)
-        print("✓ Extensions initialized")
     except Exception as e:
-        print("✗ Error initializing extensions:", e)
+        log_event('extension_init_error', logging.ERROR, error=str(e))
         # Continue without raising to prevent complete failure
 
-    try:
-        admin = Admin(app, name='Order-System Admin', template_mode='bootstrap4')
-        admin.add_view(AdminModelView(User, db.session))
-        admin.add_view(AdminModelView(Product, db.session))
-        admin.add_view(AdminModelView(Order, db.session))
-        admin.add_view(AdminModelView(OrderItem, db.session))
-        admin.add_view(AdminModelView(CartItem, db.session))
-        print("✓ Admin panel setup")
-    except Exception as e:
-        print("✗ Error setting up admin:", e)
-        # Continue without admin panel if it fails
+    # Flask-Admin is built on the first /admin request, not at startup
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/admin': LazyAdmin(app)})
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 
     try:
         app.register_blueprint(main_bp)
-        print("✓ Blueprint registered")
     except Exception as e:
-        print("✗ Error registering blueprint:", e)
+        log_event('blueprint_error', logging.ERROR, error=str(e))
         raise  # This is critical, so we should fail if blueprints don't register
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return get_user_cache().load(int(user_id))
 
     @app.errorhandler(500)
     def internal_error(error):
-        print(f"500 Error: {error}")
+        log_event('internal_error', logging.ERROR, path=request.path, error=str(error))
         return "Internal Server Error - Check logs for details", 500
 
     @app.errorhandler(404)
@@ -97,11 +248,28 @@ def create_app():
             return '', 204  # No content for favicon
         return "Page not found", 404
 
-    print("✓ App created successfully")
+    options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    log_event('app_created', database=app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+              pool={k: v for k, v in options.items() if k.startswith('pool_') or k == 'max_overflow'},
+              email_delivery=app.config['EMAIL_DELIVERY'])
     return app
 
-class AdminModelView(ModelView):
-    def is_accessible(self):
-        return current_user.is_authenticated and getattr(current_user, 'is_admin', False)
-    def inaccessible_callback(self, name, **kwargs):
-        return redirect(url_for('main.login', next=request.url))
+class LazyAdmin:
+    """WSGI app that builds the admin panel (app/admin.py) when it is first requested."""
+
+    def __init__(self, app):
+        self.app = app
+        self.admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if self.admin_app is None:
+            with self._lock:
+                if self.admin_app is None:
+                    try:
+                        from .admin import create_admin_app
+                        self.admin_app = create_admin_app(self.app)
+                    except Exception as e:
+                        log_event('admin_setup_error', logging.ERROR, error=str(e))
+                        return Response('Admin panel unavailable', status=503)(environ, start_response)
+        return self.admin_app(environ, start_response)
@@ -0,0 +1,109 @@
+from datetime import date
+
+from flask import Flask, Response, abort, current_app, redirect, request, stream_with_context
+from flask_admin import Admin, BaseView, expose
+from flask_admin.contrib.sqla import ModelView
+from flask_login import current_user
+from urllib.parse import urlencode
+
+from .models import db, User, Product, Order, OrderItem, CartItem, DailySales, ProductSales, StockAlert
+from .catalog import get_catalog_cache
+from .order_history import FORMATS, export_rows, export_statement
+from .replicas import get_replicas, read_engine, route_reads
+
+# Imported on the first /admin request only (see LazyAdmin in app/__init__.py).
+# The panel is a small Flask app of its own mounted under /admin; it shares the
+# parent's config, database engines, login manager and extension state.
+
+
+class AdminAccessMixin:
+    def is_accessible(self):
+        return current_user.is_authenticated and getattr(current_user, 'is_admin', False)
+    def inaccessible_callback(self, name, **kwargs):
+        return redirect(f"{request.host_url}login?{urlencode({'next': request.url})}")
+
+
+class AdminModelView(AdminAccessMixin, ModelView):
+    def after_model_change(self, form, model, is_created):
+        if isinstance(model, Product):
+            get_catalog_cache().invalidate()
+    def after_model_delete(self, model):
+        if isinstance(model, Product):
+            get_catalog_cache().invalidate()
+
+
+
+class OrderExportView(AdminAccessMixin, BaseView):
+    """Streams order lines as CSV or NDJSON; ?start=&end= (YYYY-MM-DD) and ?user_id= narrow it."""
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/order_export.html', formats=list(FORMATS))
+
+    @expose('/orders.<fmt>')
+    def export(self, fmt):
+        if fmt not in FORMATS:
+            abort(404)
+        try:
+            start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+            end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+        except ValueError:
+            abort(400, description='Dates must be YYYY-MM-DD.')
+        stmt = export_statement(start, end, request.args.get('user_id', type=int))
+        mimetype, stream = FORMATS[fmt]
+        batches = export_rows(read_engine(), stmt, current_app.config['ORDER_EXPORT_BATCH'])
+        return Response(stream_with_context(stream(batches)), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename=orders.{fmt}'})
+
+
+
+class SalesDashboardView(AdminAccessMixin, BaseView):
+    """Sales and stock figures read from the rollup tables kept by app/analytics.py."""
+
+    @expose('/')
+    def index(self):
+        days = DailySales.query.order_by(DailySales.day.desc()).limit(current_app.config['ANALYTICS_DASHBOARD_DAYS']).all()
+        top = ProductSales.query.order_by(ProductSales.units.desc()).limit(20).all()
+        alerts = StockAlert.query.order_by(StockAlert.stock, StockAlert.product_id).all()
+        return self.render('admin/sales_dashboard.html', days=days, top=top, alerts=alerts,
+                           threshold=current_app.config['LOW_STOCK_THRESHOLD'])
+
+
+def _share_engines(parent, admin_app):
+    # Reuse the parent's engines (and so its connection pools) instead of opening new ones.
+    # Flask-SQLAlchemy has no public way to do this: db.init_app() always builds new
+    # engines, and passing the parent's pool as an engine option clashes with the
+    # StaticPool it forces on in-memory SQLite. So this writes its per-app engine map,
+    # an internal that requirements.txt pins Flask-SQLAlchemy's exact version for, and
+    # checks the result so an upgrade that changes it fails here, not mid-request.
+    with parent.app_context():
+        engines = db.engines
+    db._app_engines[admin_app] = engines
+    with admin_app.app_context():
+        if db.engines is not engines:
+            raise RuntimeError('Cannot share database engines with the admin app on this Flask-SQLAlchemy version.')
+
+
+def create_admin_app(parent):
+    from . import login_manager
+
+    admin_app = Flask(__name__, static_folder=None)
+    admin_app.config.update(parent.config)
+    admin_app.extensions.update(parent.extensions)
+    _share_engines(parent, admin_app)
+    admin_app.teardown_appcontext(lambda exc: db.session.remove())
+    if get_replicas(parent):
+        route_reads(admin_app, get_replicas(parent))
+    admin_app.jinja_env.filters.update(parent.jinja_env.filters)
+    admin_app.jinja_env.bytecode_cache = parent.jinja_env.bytecode_cache
+    login_manager.init_app(admin_app)
+
+    admin = Admin(admin_app, name='Order-System Admin', template_mode='bootstrap4', url='/')
+    admin.add_view(AdminModelView(User, db.session))
+    admin.add_view(AdminModelView(Product, db.session))
+    admin.add_view(AdminModelView(Order, db.session))
+    admin.add_view(AdminModelView(OrderItem, db.session))
+    admin.add_view(AdminModelView(CartItem, db.session))
+    admin.add_view(SalesDashboardView(name='Sales', endpoint='sales'))
+    admin.add_view(OrderExportView(name='Export orders', endpoint='order_export'))
+    return admin_app
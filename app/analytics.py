@@ -0,0 +1,165 @@
+from datetime import datetime
+
+import click
+from flask import current_app, has_app_context
+from sqlalchemy import Date, DateTime, delete, event, func, insert, literal, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .models import db, Product, Order, OrderItem, DailySales, ProductSales, StockAlert
+
+# Reporting reads rollup tables instead of scanning order and order_item:
+#   daily_sales    - orders, units and revenue per day
+#   product_sales  - orders, units and revenue per product
+#   stock_alert    - products at or below LOW_STOCK_THRESHOLD units of stock
+#
+# record_orders() adds an order's lines to the sales rollups in the same
+# transaction that makes the order a sale: a paid checkout, a settled async
+# payment or an accepted bulk order. Stock alerts are refreshed just before any
+# commit that changed product stock. `flask rebuild-analytics` recomputes the
+# rollups from history with one GROUP BY per batch of orders, using the same
+# aggregation as the incremental path.
+
+daily_table = DailySales.__table__
+product_sales_table = ProductSales.__table__
+alert_table = StockAlert.__table__
+COUNTERS = ('orders', 'units', 'revenue_cents')
+UPSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _upsert(table, rows, session=None):
+    """Insert rows, or add their COUNTERS to (and overwrite their other columns on) existing rows."""
+    if not rows:
+        return
+    session = session or db.session
+    keys = [column.name for column in table.primary_key.columns]
+    make_insert = UPSERTS.get(session.get_bind().dialect.name)
+    if make_insert is not None:
+        stmt = make_insert(table)
+        changes = {name: (table.c[name] + stmt.excluded[name] if name in COUNTERS else stmt.excluded[name])
+                   for name in rows[0] if name not in keys}
+        session.execute(stmt.on_conflict_do_update(index_elements=keys, set_=changes), rows)
+        return
+    for row in rows:
+        changes = {name: (table.c[name] + value if name in COUNTERS else value)
+                   for name, value in row.items() if name not in keys}
+        if not session.execute(update(table).where(*[table.c[k] == row[k] for k in keys]).values(changes)).rowcount:
+            session.execute(insert(table).values(row))
+
+
+def counted_orders():
+    """Orders that are sales: everything except failed checkouts and checkouts still awaiting payment.
+
+    Invoiced bulk orders count from the start; they are billed to the account, not charged at checkout.
+    """
+    from .payments import PENDING, FAILED
+
+    return (or_(Order.status.is_(None), Order.status != FAILED),
+            or_(Order.paid.is_(True), Order.status != PENDING, Order.idempotency_key.is_(None),
+                ~Order.idempotency_key.like('checkout:%')))
+
+
+def _aggregate(*criteria):
+    day = func.date(Order.created_at, type_=Date)
+    quantity, line_total = func.sum(OrderItem.quantity), func.sum(OrderItem.price_cents * OrderItem.quantity)
+    orders = func.count(func.distinct(Order.id))
+    daily = db.session.execute(
+        select(day, orders, quantity, line_total)
+        .join(OrderItem, OrderItem.order_id == Order.id)
+        .where(*criteria).group_by(day))
+    _upsert(daily_table, [{'day': d, 'orders': n, 'units': u, 'revenue_cents': r} for d, n, u, r in daily])
+    products = db.session.execute(
+        select(OrderItem.product_id, func.max(Product.name), orders, quantity, line_total, func.max(Order.created_at))
+        .select_from(Order)
+        .join(OrderItem, OrderItem.order_id == Order.id)
+        .outerjoin(Product, Product.id == OrderItem.product_id)
+        .where(*criteria).group_by(OrderItem.product_id))
+    _upsert(product_sales_table, [{'product_id': pid, 'name': name, 'orders': n, 'units': u, 'revenue_cents': r,
+                                   'last_sold_at': last} for pid, name, n, u, r, last in products])
+
+
+def record_orders(order_ids):
+    """Add orders that just became sales to the rollups. The caller commits."""
+    if order_ids:
+        _aggregate(Order.id.in_(list(order_ids)))
+
+
+def rebuild_rollups(batch_size=50000):
+    """Recompute the sales rollups from all orders and the stock alerts from all products. The caller commits."""
+    db.session.execute(delete(daily_table))
+    db.session.execute(delete(product_sales_table))
+    low, high = db.session.query(func.min(Order.id), func.max(Order.id)).one()
+    batches = 0
+    if low is not None:
+        for start in range(low, high + 1, batch_size):
+            _aggregate(Order.id >= start, Order.id < start + batch_size, *counted_orders())
+            batches += 1
+    db.session.execute(delete(alert_table))
+    db.session.execute(insert(alert_table).from_select(
+        ['product_id', 'name', 'stock', 'since'],
+        select(Product.id, Product.name, Product.stock, literal(datetime.utcnow(), DateTime))
+        .where(Product.stock <= current_app.config['LOW_STOCK_THRESHOLD'])))
+    return batches
+
+
+def refresh_stock_alerts(product_ids, session=None):
+    """Raise, update or clear the alerts of the given products.
+
+    Two statements however many products changed: a DELETE and an INSERT ... SELECT upsert.
+    """
+    session = session or db.session
+    threshold = current_app.config['LOW_STOCK_THRESHOLD']
+    product_ids = list(product_ids)
+    make_insert = UPSERTS.get(session.get_bind().dialect.name)
+    if make_insert is not None:
+        low = select(Product.id).where(Product.id.in_(product_ids), Product.stock <= threshold)
+        # Products back above the threshold, or deleted, lose their alert.
+        session.execute(delete(alert_table).where(alert_table.c.product_id.in_(product_ids),
+                                                  alert_table.c.product_id.not_in(low)))
+        stmt = make_insert(alert_table).from_select(
+            ['product_id', 'name', 'stock', 'since'],
+            select(Product.id, Product.name, Product.stock, literal(datetime.utcnow(), DateTime))
+            .where(Product.id.in_(product_ids), Product.stock <= threshold))
+        # An existing alert keeps its `since`.
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=['product_id'], set_={'name': stmt.excluded.name, 'stock': stmt.excluded.stock},
+            where=alert_table.c.stock != stmt.excluded.stock))
+        return
+    rows = session.execute(select(Product.id, Product.name, Product.stock, alert_table.c.stock)
+                           .outerjoin(alert_table, alert_table.c.product_id == Product.id)
+                           .where(Product.id.in_(product_ids)))
+    raised, keep = [], set()
+    for pid, name, stock, alerted in rows:
+        if stock <= threshold:
+            keep.add(pid)
+            if alerted != stock:
+                raised.append({'product_id': pid, 'name': name, 'stock': stock})
+        elif alerted is None:
+            keep.add(pid)
+    # Products back above the threshold, or deleted, lose their alert.
+    cleared = set(product_ids) - keep
+    if cleared:
+        session.execute(delete(alert_table).where(alert_table.c.product_id.in_(cleared)))
+    _upsert(alert_table, raised, session)
+
+
+@event.listens_for(Session, 'before_commit')
+def _refresh_alerts_before_commit(session):
+    if session.in_nested_transaction() or not has_app_context():
+        return
+    if current_app.config.get('LOW_STOCK_THRESHOLD') is None:
+        return
+    session.flush()
+    changed = session.info.get('changed_products')
+    if changed:
+        refresh_stock_alerts(changed, session)
+
+
+def init_analytics(app):
+    @app.cli.command('rebuild-analytics')
+    @click.option('--batch-size', type=int, default=50000, help='Orders aggregated per statement.')
+    def rebuild_analytics(batch_size):
+        """Recompute the sales rollups and stock alerts from order history."""
+        batches = rebuild_rollups(batch_size)
+        db.session.commit()
+        click.echo(f"Rebuilt sales rollups from {batches} batches of orders.")
@@ -0,0 +1,165 @@
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .models import db, User
+from .signals import users_changed
+
+# Password hashing is deliberately slow, so it runs on a small process pool
+# (PASSWORD_WORKERS) instead of the request thread, where it would hold the GIL
+# and stall every other request in the worker. At most PASSWORD_MAX_PENDING
+# hashes may be queued or running; a request that cannot get a slot within
+# PASSWORD_QUEUE_TIMEOUT seconds gets HasherBusy, which the routes turn into a
+# 503. PASSWORD_WORKERS=0 hashes in the request thread, still bounded.
+#
+# UserCache keeps the columns flask-login needs to rebuild current_user for
+# USER_CACHE_TTL seconds, so authenticated requests skip the user SELECT.
+# Commits that change a user clear its entry (see users_changed).
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256:600000', workers=2, max_pending=None, queue_timeout=1.0):
+        # `method` is a werkzeug method string; shorthands ('scrypt', 'pbkdf2:sha256') get werkzeug's default cost.
+        self.method = method
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending or max(workers, 1) * 4)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['PASSWORD_HASH_METHOD'], config['PASSWORD_WORKERS'],
+                   config['PASSWORD_MAX_PENDING'], config['PASSWORD_QUEUE_TIMEOUT'])
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # Created on first use, per process; spawned so children don't inherit app threads.
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _reset(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def _run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusy('Password hashing queue is full.')
+        try:
+            if not self.workers:
+                return fn(*args, **kwargs)
+            pool = self._pool()
+            try:
+                return pool.submit(fn, *args, **kwargs).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed); start a fresh pool and try once more.
+                self._reset(pool)
+                return self._pool().submit(fn, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+    @property
+    def method(self):
+        return self._method
+
+    @method.setter
+    def method(self, method):
+        self._method = method
+        self._prefix = None
+
+    def hash(self, password):
+        pwhash = self._run(generate_password_hash, password, method=self.method)
+        self._prefix = pwhash.split('$', 1)[0] + '$'
+        return pwhash
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether `pwhash` was made with another method or cost. May raise HasherBusy."""
+        if self._prefix is None:
+            # Compare against what werkzeug writes for `method`, with shorthands spelled out, not `method` itself.
+            self.hash('')
+        return not pwhash.startswith(self._prefix)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+class UserCache:
+    COLUMNS = [column.key for column in User.__table__.columns if column.key != 'password']
+
+    def __init__(self, ttl=60.0, max_entries=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        if self.ttl <= 0:
+            return db.session.get(User, user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(user_id)
+                values = entry[1]
+            else:
+                values = None
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self.put(user)
+            return user
+        user = User(**values)
+        make_transient_to_detached(user)
+        # Attach without a SELECT; anything not cached (password, relationships) loads on access.
+        return db.session.merge(user, load=False)
+
+    def put(self, user):
+        values = {key: getattr(user, key) for key in self.COLUMNS}
+        with self._lock:
+            self._entries[user.id] = (self.clock() + self.ttl, values)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, sender=None, user_ids=None, **kwargs):
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+            for user_id in user_ids or ():
+                self._entries.pop(user_id, None)
+
+
+def get_password_hasher(app=None):
+    return (app or current_app).extensions['password_hasher']
+
+
+def get_user_cache(app=None):
+    return (app or current_app).extensions['user_cache']
+
+
+def init_auth(app):
+    app.extensions['password_hasher'] = PasswordHasher.from_config(app.config)
+    cache = UserCache(app.config['USER_CACHE_TTL'], app.config['USER_CACHE_SIZE'])
+    app.extensions['user_cache'] = cache
+    users_changed.connect(cache.invalidate)
+    return cache
@@ -0,0 +1,160 @@
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, Product, Order, OrderItem
+from .inventory import OutOfStock, aggregate, decrement_stock
+from .email_outbox import enqueue_order_confirmations
+from .analytics import record_orders
+from .pricing import get_pricing
+from .payments import INVOICED
+
+# Set-based order placement for wholesale clients. A request carries many
+# orders (or one very large one); all SKUs are validated with one SELECT, stock
+# for every accepted order is taken with one conditional UPDATE, and orders and
+# their lines are written with multi-row INSERTs. Each order succeeds or fails
+# on its own and gets its own entry in the result list. Orders are created
+# invoiced (billed to the client's account rather than charged), so they count
+# as sales and get a confirmation email straight away.
+#
+# Request body:
+#     {"request_id": "optional-client-key",
+#      "orders": [{"reference": "PO-1", "lines": [{"product_id": 1, "quantity": 5}]}]}
+#
+# With a request_id, replaying the same request returns the orders created the
+# first time instead of placing them again. When two submits of the same request
+# race, the loser's INSERT hits the unique idempotency key; its work is rolled
+# back and it answers with the winner's orders, as a replay would.
+
+
+class BulkOrderError(ValueError):
+    pass
+
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def parse_bulk_request(payload, max_orders, max_lines):
+    if not isinstance(payload, dict) or not isinstance(payload.get('orders'), list):
+        raise BulkOrderError('Body must be a JSON object with an "orders" list.')
+    orders = payload['orders']
+    if not orders:
+        raise BulkOrderError('No orders given.')
+    if len(orders) > max_orders:
+        raise BulkOrderError(f'At most {max_orders} orders per request.')
+    request_id = payload.get('request_id')
+    if request_id is not None and (not isinstance(request_id, str) or not 0 < len(request_id) <= 36):
+        raise BulkOrderError('request_id must be a string of at most 36 characters.')
+
+    parsed, line_count = [], 0
+    for index, order in enumerate(orders):
+        entry = {'index': index, 'reference': None, 'lines': [], 'error': None}
+        parsed.append(entry)
+        if not isinstance(order, dict) or not isinstance(order.get('lines'), list) or not order['lines']:
+            entry['error'] = 'Order must have a non-empty "lines" list.'
+            continue
+        entry['reference'] = order.get('reference')
+        line_count += len(order['lines'])
+        if line_count > max_lines:
+            raise BulkOrderError(f'At most {max_lines} order lines per request.')
+        for line in order['lines']:
+            if (not isinstance(line, dict) or not _positive_int(line.get('product_id'))
+                    or not _positive_int(line.get('quantity'))):
+                entry['error'] = 'Each line needs a positive integer "product_id" and "quantity".'
+                break
+            entry['lines'].append((line['product_id'], line['quantity']))
+    return request_id, parsed
+
+
+def _rejected(entry, error, product_ids=None):
+    result = {'index': entry['index'], 'reference': entry['reference'], 'status': 'rejected', 'error': error}
+    if product_ids:
+        result['product_ids'] = sorted(product_ids)
+    return result
+
+
+def place_bulk_orders(user_id, user_email, request_id, orders):
+    """Create the orders that can be fulfilled and return one result per order. The caller commits."""
+    prefix = f'bulk:{user_id}:{request_id}' if request_id else f'bulk:{uuid.uuid4().hex}'
+    results = [None] * len(orders)
+    for entry in orders:
+        entry['key'] = f"{prefix}:{entry['index']}"
+        if entry['error']:
+            results[entry['index']] = _rejected(entry, entry['error'])
+
+    candidates = [entry for entry in orders if results[entry['index']] is None]
+    if request_id and candidates:
+        replayed = dict(db.session.query(Order.idempotency_key, Order.id).filter(
+            Order.idempotency_key.in_([entry['key'] for entry in candidates])).all())
+        for entry in candidates:
+            if entry['key'] in replayed:
+                results[entry['index']] = {'index': entry['index'], 'reference': entry['reference'],
+                                           'status': 'created', 'order_id': replayed[entry['key']], 'replayed': True}
+        candidates = [entry for entry in candidates if results[entry['index']] is None]
+
+    product_ids = {pid for entry in candidates for pid, _ in entry['lines']}
+    prices = dict(db.session.query(Product.id, Product.price_cents).filter(Product.id.in_(product_ids)).all()) if product_ids else {}
+    valid = []
+    for entry in candidates:
+        unknown = {pid for pid, _ in entry['lines'] if pid not in prices}
+        if unknown:
+            results[entry['index']] = _rejected(entry, 'unknown_products', unknown)
+        else:
+            entry['quantities'] = aggregate(entry['lines'])
+            valid.append(entry)
+
+    accepted = _take_stock(valid, results)
+    if not accepted:
+        return results
+
+    now = datetime.utcnow()
+    pricing = get_pricing()
+    for entry in accepted:
+        entry['quote'] = pricing.quote((prices[pid], qty) for pid, qty in entry['lines'])
+    try:
+        created = db.session.execute(
+            insert(Order).returning(Order.idempotency_key, Order.id),
+            [{'user_id': user_id, 'created_at': now, 'total_cents': entry['quote'].total, 'paid': False, 'status': INVOICED,
+              'discount_cents': entry['quote'].discount, 'tax_cents': entry['quote'].tax,
+              'idempotency_key': entry['key']} for entry in accepted])
+    except IntegrityError:
+        if not request_id:
+            raise
+        # A concurrent submit of the same request created these orders first.
+        db.session.rollback()
+        return place_bulk_orders(user_id, user_email, request_id, orders)
+    order_ids = dict(created.all())
+    db.session.execute(insert(OrderItem), [
+        {'order_id': order_ids[entry['key']], 'product_id': pid, 'quantity': qty, 'price_cents': prices[pid]}
+        for entry in accepted for pid, qty in entry['lines']
+    ])
+    record_orders(order_ids.values())
+    enqueue_order_confirmations(user_email, [order_ids[entry['key']] for entry in accepted])
+
+    for entry in accepted:
+        results[entry['index']] = {'index': entry['index'], 'reference': entry['reference'], 'status': 'created',
+                                   'order_id': order_ids[entry['key']], 'total_amount': entry['quote'].total / 100,
+                                   'total_cents': entry['quote'].total}
+    return results
+
+
+def _take_stock(orders, results):
+    # Fast path: the whole request fits in stock, one UPDATE for everything.
+    demand = aggregate((pid, qty) for entry in orders for pid, qty in entry['quantities'].items())
+    try:
+        decrement_stock(demand)
+        return orders
+    except OutOfStock:
+        pass
+    # Otherwise allocate order by order, in request order, one UPDATE each.
+    accepted = []
+    for entry in orders:
+        try:
+            decrement_stock(entry['quantities'])
+            accepted.append(entry)
+        except OutOfStock as e:
+            results[entry['index']] = _rejected(entry, 'out_of_stock', e.product_ids)
+    return accepted
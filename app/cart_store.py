@@ -0,0 +1,482 @@
+import json
+import logging
+import threading
+import time
+
+import click
+from flask import current_app
+from sqlalchemy import insert
+
+from .models import db, Product, CartItem
+from .pricing import to_cents
+from .queries import cart_items_with_products
+from .signals import products_changed
+
+# Carts live behind a CartStore chosen by CART_STORE:
+#   sql         - the cart_item table, read and written on every request (default)
+#   memory      - LocalKV, an in-process stand-in for a key-value server; only
+#                 correct with a single app process, so meant for tests and dev
+#   redis://... - a Redis server (needs the optional `redis` package)
+#
+# The key-value store keeps each cart as one JSON document with a running
+# total, so adding or removing a line never touches the database. Changed carts
+# are remembered in a dirty set and written back to cart_item in batches every
+# CART_FLUSH_INTERVAL seconds (or by `flask flush-carts`); a cart missing from
+# the store is loaded from cart_item, so a flushed cart survives a restart.
+# When products change, the time is stamped in the cart:prices hash, which every
+# worker reads, and cart lines priced before their product's stamp are
+# repriced on the next read.
+# Every change re-reads and rewrites the document inside a WATCH/MULTI
+# transaction, so concurrent requests for one cart retry instead of losing
+# each other's lines. Clearing a cart at checkout bumps its cart:<id>:cleared counter, and a flush
+# that sees the counter move while it writes drops that cart's rows instead of
+# writing back a snapshot taken before the checkout.
+
+
+class CartLine:
+    __slots__ = ('product_id', 'name', 'price_cents', 'quantity', 'priced_at')
+
+    def __init__(self, product_id, name, price_cents, quantity, priced_at=0.0):
+        self.product_id = product_id
+        self.name = name
+        self.price_cents = price_cents
+        self.quantity = quantity
+        self.priced_at = priced_at
+
+    @property
+    def subtotal_cents(self):
+        return self.price_cents * self.quantity
+
+
+class Cart:
+    """Cart lines keyed by product id, with the subtotal in cents kept up to date as lines change."""
+
+    def __init__(self, lines=(), total_cents=None):
+        self.lines = {line.product_id: line for line in lines}
+        self.total_cents = sum(line.subtotal_cents for line in self.lines.values()) if total_cents is None else total_cents
+        # Product rows loaded alongside the lines (SQL store only), so checkout can skip reloading them.
+        self.products = None
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    @property
+    def count(self):
+        return sum(line.quantity for line in self.lines.values())
+
+    def add(self, product_id, quantity, name=None, price_cents=None, priced_at=0.0):
+        line = self.lines.get(product_id)
+        if line is None:
+            line = self.lines[product_id] = CartLine(product_id, name, price_cents, 0, priced_at)
+        line.quantity += quantity
+        self.total_cents += line.price_cents * quantity
+
+    def remove(self, product_id):
+        line = self.lines.pop(product_id, None)
+        if line is not None:
+            self.total_cents -= line.subtotal_cents
+        return line
+
+    def reprice(self, product_id, name, price_cents, priced_at):
+        line = self.lines[product_id]
+        self.total_cents += (price_cents - line.price_cents) * line.quantity
+        line.name, line.price_cents, line.priced_at = name, price_cents, priced_at
+
+    def to_json(self):
+        return json.dumps({'v': 2, 'total_cents': self.total_cents, 'lines': [
+            [line.product_id, line.name, line.price_cents, line.quantity, line.priced_at] for line in self.lines.values()]})
+
+    @classmethod
+    def from_json(cls, raw):
+        data = json.loads(raw)
+        if data.get('v') != 2:
+            # Stored before prices were cents; priced_at=0 makes the next read reprice every line.
+            return cls([CartLine(pid, name, to_cents(price), qty, 0.0) for pid, name, price, qty, _ in data['lines']])
+        return cls([CartLine(*values) for values in data['lines']], total_cents=data['total_cents'])
+
+
+class CartStore:
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def add(self, user_id, product_id, quantity):
+        """Add to a line. Returns False if the product does not exist."""
+        raise NotImplementedError
+
+    def remove(self, user_id, product_id):
+        """Drop a line. Returns False if it was not in the cart."""
+        raise NotImplementedError
+
+    def clear(self, user_id):
+        """Empty the cart after checkout; the cart_item delete joins the caller's transaction."""
+        raise NotImplementedError
+
+    def restore(self, user_id, quantities):
+        """Put lines back (e.g. after a failed payment) unless the product is already in the cart."""
+        raise NotImplementedError
+
+    def flush(self):
+        return 0
+
+
+class SqlCartStore(CartStore):
+    name = 'sql'
+
+    def get(self, user_id):
+        rows = [item for item in cart_items_with_products(user_id) if item.product]
+        cart = Cart([CartLine(item.product_id, item.product.name, item.product.price_cents, item.quantity) for item in rows])
+        cart.products = {item.product_id: item.product for item in rows}
+        return cart
+
+    def add(self, user_id, product_id, quantity):
+        if db.session.get(Product, product_id) is None:
+            return False
+        cart_item = CartItem.query.filter_by(user_id=user_id, product_id=product_id).first()
+        if cart_item:
+            cart_item.quantity += quantity
+        else:
+            db.session.add(CartItem(user_id=user_id, product_id=product_id, quantity=quantity))
+        db.session.commit()
+        return True
+
+    def remove(self, user_id, product_id):
+        cart_item = CartItem.query.filter_by(user_id=user_id, product_id=product_id).first()
+        if not cart_item:
+            return False
+        db.session.delete(cart_item)
+        db.session.commit()
+        return True
+
+    def clear(self, user_id):
+        CartItem.query.filter_by(user_id=user_id).delete()
+
+    def restore(self, user_id, quantities):
+        in_cart = {pid for (pid,) in db.session.query(CartItem.product_id).filter_by(user_id=user_id)}
+        rows = [{'user_id': user_id, 'product_id': pid, 'quantity': qty}
+                for pid, qty in quantities.items() if pid not in in_cart]
+        if rows:
+            db.session.execute(insert(CartItem), rows)
+
+
+class LocalKV:
+    """The subset of the Redis client API that KVCartStore and the rate limiter use, kept in process memory."""
+
+    def __init__(self):
+        self._values = {}
+        self._sets = {}
+        self._hashes = {}
+        # Reentrant: transaction() holds it while the callable makes its own calls.
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._values.pop(key, None) is not None for key in keys)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value, expires = self._values.get(key, (0, None))
+            if expires is not None and expires < time.time():
+                value, expires = 0, None
+            value = int(value) + amount
+            self._values[key] = (value, expires)
+            return value
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if key not in self._values:
+                return False
+            self._values[key] = (self._values[key][0], time.time() + seconds)
+            return True
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._sets.setdefault(key, set()).update(str(m) for m in members)
+
+    def srem(self, key, *members):
+        with self._lock:
+            self._sets.get(key, set()).difference_update(str(m) for m in members)
+
+    def spop(self, key, count=None):
+        with self._lock:
+            members = self._sets.get(key, set())
+            return [members.pop() for _ in range(min(count or 1, len(members)))]
+
+    def scard(self, key):
+        with self._lock:
+            return len(self._sets.get(key, ()))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            fields = self._hashes.setdefault(key, {})
+            if field is not None:
+                fields[str(field)] = value
+            fields.update((str(f), v) for f, v in (mapping or {}).items())
+
+    def hmget(self, key, fields):
+        with self._lock:
+            values = self._hashes.get(key, {})
+            return [values.get(str(f)) for f in fields]
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        """Redis.transaction(): here the whole callable runs under the lock, so it never has to retry."""
+        with self._lock:
+            value = func(_LocalPipeline(self))
+        return value if value_from_callable else []
+
+
+class _LocalPipeline:
+    """What Redis.transaction() hands its callable: the client's commands plus multi()."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def multi(self):
+        pass
+
+
+class KVCartStore(CartStore):
+    name = 'kv'
+    DIRTY = 'cart:dirty'
+    PRICES = 'cart:prices'
+
+    def __init__(self, client, ttl=30 * 24 * 3600, flush_batch=500):
+        self.client = client
+        self.ttl = ttl
+        self.flush_batch = flush_batch
+
+    def _key(self, user_id):
+        return f'cart:{user_id}'
+
+    def _cleared_key(self, user_id):
+        return f'cart:{user_id}:cleared'
+
+    def products_changed(self, sender, product_ids=(), **kwargs):
+        # In the store, not in this process: every worker has to reprice, not just the one that saw the change.
+        now = time.time()
+        self.client.hset(self.PRICES, mapping={pid: now for pid in product_ids})
+
+    def _load(self, user_id, client=None):
+        """The stored cart and True, or the cart read through from cart_item and False."""
+        raw = (client or self.client).get(self._key(user_id))
+        if raw is not None:
+            return Cart.from_json(raw), True
+        # Not in the store (first visit, evicted or restarted): read through to cart_item.
+        now = time.time()
+        return Cart([CartLine(item.product_id, item.product.name, item.product.price_cents, item.quantity, now)
+                     for item in cart_items_with_products(user_id) if item.product]), False
+
+    def _update(self, user_id, change, dirty=True):
+        """Apply change(cart) atomically, storing the cart if it returns True. Returns (that result, cart)."""
+        key = self._key(user_id)
+
+        def apply(pipe):
+            # The cart is WATCHed: if another request writes it before EXEC, redis-py runs this again.
+            cart, stored = self._load(user_id, pipe)
+            changed = change(cart)
+            if changed or not stored:
+                pipe.multi()
+                pipe.set(key, cart.to_json(), ex=self.ttl)
+                if changed and dirty:
+                    pipe.sadd(self.DIRTY, user_id)
+            return changed, cart
+
+        return self.client.transaction(apply, key, value_from_callable=True)
+
+    def _stale(self, cart):
+        """Products whose lines were priced before the product last changed."""
+        if not cart:
+            return []
+        lines = list(cart)
+        changed = self.client.hmget(self.PRICES, [line.product_id for line in lines])
+        # Lines from before prices were cents have priced_at=0 and are always stale.
+        return [line.product_id for line, at in zip(lines, changed) if float(at or 0) >= line.priced_at]
+
+    def _refresh_prices(self, cart):
+        stale = self._stale(cart)
+        if not stale:
+            return False
+        now = time.time()
+        found = {pid: (name, price) for pid, name, price in
+                 db.session.query(Product.id, Product.name, Product.price_cents).filter(Product.id.in_(stale))}
+        for pid in stale:
+            if pid in found:
+                cart.reprice(pid, *found[pid], now)
+            else:
+                cart.remove(pid)
+        return True
+
+    def get(self, user_id):
+        cart, stored = self._load(user_id)
+        if stored and not self._stale(cart):
+            return cart
+        return self._update(user_id, self._refresh_prices, dirty=False)[1]
+
+    def add(self, user_id, product_id, quantity):
+        def add(cart):
+            if product_id in cart.lines:
+                cart.add(product_id, quantity)
+                return True
+            row = db.session.query(Product.name, Product.price_cents).filter_by(id=product_id).first()
+            if row is None:
+                return False
+            cart.add(product_id, quantity, row.name, row.price_cents, time.time())
+            return True
+
+        return self._update(user_id, add)[0]
+
+    def remove(self, user_id, product_id):
+        return self._update(user_id, lambda cart: cart.remove(product_id) is not None)[0]
+
+    def clear(self, user_id):
+        # Bumped before cart_item is touched, so a flush already holding this cart sees it.
+        self.client.incr(self._cleared_key(user_id))
+        self.client.expire(self._cleared_key(user_id), self.ttl)
+        CartItem.query.filter_by(user_id=user_id).delete()
+        self.client.delete(self._key(user_id))
+        self.client.srem(self.DIRTY, user_id)
+
+    def restore(self, user_id, quantities):
+        def restore(cart):
+            missing = [pid for pid in quantities if pid not in cart.lines]
+            if not missing:
+                return False
+            now = time.time()
+            for pid, name, price in db.session.query(Product.id, Product.name, Product.price_cents).filter(Product.id.in_(missing)):
+                cart.add(pid, quantities[pid], name, price, now)
+            return True
+
+        self._update(user_id, restore)
+
+    def flush(self):
+        """Write dirty carts back to cart_item. Returns the number of carts written."""
+        written = 0
+        while True:
+            user_ids = [int(u) for u in self.client.spop(self.DIRTY, self.flush_batch)]
+            if not user_ids:
+                return written
+            try:
+                cleared_keys = [self._cleared_key(user_id) for user_id in user_ids]
+                cleared = self.client.mget(cleared_keys)
+                carts = {user_id: Cart.from_json(raw)
+                         for user_id, raw in zip(user_ids, self.client.mget([self._key(u) for u in user_ids]))
+                         if raw is not None}
+                CartItem.query.filter(CartItem.user_id.in_(list(carts))).delete(synchronize_session=False)
+                rows = [{'user_id': user_id, 'product_id': line.product_id, 'quantity': line.quantity}
+                        for user_id, cart in carts.items() for line in cart]
+                if rows:
+                    db.session.execute(insert(CartItem), rows)
+                # Carts checked out since they were read: their snapshot must not outlive the checkout.
+                checked_out = [user_id for user_id, before, after in zip(user_ids, cleared, self.client.mget(cleared_keys))
+                               if before != after and user_id in carts]
+                if checked_out:
+                    CartItem.query.filter(CartItem.user_id.in_(checked_out)).delete(synchronize_session=False)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.client.sadd(self.DIRTY, *user_ids)
+                raise
+            written += len(carts) - len(checked_out)
+
+
+class CartFlusher:
+    """Background thread that flushes a KVCartStore every `interval` seconds."""
+
+    def __init__(self, app, store, interval):
+        self.app = app
+        self.store = store
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if not self.running:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='cart-flusher', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    written = self.store.flush()
+                if written:
+                    logging.info(f"Flushed {written} carts to the database.")
+            except Exception:
+                logging.exception("Cart flush failed.")
+
+
+def create_cart_store(config):
+    url = config['CART_STORE']
+    if url == 'sql':
+        return SqlCartStore()
+    if url == 'memory':
+        client = LocalKV()
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('CART_STORE is a Redis URL but the redis package is not installed.')
+        client = redis.Redis.from_url(url)
+    else:
+        raise ValueError(f'Unknown CART_STORE {url!r}.')
+    return KVCartStore(client, ttl=config['CART_TTL'])
+
+
+def get_cart_store(app=None):
+    return (app or current_app).extensions['cart_store']
+
+
+def init_cart_store(app):
+    store = create_cart_store(app.config)
+    app.extensions['cart_store'] = store
+
+    if isinstance(store, KVCartStore):
+        products_changed.connect(store.products_changed)
+        interval = app.config['CART_FLUSH_INTERVAL']
+        if interval > 0:
+            flusher = CartFlusher(app, store, interval)
+            app.extensions['cart_flusher'] = flusher
+
+            @app.before_request
+            def _start_cart_flusher():
+                if not flusher.running:
+                    flusher.start()
+
+    @app.cli.command('flush-carts')
+    def flush_carts():
+        """Write carts held in the cart store back to the database."""
+        click.echo(f"Flushed {store.flush()} carts.")
+
+    return store
@@ -0,0 +1,170 @@
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import tuple_
+
+from .models import Product
+from .signals import products_changed
+
+# Keyset ("seek") pagination over the catalog: a page is the next `limit`
+# products after the (sort value, id) pair of the previous page's last row,
+# so every page costs one index range scan no matter how deep it is. The id
+# tiebreaker keeps the order stable when prices or names repeat; the
+# ix_product_<sort>_id indexes on Product back each ordering.
+
+SORTS = {
+    'id': Product.id,
+    'price': Product.price_cents,
+    'name': Product.name,
+}
+
+# The Python type a cursor holds for each sort column's value
+CURSOR_TYPES = {
+    'id': int,
+    'price': int,
+    'name': str,
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_sort(value):
+    """Return (field, descending) for 'price', '-price', ... defaulting to id."""
+    value = (value or 'id').strip()
+    descending = value.startswith('-')
+    field = value.lstrip('-')
+    if field not in SORTS:
+        field, descending = 'id', False
+    return field, descending
+
+
+def encode_cursor(field, product):
+    key = [getattr(product, SORTS[field].key), product.id] if field != 'id' else [product.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, field):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(cursor) from e
+    if not isinstance(key, list) or len(key) != (1 if field == 'id' else 2):
+        raise InvalidCursor(cursor)
+    # A forged cursor must not reach the query with a value the column cannot compare against.
+    types = [CURSOR_TYPES[field], int] if field != 'id' else [int]
+    if any(isinstance(value, bool) or not isinstance(value, kind) for value, kind in zip(key, types)):
+        raise InvalidCursor(cursor)
+    return key
+
+
+def fetch_page(sort=None, after=None, limit=None):
+    """Return (products, next_cursor) for one catalog page."""
+    field, descending = parse_sort(sort)
+    config = current_app.config
+    limit = min(max(int(limit or config['CATALOG_PAGE_SIZE']), 1), config['CATALOG_MAX_PAGE_SIZE'])
+
+    column = SORTS[field]
+    keys = [Product.id] if field == 'id' else [column, Product.id]
+    query = Product.query
+    if after:
+        position = decode_cursor(after, field)
+        row = tuple_(*keys) if len(keys) > 1 else keys[0]
+        bound = tuple_(*position) if len(keys) > 1 else position[0]
+        query = query.filter(row < bound if descending else row > bound)
+    order = [k.desc() for k in keys] if descending else keys
+    # One extra row tells us whether there is a next page without a COUNT(*).
+    products = query.order_by(*order).limit(limit + 1).all()
+    next_cursor = encode_cursor(field, products[limit - 1]) if len(products) > limit else None
+    return products[:limit], next_cursor
+
+
+def serialize_product(product):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'description': product.description,
+        'price': product.price,
+        'price_cents': product.price_cents,
+        'stock': product.stock,
+        'in_stock': product.stock > 0,
+        'image_url': product.image_url,
+    }
+
+
+class CatalogCache:
+    """LRU cache of rendered catalog pages, emptied whenever a product changes.
+
+    `version` changes on every invalidation so callers can use it as a
+    validator. Entries also expire after `ttl` seconds, which bounds how long
+    other processes (whose caches this one cannot invalidate) may serve a
+    stale page. `changed_within()` tells callers that an invalidation is
+    recent enough for a read replica not to have the change yet.
+    """
+
+    def __init__(self, max_entries=256, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.version = self._new_version()
+        self._invalidated_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def _new_version(self):
+        self._generation += 1
+        return f'{id(self):x}-{time.time_ns():x}-{self._generation}'
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        with self._lock:
+            # Drop results computed before an invalidation that raced with them.
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._entries.clear()
+            self.version = self._new_version()
+            self._invalidated_at = time.monotonic()
+
+    def changed_within(self, seconds):
+        invalidated_at = self._invalidated_at
+        return invalidated_at is not None and time.monotonic() - invalidated_at < seconds
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_catalog_cache():
+    return current_app.extensions['catalog_cache']
+
+
+def init_catalog(app):
+    cache = CatalogCache(app.config['CATALOG_CACHE_SIZE'], app.config['CATALOG_CACHE_TTL'])
+    app.extensions['catalog_cache'] = cache
+    products_changed.connect(cache.invalidate)
+    return cache
@@ -0,0 +1,320 @@
+import json
+import logging
+import random
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import and_, or_, insert
+
+from .models import db, EmailOutbox, User
+from .queries import orders_with_items
+from .rendering import get_renderer
+from .email_utils import get_mail, build_order_confirmation, build_verification_email, verification_url
+
+# Outbound email is written to the email_outbox table in the same transaction
+# as the row that triggered it, and delivered later by an EmailWorkerPool.
+# EMAIL_DELIVERY selects who drains the table:
+#   background - worker threads started inside the web process
+#   external   - a separate `flask email-worker` process
+#   inline     - drained synchronously after the request commits (tests)
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+DEAD = 'dead'
+
+
+def enqueue(kind, recipient, **payload):
+    message = EmailOutbox(kind=kind, recipient=recipient, payload=json.dumps(payload),
+                          status=PENDING, next_attempt_at=datetime.utcnow())
+    db.session.add(message)
+    return message
+
+
+def enqueue_order_confirmation(user_email, order):
+    return enqueue('order_confirmation', user_email, order_id=order.id)
+
+
+def enqueue_order_confirmations(user_email, order_ids):
+    # One multi-row INSERT for bulk-created orders.
+    if not order_ids:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert(EmailOutbox), [
+        {'kind': 'order_confirmation', 'recipient': user_email, 'payload': json.dumps({'order_id': order_id}),
+         'status': PENDING, 'attempts': 0, 'next_attempt_at': now, 'created_at': now}
+        for order_id in order_ids
+    ])
+
+
+def enqueue_verification_email(user):
+    # The verify URL needs the request context, so it is built now rather than by the worker.
+    return enqueue('verify_email', user.email, user_id=user.id, verify_url=verification_url(user))
+
+
+def dispatch():
+    """Hand freshly committed messages to the configured delivery mode."""
+    pool = current_app.extensions.get('email_outbox')
+    if pool is None:
+        return
+    try:
+        pool.notify()
+    except Exception as e:
+        # The messages are committed; a worker will pick them up later.
+        logging.error(f"Email dispatch failed: {e}")
+
+
+def _render_verify_email(message, payload):
+    user = db.session.get(User, payload['user_id'])
+    if user is None:
+        raise LookupError(f"user {payload['user_id']} no longer exists")
+    return build_verification_email(user, payload['verify_url'])
+
+
+# Order confirmations are rendered by render_batch.
+RENDERERS = {
+    'verify_email': _render_verify_email,
+}
+
+
+def render_batch(batch):
+    """message id -> Message, or the exception its renderer raised.
+
+    The batch's order confirmations are loaded in one query and rendered
+    together, so repeats of an order share its rendered item list.
+    """
+    rendered, payloads = {}, {}
+    for message in batch:
+        try:
+            payloads[message.id] = json.loads(message.payload)
+        except ValueError as e:
+            rendered[message.id] = e
+    order_ids = {payloads[m.id].get('order_id') for m in batch
+                 if m.kind == 'order_confirmation' and m.id in payloads} - {None}
+    orders = {order.id: order for order in orders_with_items(sorted(order_ids))}
+    bodies = get_renderer().confirmations(orders.values())
+    for message in batch:
+        if message.id in rendered:
+            continue
+        payload = payloads[message.id]
+        try:
+            if message.kind == 'order_confirmation':
+                order = orders.get(payload['order_id'])
+                if order is None:
+                    raise LookupError(f"order {payload['order_id']} no longer exists")
+                rendered[message.id] = build_order_confirmation(message.recipient, order, bodies[order.id])
+            else:
+                rendered[message.id] = RENDERERS[message.kind](message, payload)
+        except Exception as e:
+            rendered[message.id] = e
+    return rendered
+
+
+def claim_batch(worker_id, batch_size, lease_seconds):
+    now = datetime.utcnow()
+    due = or_(
+        and_(EmailOutbox.status == PENDING, EmailOutbox.next_attempt_at <= now),
+        and_(EmailOutbox.status == SENDING, EmailOutbox.locked_until < now),
+    )
+    ids = [row[0] for row in db.session.query(EmailOutbox.id).filter(due)
+           .order_by(EmailOutbox.id).limit(batch_size).all()]
+    if not ids:
+        db.session.rollback()
+        return []
+    # The conditional update is the claim: a row another worker grabbed in the
+    # meantime no longer matches `due` and is skipped.
+    db.session.query(EmailOutbox).filter(EmailOutbox.id.in_(ids), due).update(
+        {'status': SENDING, 'claimed_by': worker_id,
+         'locked_until': now + timedelta(seconds=lease_seconds)},
+        synchronize_session=False)
+    db.session.commit()
+    return (EmailOutbox.query
+            .filter_by(claimed_by=worker_id, status=SENDING)
+            .order_by(EmailOutbox.id).all())
+
+
+def retry_delay(attempts, base, cap):
+    delay = min(cap, base * (2 ** max(attempts - 1, 0)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class EmailWorkerPool:
+    def __init__(self, app, workers=2, batch_size=20, poll_interval=2.0,
+                 max_attempts=5, backoff_base=30.0, backoff_cap=3600.0, lease_seconds=300):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.lease_seconds = lease_seconds
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app):
+        config = app.config
+        return cls(
+            app,
+            workers=config['EMAIL_WORKERS'],
+            batch_size=config['EMAIL_BATCH_SIZE'],
+            poll_interval=config['EMAIL_POLL_INTERVAL'],
+            max_attempts=config['EMAIL_MAX_ATTEMPTS'],
+            backoff_base=config['EMAIL_RETRY_BACKOFF'],
+            backoff_cap=config['EMAIL_RETRY_BACKOFF_MAX'],
+        )
+
+    @property
+    def running(self):
+        return any(t.is_alive() for t in self._threads)
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f'email-worker-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+        logging.info(f"Email worker pool started with {self.workers} workers.")
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        if self.app.config['EMAIL_DELIVERY'] == 'inline':
+            self.drain()
+        else:
+            self._wake.set()
+
+    def drain(self):
+        """Deliver everything currently due in the calling thread; returns the number sent."""
+        worker_id = uuid.uuid4().hex
+        sent = 0
+        with self.app.app_context():
+            mail = get_mail(self.app)
+            while True:
+                batch = claim_batch(worker_id, self.batch_size, self.lease_seconds)
+                if not batch:
+                    return sent
+                sent += self.deliver(mail, batch)
+
+    def _run(self):
+        worker_id = uuid.uuid4().hex
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    mail = get_mail(self.app)
+                    batch = claim_batch(worker_id, self.batch_size, self.lease_seconds)
+                    if batch:
+                        self.deliver(mail, batch)
+                        continue
+            except Exception:
+                logging.exception("Email worker loop failed.")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def deliver(self, mail, batch):
+        """Render and send a claimed batch over one SMTP connection, reconnecting after a failure."""
+        sent = 0
+        rendered = render_batch(batch)
+        pending = list(batch)
+        while pending:
+            try:
+                connection = mail.connect()
+                connection.__enter__()
+            except Exception as e:
+                for message in pending:
+                    self._failed(message, e)
+                db.session.commit()
+                return sent
+            try:
+                while pending:
+                    message = pending.pop(0)
+                    msg = rendered[message.id]
+                    if isinstance(msg, Exception):
+                        self._failed(message, msg)
+                        continue
+                    try:
+                        connection.send(msg)
+                    except Exception as e:
+                        # The SMTP session may be unusable now; reconnect for the rest.
+                        self._failed(message, e)
+                        break
+                    self._sent(message)
+                    sent += 1
+            finally:
+                try:
+                    connection.__exit__(None, None, None)
+                except Exception:
+                    pass
+                # One status write per batch; a crash before this re-delivers the
+                # batch once the claim lease expires (at-least-once delivery).
+                db.session.commit()
+        return sent
+
+    def _sent(self, message):
+        message.status = SENT
+        message.attempts += 1
+        message.sent_at = datetime.utcnow()
+        message.claimed_by = None
+        message.locked_until = None
+        message.last_error = None
+
+    def _failed(self, message, error):
+        message.attempts += 1
+        message.claimed_by = None
+        message.locked_until = None
+        message.last_error = str(error)[:1000]
+        if message.attempts >= self.max_attempts or isinstance(error, LookupError):
+            message.status = DEAD
+            logging.error(f"Email {message.id} ({message.kind}) to {message.recipient} moved to dead letter: {error}")
+        else:
+            message.status = PENDING
+            message.next_attempt_at = datetime.utcnow() + timedelta(
+                seconds=retry_delay(message.attempts, self.backoff_base, self.backoff_cap))
+            logging.warning(f"Email {message.id} ({message.kind}) attempt {message.attempts} failed: {error}")
+
+
+def init_email_outbox(app):
+    pool = EmailWorkerPool.from_config(app)
+    app.extensions['email_outbox'] = pool
+
+    if app.config['EMAIL_DELIVERY'] == 'background':
+        # Started lazily so forked gunicorn workers each get their own threads.
+        @app.before_request
+        def _start_email_workers():
+            if not pool.running:
+                pool.start()
+
+    @app.cli.command('email-worker')
+    @click.option('--workers', type=int, default=None, help='Number of worker threads.')
+    @click.option('--once', is_flag=True, help='Drain the outbox once and exit.')
+    def email_worker(workers, once):
+        """Deliver queued emails from the outbox."""
+        if once:
+            click.echo(f"Sent {pool.drain()} emails.")
+            return
+        if workers:
+            pool.workers = workers
+        pool.start()
+        try:
+            while pool.running:
+                pool._stop.wait(1)
+        except KeyboardInterrupt:
+            pool.stop()
+
+    return pool
@@ -1,29 +1,51 @@
 import logging
-from flask_mail import Message
+import threading
 from flask import render_template, current_app, url_for
+from .rendering import get_renderer
+
+_mail_lock = threading.Lock()
+
+def get_mail(app=None):
+    """Flask-Mail state for the app, set up the first time something sends email."""
+    app = app or current_app._get_current_object()
+    state = app.extensions.get('mail')
+    if state is None:
+        from flask_mail import Mail
+        with _mail_lock:
+            state = app.extensions.get('mail') or Mail().init_app(app)
+    return state
+
+def build_order_confirmation(user_email, order, rendered=None):
+    """`rendered` is the (text, html) pair when the bodies were rendered ahead, e.g. for a batch."""
+    from flask_mail import Message
+    msg = Message('Order Confirmation', recipients=[user_email])
+    msg.body, msg.html = rendered or get_renderer().confirmation(order)
+    return msg
+
+def build_verification_email(user, verify_url):
+    from flask_mail import Message
+    msg = Message('Verify Your Email', recipients=[user.email])
+    msg.body = render_template('verify_email.txt', user=user, verify_url=verify_url)
+    msg.html = render_template('verify_email.html', user=user, verify_url=verify_url)
+    return msg
+
+def verification_url(user):
+    token = user.get_verification_token()
+    return url_for('main.verify_email', token=token, _external=True)
 
 def send_order_confirmation(user_email, order):
-    from . import mail  # Import here to avoid circular import
     try:
-        msg = Message('Order Confirmation', recipients=[user_email])
-        msg.body = render_template('order_confirmation_email.txt', order=order)
-        msg.html = render_template('order_confirmation_email.html', order=order)
-        mail.send(msg)
+        get_mail().send(build_order_confirmation(user_email, order))
         return True
     except Exception as e:
         logging.error(f"Failed to send order confirmation email: {e}")
         return False
 
 def send_verification_email(user):
-    from . import mail
-    token = user.get_verification_token()
-    verify_url = url_for('main.verify_email', token=token, _external=True)
+    verify_url = verification_url(user)
     try:
-        msg = Message('Verify Your Email', recipients=[user.email])
-        msg.body = render_template('verify_email.txt', user=user, verify_url=verify_url)
-        msg.html = render_template('verify_email.html', user=user, verify_url=verify_url)
-        mail.send(msg)
+        get_mail().send(build_verification_email(user, verify_url))
         return True
     except Exception as e:
         logging.error(f"Failed to send verification email: {e}")
-        return False 
\ No newline at end of file
+        return False
@@ -0,0 +1,138 @@
+import hashlib
+import os
+from datetime import timezone
+
+from flask import current_app, make_response, request, session
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Response
+
+# HTTP validators for the catalog, cart and order pages. Each page builds its
+# ETag from the state it shows (the catalog fragment's content hash, the cart
+# lines and quote, the order's status and update stamp) plus a release stamp
+# of the templates, so a matching If-None-Match/If-Modified-Since gets a 304
+# before the page template is rendered. Anonymous catalog pages are marked
+# public with an s-maxage so a CDN can serve them; signed-in pages are private
+# and revalidated on every view. Pages carrying flashed messages are never
+# validated, since the message must be shown once.
+#
+# Static files are linked as /static/<file>?v=<content hash> and those URLs
+# are served with a year-long immutable Cache-Control; a changed file gets a
+# new URL.
+
+STATIC_VERSION_ARG = 'v'
+
+
+def _digest(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def content_etag(text):
+    """Hash of a rendered fragment, stored next to it so it is only computed once."""
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _tree_digest(*folders):
+    digest = hashlib.sha1()
+    for folder in folders:
+        for root, dirs, files in os.walk(folder or ''):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, folder).encode())
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def _http_date(value):
+    # Naive datetimes in this app are UTC; HTTP dates have whole seconds.
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.replace(microsecond=0)
+
+
+class HttpCache:
+    def __init__(self, release, shared_max_age=60, browser_max_age=0, static_max_age=365 * 24 * 3600, static_folder=None):
+        self.release = release
+        self.shared_max_age = shared_max_age
+        self.browser_max_age = browser_max_age
+        self.static_max_age = static_max_age
+        self.static_folder = static_folder
+        self._fingerprints = {}
+
+    def respond(self, render, *state, last_modified=None, shared=False):
+        """Return a 304 if the client already has this version of the page, else render it.
+
+        `state` is everything the page shows; `shared` marks pages that are the
+        same for every anonymous visitor and may be stored by a CDN.
+        """
+        if '_flashes' in session:
+            response = make_response(render())
+            response.cache_control.no_store = True
+            return response
+        etag = _digest(self.release, *state)
+        last_modified = _http_date(last_modified)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            response = make_response(render())
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        if shared:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.browser_max_age
+            response.cache_control.s_maxage = self.shared_max_age
+        else:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
+
+    def fingerprint(self, filename):
+        """Short content hash of a static file, or None if it does not exist."""
+        path = safe_join(self.static_folder, filename)
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError, ValueError):
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._fingerprints.get(filename)
+        if cached is None or cached[0] != key:
+            with open(path, 'rb') as f:
+                cached = (key, hashlib.sha1(f.read()).hexdigest()[:12])
+            self._fingerprints[filename] = cached
+        return cached[1]
+
+    def add_static_version(self, endpoint, values):
+        if endpoint == 'static' and STATIC_VERSION_ARG not in values and 'filename' in values:
+            version = self.fingerprint(values['filename'])
+            if version:
+                values[STATIC_VERSION_ARG] = version
+
+    def cache_static(self, response):
+        if request.endpoint != 'static' or response.status_code not in (200, 304):
+            return response
+        version = request.args.get(STATIC_VERSION_ARG)
+        if version and version == self.fingerprint(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = self.static_max_age
+            response.cache_control.immutable = True
+        return response
+
+
+def get_http_cache():
+    return current_app.extensions['http_cache']
+
+
+def init_http_cache(app):
+    release = app.config['HTTP_CACHE_RELEASE'] or _tree_digest(os.path.join(app.root_path, app.template_folder),
+                                                               app.static_folder)
+    cache = HttpCache(release, app.config['HTTP_SHARED_MAX_AGE'], app.config['HTTP_BROWSER_MAX_AGE'],
+                      app.config['STATIC_MAX_AGE'], app.static_folder)
+    app.extensions['http_cache'] = cache
+    app.url_defaults(cache.add_static_version)
+    app.after_request(cache.cache_static)
+    return cache
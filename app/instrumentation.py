@@ -0,0 +1,231 @@
+import ipaddress
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from flask import g, has_request_context, request, jsonify, abort, Response
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from .models import db
+
+# Per-request database instrumentation. Engine events time every statement,
+# TimedQueuePool times how long a request waited for a pooled connection, and
+# after each request the totals are folded into per-endpoint counters that
+# /metrics exposes in Prometheus text format. Every request is also logged as
+# one JSON line on the "app.requests" logger.
+
+logger = logging.getLogger('app')
+request_logger = logging.getLogger('app.requests')
+
+
+def log_event(event_name, level=logging.INFO, log=logger, **fields):
+    log.log(level, json.dumps({'event': event_name, **fields}, default=str))
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds', 'pool_wait_seconds', 'slow_queries')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.slow_queries = 0
+
+
+def current_stats():
+    if has_request_context():
+        return g.get('_db_stats')
+    return None
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that charges the time spent waiting for a connection to the current request."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.pool_wait_seconds += time.perf_counter() - start
+
+
+class Metrics:
+    def __init__(self, slow_query_samples=20):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)           # (endpoint, method, status) -> count
+        self.request_seconds = defaultdict(float)  # endpoint -> total seconds
+        self.request_count = defaultdict(int)      # endpoint -> count
+        self.queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.pool_wait_seconds = defaultdict(float)
+        self.slow_queries = defaultdict(int)
+        self.slow_samples = defaultdict(lambda: deque(maxlen=slow_query_samples))
+        self.counters = defaultdict(int)           # (name, labels) -> count, for other subsystems
+        self.gauges = {}                           # name -> callable returning a number
+
+    def observe(self, endpoint, method, status, seconds, stats):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.request_seconds[endpoint] += seconds
+            self.request_count[endpoint] += 1
+            self.queries[endpoint] += stats.queries
+            self.db_seconds[endpoint] += stats.db_seconds
+            self.pool_wait_seconds[endpoint] += stats.pool_wait_seconds
+            self.slow_queries[endpoint] += stats.slow_queries
+
+    def slow_query(self, endpoint, statement, seconds):
+        with self._lock:
+            self.slow_samples[endpoint].append({
+                'statement': statement[:500],
+                'duration_ms': round(seconds * 1000, 2),
+                'at': time.time(),
+            })
+
+    def increment(self, name, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += 1
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        with self._lock:
+            family('app_http_requests_total', 'counter', 'HTTP requests by endpoint, method and status.',
+                   [((('endpoint', e), ('method', m), ('status', s)), n)
+                    for (e, m, s), n in sorted(self.requests.items())])
+            family('app_http_request_duration_seconds_sum', 'counter', 'Total time spent serving requests.',
+                   [((('endpoint', e),), round(v, 6)) for e, v in sorted(self.request_seconds.items())])
+            family('app_http_request_duration_seconds_count', 'counter', 'Requests timed.',
+                   [((('endpoint', e),), v) for e, v in sorted(self.request_count.items())])
+            family('app_db_queries_total', 'counter', 'SQL statements executed.',
+                   [((('endpoint', e),), v) for e, v in sorted(self.queries.items())])
+            family('app_db_query_seconds_total', 'counter', 'Time spent executing SQL statements.',
+                   [((('endpoint', e),), round(v, 6)) for e, v in sorted(self.db_seconds.items())])
+            family('app_db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a pooled connection.',
+                   [((('endpoint', e),), round(v, 6)) for e, v in sorted(self.pool_wait_seconds.items())])
+            family('app_db_slow_queries_total', 'counter', 'Statements slower than DB_SLOW_QUERY_MS.',
+                   [((('endpoint', e),), v) for e, v in sorted(self.slow_queries.items())])
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                family(name, 'counter', name.replace('_', ' ') + '.',
+                       [(labels, v) for (n, labels), v in sorted(self.counters.items()) if n == name])
+            gauges = list(self.gauges.items())
+        for name, read in sorted(gauges):
+            try:
+                value = read()
+            except Exception:
+                continue
+            family(name, 'gauge', name.replace('_', ' ') + '.', [((), value)])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _is_local(address):
+    try:
+        return ipaddress.ip_address(address or '').is_loopback
+    except ValueError:
+        return False
+
+
+def get_metrics(app):
+    return app.extensions['metrics']
+
+
+def instrument_engine(app, engine, bind='primary'):
+    metrics = get_metrics(app)
+    slow_seconds = app.config['DB_SLOW_QUERY_MS'] / 1000
+    # With read replicas, count statements per bind to show how reads are split.
+    replicated = bool(app.config.get('DATABASE_REPLICA_URLS'))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        stats = current_stats()
+        if stats is None:
+            return
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        if replicated:
+            metrics.increment('app_db_bind_queries_total', bind=bind)
+        if slow_seconds and elapsed >= slow_seconds:
+            stats.slow_queries += 1
+            endpoint = request.endpoint or 'unknown'
+            metrics.slow_query(endpoint, statement, elapsed)
+            log_event('slow_query', logging.WARNING, endpoint=endpoint,
+                      duration_ms=round(elapsed * 1000, 2), statement=statement[:500])
+
+    pool = engine.pool
+    if isinstance(pool, QueuePool) and bind == 'primary':
+        metrics.gauges['app_db_pool_size'] = pool.size
+        metrics.gauges['app_db_pool_checked_out'] = pool.checkedout
+        metrics.gauges['app_db_pool_overflow'] = pool.overflow
+
+
+def init_instrumentation(app):
+    metrics = Metrics(app.config['DB_SLOW_QUERY_SAMPLES'])
+    app.extensions['metrics'] = metrics
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument_engine(app, engine)
+
+    @app.before_request
+    def _start_request_stats():
+        g._request_start = time.perf_counter()
+        g._db_stats = RequestStats()
+
+    @app.after_request
+    def _record_request_stats(response):
+        stats = g.pop('_db_stats', None)
+        start = g.pop('_request_start', None)
+        if stats is None or start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'unknown'
+        metrics.observe(endpoint, request.method, response.status_code, elapsed, stats)
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries", '
+            f'total;dur={elapsed * 1000:.1f}')
+        log_event('request', log=request_logger, endpoint=endpoint, method=request.method,
+                  path=request.path, status=response.status_code, duration_ms=round(elapsed * 1000, 2),
+                  db_queries=stats.queries, db_ms=round(stats.db_seconds * 1000, 2),
+                  pool_wait_ms=round(stats.pool_wait_seconds * 1000, 2))
+        return response
+
+    def _local_only():
+        if not app.config['METRICS_ALLOW_REMOTE'] and not _is_local(request.remote_addr):
+            abort(404)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        _local_only()
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/metrics/slow_queries')
+    def slow_queries_endpoint():
+        _local_only()
+        with metrics._lock:
+            samples = {endpoint: list(queue) for endpoint, queue in metrics.slow_samples.items()}
+        return jsonify(samples)
+
+    return metrics
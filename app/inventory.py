@@ -0,0 +1,173 @@
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import case, insert
+
+from .models import db, Product, StockReservation
+from .signals import mark_products_changed
+
+# Stock is only ever changed with single conditional UPDATE statements, so two
+# checkouts racing for the last unit cannot both win and no table lock is
+# needed. A checkout first *reserves* its lines (stock is decremented and a
+# `held` StockReservation row records it), then runs the payment, then either
+# commits the reservation or releases it. Holds that outlive their TTL are
+# returned to stock by release_expired().
+
+HELD = 'held'
+COMMITTED = 'committed'
+RELEASED = 'released'
+
+product_table = Product.__table__
+reservation_table = StockReservation.__table__
+CHUNK_SIZE = 250
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = list(product_ids)
+        super().__init__(f"insufficient stock for products {self.product_ids}")
+
+
+def aggregate(lines):
+    """Collapse (product_id, quantity) pairs into {product_id: total_quantity}."""
+    quantities = defaultdict(int)
+    for product_id, quantity in lines:
+        if quantity <= 0:
+            raise ValueError(f"quantity must be positive, got {quantity} for product {product_id}")
+        quantities[product_id] += quantity
+    return dict(quantities)
+
+
+def _per_product(quantities):
+    return case(quantities, value=product_table.c.id)
+
+
+def _chunks(quantities):
+    # The CASE is scanned linearly for every updated row, so huge requests go
+    # out in equal-sized statements (which also reuse one compiled form).
+    items = list(quantities.items())
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield dict(items[start:start + CHUNK_SIZE])
+
+
+def decrement_stock(quantities):
+    """Take `quantities` out of stock in one statement, or not at all.
+
+    Every product row is updated only if it still has enough stock; if any
+    line falls short the rows that were decremented are put back and
+    OutOfStock is raised with the short product ids. Very large requests are
+    split into CHUNK_SIZE-product statements with the same all-or-nothing
+    outcome.
+    """
+    if not quantities:
+        return
+    mark_products_changed(db.session, quantities)
+    dialect = db.session.get_bind().dialect
+    if not dialect.update_returning:
+        savepoint = db.session.begin_nested()
+    updated = set()
+    for chunk in _chunks(quantities):
+        qty = _per_product(chunk)
+        stmt = (product_table.update()
+                .where(product_table.c.id.in_(list(chunk)), product_table.c.stock >= qty)
+                .values(stock=product_table.c.stock - qty))
+        if dialect.update_returning:
+            done = {row[0] for row in db.session.execute(stmt.returning(product_table.c.id))}
+            updated |= done
+            if len(done) < len(chunk):
+                increment_stock({pid: quantities[pid] for pid in updated})
+                raise OutOfStock(sorted(set(chunk) - done))
+        elif db.session.execute(stmt).rowcount < len(chunk):
+            savepoint.rollback()
+            raise OutOfStock(shortfall(chunk))
+    if not dialect.update_returning:
+        savepoint.commit()
+
+
+def increment_stock(quantities):
+    if not quantities:
+        return
+    mark_products_changed(db.session, quantities)
+    for chunk in _chunks(quantities):
+        qty = _per_product(chunk)
+        db.session.execute(product_table.update()
+                           .where(product_table.c.id.in_(list(chunk)))
+                           .values(stock=product_table.c.stock + qty))
+
+
+def shortfall(quantities):
+    rows = db.session.query(Product.id, Product.stock).filter(Product.id.in_(list(quantities))).all()
+    stock = dict(rows)
+    return sorted(pid for pid, qty in quantities.items() if stock.get(pid, 0) < qty)
+
+
+def reserve(lines, user_id=None, ttl=None):
+    """Hold stock for `lines` and return the reservation token. The caller commits."""
+    quantities = aggregate(lines)
+    if ttl is None:
+        ttl = current_app.config['STOCK_RESERVATION_TTL']
+    decrement_stock(quantities)
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    db.session.execute(insert(reservation_table), [
+        {'token': token, 'user_id': user_id, 'product_id': pid, 'quantity': qty,
+         'status': HELD, 'created_at': now, 'expires_at': expires_at}
+        for pid, qty in quantities.items()
+    ])
+    return token
+
+
+def commit_reservation(token):
+    """Turn a hold into a sale. Returns False if the hold already expired or was released."""
+    result = db.session.execute(reservation_table.update()
+                                .where(reservation_table.c.token == token,
+                                       reservation_table.c.status == HELD)
+                                .values(status=COMMITTED))
+    return result.rowcount > 0
+
+
+def _release_where(*criteria):
+    # Flipping the status and returning the rows in one statement means only
+    # one caller can ever restore a given hold.
+    stmt = (reservation_table.update()
+            .where(reservation_table.c.status == HELD, *criteria)
+            .values(status=RELEASED))
+    dialect = db.session.get_bind().dialect
+    if dialect.update_returning:
+        rows = db.session.execute(stmt.returning(reservation_table.c.product_id,
+                                                 reservation_table.c.quantity)).all()
+    else:
+        rows = db.session.query(StockReservation.product_id, StockReservation.quantity).filter(
+            StockReservation.status == HELD, *criteria).with_for_update().all()
+        db.session.execute(stmt)
+    quantities = defaultdict(int)
+    for product_id, quantity in rows:
+        quantities[product_id] += quantity
+    increment_stock(dict(quantities))
+    return dict(quantities)
+
+
+def release_reservation(token):
+    """Give a hold back to stock. Safe to call more than once."""
+    return _release_where(reservation_table.c.token == token)
+
+
+def release_expired(now=None):
+    released = _release_where(reservation_table.c.expires_at < (now or datetime.utcnow()))
+    if released:
+        logging.info(f"Released expired stock reservations: {released}")
+    return released
+
+
+def init_inventory(app):
+    @app.cli.command('release-expired-reservations')
+    def release_expired_command():
+        """Return expired stock holds to inventory."""
+        released = release_expired()
+        db.session.commit()
+        click.echo(f"Released {sum(released.values())} units across {len(released)} products.")
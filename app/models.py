@@ -3,8 +3,23 @@ from flask_login import UserMixin
 from datetime import datetime
 from itsdangerous import URLSafeTimedSerializer as Serializer
 from flask import current_app
+from sqlalchemy.ext.hybrid import hybrid_property
 
-db = SQLAlchemy()
+from .pricing import to_cents
+from .replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def major_units(cents_column):
+    """The money stored in integer `cents_column`, in major units, for display and float-passing callers."""
+    def fget(self):
+        cents = getattr(self, cents_column)
+        return None if cents is None else cents / 100
+
+    def fset(self, value):
+        setattr(self, cents_column, to_cents(value))
+
+    return hybrid_property(fget, fset, expr=lambda cls: getattr(cls, cents_column) / 100.0)
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -13,6 +28,8 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(200), nullable=False)
     is_verified = db.Column(db.Boolean, default=False)
     is_admin = db.Column(db.Boolean, default=False)
+    # May place invoiced orders through /api/bulk_orders; set from the admin panel.
+    is_wholesale = db.Column(db.Boolean, default=False)
     orders = db.relationship('Order', backref='user', lazy=True)
     cart_items = db.relationship('CartItem', backref='user', lazy=True)
 
@@ -32,30 +49,114 @@ class User(UserMixin, db.Model):
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    price_cents = db.Column(db.Integer, nullable=False)
     stock = db.Column(db.Integer, nullable=False)
     description = db.Column(db.Text)
     image_url = db.Column(db.String(300))
+    price = major_units('price_cents')
+
+    # Back the keyset pagination orderings in app/catalog.py
+    __table_args__ = (
+        db.Index('ix_product_price_id', 'price_cents', 'id'),
+        db.Index('ix_product_name_id', 'name', 'id'),
+    )
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    total_amount = db.Column(db.Float, nullable=False)
+    total_cents = db.Column(db.Integer, nullable=False)
+    discount_cents = db.Column(db.Integer, default=0)
+    tax_cents = db.Column(db.Integer, default=0)
     paid = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), default='pending')  # pending -> paid / failed; bulk orders: invoiced
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    idempotency_key = db.Column(db.String(64))
     items = db.relationship('OrderItem', backref='order', lazy=True)
+    total_amount = major_units('total_cents')
+
+    # Order history pages (user, newest first) and date-range exports in app/order_history.py.
+    # The unique index backs duplicate-submit detection at checkout and bulk-order replays;
+    # as an index rather than a column constraint, init-db also adds it to upgraded tables.
+    __table_args__ = (
+        db.Index('ix_order_user_created_id', 'user_id', 'created_at', 'id'),
+        db.Index('ix_order_created_at', 'created_at'),
+        db.Index('ux_order_idempotency_key', 'idempotency_key', unique=True),
+    )
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    price_cents = db.Column(db.Integer, nullable=False)
     product = db.relationship('Product')
+    price = major_units('price_cents')
 
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False, default=1)
-    product = db.relationship('Product') 
\ No newline at end of file
+    product = db.relationship('Product') 
+class EmailOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    recipient = db.Column(db.String(120), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    claimed_by = db.Column(db.String(32), index=True)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+class StockReservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='held')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index('ix_stock_reservation_status_expires', 'status', 'expires_at'),)
+
+class PaymentAttempt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    amount_cents = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='processing')
+    provider_reference = db.Column(db.String(64))
+    error = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Reporting rollups kept up to date by app/analytics.py; the admin dashboard reads only these.
+class DailySales(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue_cents = db.Column(db.Integer, nullable=False, default=0)
+
+class ProductSales(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    name = db.Column(db.String(100))
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue_cents = db.Column(db.Integer, nullable=False, default=0)
+    last_sold_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_product_sales_units', 'units'),)
+
+class StockAlert(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    name = db.Column(db.String(100))
+    stock = db.Column(db.Integer, nullable=False)
+    since = db.Column(db.DateTime, default=datetime.utcnow)
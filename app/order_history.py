@@ -0,0 +1,121 @@
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import selectinload
+
+from .models import User, Product, Order, OrderItem
+
+# A user's order history is paged newest first with the same keyset cursors as
+# the catalog: each page continues after the (created_at, id) of the previous
+# page's last order, which ix_order_user_created_id serves as one range scan.
+#
+# The admin export streams every order line (Order x OrderItem x Product) as
+# CSV or NDJSON. Rows come off a server-side cursor (stream_results) in batches
+# of ORDER_EXPORT_BATCH and are written out as they arrive, so memory use does
+# not depend on how many orders are exported.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(order):
+    key = [order.created_at.isoformat(), order.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def fetch_orders(user_id, before=None, limit=None):
+    """Return (orders, next_cursor) for one page of a user's orders, newest first."""
+    config = current_app.config
+    limit = min(max(int(limit or config['ORDER_HISTORY_PAGE_SIZE']), 1), config['ORDER_HISTORY_MAX_PAGE_SIZE'])
+    query = (Order.query
+             .options(selectinload(Order.items).joinedload(OrderItem.product))
+             .filter(Order.user_id == user_id))
+    if before:
+        query = query.filter(tuple_(Order.created_at, Order.id) < decode_cursor(before))
+    orders = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(orders[limit - 1]) if len(orders) > limit else None
+    return orders[:limit], next_cursor
+
+
+def serialize_order(order):
+    return {
+        'id': order.id,
+        'created_at': order.created_at.isoformat(),
+        'status': order.status,
+        'paid': order.paid,
+        'total_amount': order.total_amount,
+        'total_cents': order.total_cents,
+        'items': [{'product_id': item.product_id, 'name': item.product.name if item.product else None,
+                   'quantity': item.quantity, 'price': item.price, 'price_cents': item.price_cents}
+                  for item in order.items],
+    }
+
+
+EXPORT_COLUMNS = ['order_id', 'user_id', 'email', 'created_at', 'status', 'paid', 'total_cents',
+                  'product_id', 'product_name', 'quantity', 'price_cents']
+
+
+def export_statement(start=None, end=None, user_id=None):
+    stmt = (select(Order.id, Order.user_id, User.email, Order.created_at, Order.status, Order.paid,
+                   Order.total_cents, OrderItem.product_id, Product.name, OrderItem.quantity, OrderItem.price_cents)
+            .join(User, User.id == Order.user_id)
+            .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+            .outerjoin(Product, Product.id == OrderItem.product_id)
+            .order_by(Order.id, OrderItem.id))
+    if start:
+        stmt = stmt.where(Order.created_at >= start)
+    if end:
+        stmt = stmt.where(Order.created_at < end)
+    if user_id:
+        stmt = stmt.where(Order.user_id == user_id)
+    return stmt
+
+
+def export_rows(engine, stmt, batch_size=1000):
+    """Yield batches of result rows from a server-side cursor on a connection of its own."""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+        for batch in result.partitions():
+            yield batch
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def stream_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        writer.writerows([_value(v) for v in row] for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, map(_value, row)))) + '\n' for row in batch)
+
+
+FORMATS = {
+    'csv': ('text/csv', stream_csv),
+    'ndjson': ('application/x-ndjson', stream_ndjson),
+}
@@ -1,7 +1,165 @@
+import hashlib
 import random
+import threading
+import time
+import uuid
+from collections import namedtuple
 
-def process_payment(amount, user, wallet_number, payment_details):
-    # Simulate payment processing: succeed if wallet_number is 10 digits and payment_details is not empty
-    if len(wallet_number) == 10 and wallet_number.isdigit() and payment_details:
-        return random.choice([True, True, True, False])  # 75% chance of success
-    return False 
\ No newline at end of file
+# Payment providers sit behind PaymentGateway. A gateway authorizes one charge
+# per idempotency key: calling it again with the same key must return the
+# original outcome instead of charging twice, and it must give up with
+# GatewayTimeout once `timeout` seconds have passed. Refunds follow the same
+# rules: one refund per key, however often it is requested. PAYMENT_GATEWAY
+# selects the implementation, either a name from GATEWAYS or a "module:Class"
+# import path.
+
+PaymentResult = namedtuple('PaymentResult', 'approved reference error replayed', defaults=(None, None, False))
+
+
+class PaymentError(Exception):
+    """The gateway could not give an answer; retrying with the same key is safe."""
+
+
+class GatewayTimeout(PaymentError):
+    pass
+
+
+class CircuitOpen(PaymentError):
+    pass
+
+
+class PaymentInProgress(PaymentError):
+    pass
+
+
+class PaymentGateway:
+    name = 'base'
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def authorize(self, amount, idempotency_key, wallet_number, payment_details, timeout):
+        """Authorize `amount`, in integer cents."""
+        raise NotImplementedError
+
+    def refund(self, amount, reference, idempotency_key, timeout):
+        """Give back `amount` cents of the charge the provider knows as `reference`."""
+        raise NotImplementedError
+
+
+def valid_wallet(wallet_number, payment_details):
+    return bool(wallet_number and len(wallet_number) == 10 and wallet_number.isdigit() and payment_details)
+
+
+class MockGateway(PaymentGateway):
+    """Local stand-in for a provider, with configurable latency and approval rate.
+
+    The outcome for a key is derived from the key itself, so retries get the
+    same answer, and each key is only counted as a charge once.
+    """
+    name = 'mock'
+
+    def __init__(self, latency=0.0, jitter=0.0, success_rate=0.75):
+        self.latency = latency
+        self.jitter = jitter
+        self.success_rate = success_rate
+        self.charges = {}
+        self.refunds = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(latency=config['MOCK_PAYMENT_LATENCY_MS'] / 1000, jitter=config['MOCK_PAYMENT_JITTER_MS'] / 1000,
+                   success_rate=config['MOCK_PAYMENT_SUCCESS_RATE'])
+
+    def authorize(self, amount, idempotency_key, wallet_number, payment_details, timeout):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > timeout:
+            time.sleep(timeout)
+            raise GatewayTimeout(f"mock gateway did not answer within {timeout}s")
+        time.sleep(delay)
+        with self._lock:
+            if idempotency_key in self.charges:
+                return self.charges[idempotency_key]._replace(replayed=True)
+            if not valid_wallet(wallet_number, payment_details):
+                result = PaymentResult(False, error='invalid_details')
+            elif self._roll(idempotency_key) < self.success_rate:
+                result = PaymentResult(True, reference=f'mock_{uuid.uuid4().hex[:16]}')
+            else:
+                result = PaymentResult(False, error='declined')
+            self.charges[idempotency_key] = result
+            return result
+
+    def refund(self, amount, reference, idempotency_key, timeout):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > timeout:
+            time.sleep(timeout)
+            raise GatewayTimeout(f"mock gateway did not answer within {timeout}s")
+        time.sleep(delay)
+        with self._lock:
+            if idempotency_key in self.refunds:
+                return self.refunds[idempotency_key]._replace(replayed=True)
+            charge = self.charges.get(idempotency_key)
+            if charge is None or not charge.approved or charge.reference != reference:
+                result = PaymentResult(False, error='unknown_charge')
+            else:
+                result = PaymentResult(True, reference=f'mock_refund_{uuid.uuid4().hex[:16]}')
+            self.refunds[idempotency_key] = result
+            return result
+
+    @staticmethod
+    def _roll(key):
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big') / 2 ** 64
+
+
+GATEWAYS = {'mock': MockGateway}
+
+
+class CircuitBreaker:
+    """Stops calling a failing gateway for `reset_timeout` seconds after `failure_threshold` errors in a row."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                # Let a single trial call through; its outcome closes or re-opens the circuit.
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self._probing = False
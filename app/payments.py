@@ -0,0 +1,299 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import import_string
+
+from .models import db, Order, PaymentAttempt
+from .payment_gateway import (GATEWAYS, CircuitBreaker, CircuitOpen, GatewayTimeout, PaymentError,
+                              PaymentInProgress, PaymentResult)
+from .inventory import OutOfStock, commit_reservation, release_reservation, decrement_stock, aggregate
+from .email_outbox import enqueue_order_confirmations, dispatch as dispatch_emails
+from .cart_store import get_cart_store
+from .analytics import record_orders
+from .pricing import format_cents
+
+# Every charge is recorded in payment_attempt under its idempotency key before
+# the gateway is called, so a retried or double-submitted checkout replays the
+# stored outcome instead of charging again. An attempt that errored (timeout,
+# open circuit) may be retried with the same key; the gateway deduplicates it.
+#
+# PAYMENT_MODE:
+#   sync  - checkout() waits for the gateway (bounded by PAYMENT_TIMEOUT)
+#   async - checkout() creates a pending order and returns at once; a worker
+#           pool charges it and moves the order to paid or failed
+#
+# A charge approved for an order that can no longer be filled (its stock hold
+# expired and the products sold out) is refunded. If the gateway cannot refund
+# it right away the attempt is left `refund_due`, and
+# `flask retry-refunds` tries again.
+
+PROCESSING, APPROVED, DECLINED, ERROR = 'processing', 'approved', 'declined', 'error'
+REFUNDED, REFUND_DUE = 'refunded', 'refund_due'
+PENDING, PAID, FAILED = 'pending', 'paid', 'failed'
+# Bulk orders are billed to the wholesale account: a sale from the start, never charged here.
+INVOICED = 'invoiced'
+
+
+def load_gateway(config):
+    name = config['PAYMENT_GATEWAY']
+    gateway_class = GATEWAYS[name] if name in GATEWAYS else import_string(name)
+    return gateway_class.from_config(config)
+
+
+class PaymentService:
+    def __init__(self, gateway, timeout=10.0, breaker=None, metrics=None):
+        self.gateway = gateway
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics
+
+    @classmethod
+    def from_config(cls, app):
+        config = app.config
+        breaker = CircuitBreaker(config['PAYMENT_CIRCUIT_FAILURES'], config['PAYMENT_CIRCUIT_RESET'])
+        return cls(load_gateway(config), config['PAYMENT_TIMEOUT'], breaker, app.extensions.get('metrics'))
+
+    def _count(self, outcome):
+        if self.metrics is not None:
+            self.metrics.increment('app_payment_attempts_total', gateway=self.gateway.name, outcome=outcome)
+
+    def _claim(self, key, amount_cents, user_id, order_id):
+        # Returns (status, attempt, owned). Only the owner of an attempt may call the gateway.
+        now = datetime.utcnow()
+        attempt = PaymentAttempt(idempotency_key=key, user_id=user_id, order_id=order_id, amount_cents=amount_cents,
+                                 status=PROCESSING, attempts=1, created_at=now, updated_at=now)
+        db.session.add(attempt)
+        try:
+            db.session.commit()
+            return PROCESSING, attempt, True
+        except IntegrityError:
+            db.session.rollback()
+        # A processing attempt older than this was abandoned by a crashed worker.
+        stale = now - timedelta(seconds=2 * self.timeout + 30)
+        claimed = PaymentAttempt.query.filter(
+            PaymentAttempt.idempotency_key == key,
+            or_(PaymentAttempt.status == ERROR,
+                and_(PaymentAttempt.status == PROCESSING, PaymentAttempt.updated_at < stale)),
+        ).update({'status': PROCESSING, 'updated_at': now, 'attempts': PaymentAttempt.attempts + 1},
+                 synchronize_session=False)
+        db.session.commit()
+        attempt = PaymentAttempt.query.filter_by(idempotency_key=key).one()
+        return attempt.status, attempt, claimed > 0
+
+    def _finish(self, key, status, reference=None, error=None):
+        PaymentAttempt.query.filter_by(idempotency_key=key).update(
+            {'status': status, 'provider_reference': reference, 'error': error[:255] if error else None,
+             'updated_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+    def charge(self, key, amount_cents, wallet_number, payment_details, user_id=None, order_id=None):
+        """Authorize `amount_cents` at most once per key.
+
+        Commits its own bookkeeping, so call it with no pending changes in the session.
+        Raises PaymentError when the gateway gave no answer.
+        """
+        status, attempt, owned = self._claim(key, amount_cents, user_id, order_id)
+        if status in (APPROVED, DECLINED, REFUNDED, REFUND_DUE):
+            self._count('replayed')
+            return PaymentResult(status == APPROVED, attempt.provider_reference, attempt.error, replayed=True)
+        if not owned:
+            raise PaymentInProgress(f"Payment {key} is already being processed.")
+        if not self.breaker.allow():
+            self._finish(key, ERROR, error='circuit_open')
+            self._count('circuit_open')
+            raise CircuitOpen(f"The {self.gateway.name} gateway is failing; not calling it for now.")
+        try:
+            result = self.gateway.authorize(amount_cents, key, wallet_number, payment_details, self.timeout)
+        except Exception as e:
+            self.breaker.record_failure()
+            self._finish(key, ERROR, error=str(e) or type(e).__name__)
+            self._count('timeout' if isinstance(e, GatewayTimeout) else 'error')
+            if isinstance(e, PaymentError):
+                raise
+            raise PaymentError(str(e)) from e
+        self.breaker.record_success()
+        self._finish(key, APPROVED if result.approved else DECLINED, result.reference, result.error)
+        self._count('approved' if result.approved else 'declined')
+        return result
+
+    def refund(self, key, reason):
+        """Refund the approved charge recorded under `key`. Returns whether the gateway refunded it.
+
+        Commits its own bookkeeping. Until the gateway confirms, the attempt stays `refund_due`,
+        so a charge that is owed back is on record even if this process dies.
+        """
+        attempt = PaymentAttempt.query.filter_by(idempotency_key=key).one()
+        if attempt.status == REFUNDED:
+            return True
+        self._finish(key, REFUND_DUE, attempt.provider_reference, reason)
+        try:
+            result = self.gateway.refund(attempt.amount_cents, attempt.provider_reference, key, self.timeout)
+        except Exception as e:
+            logging.error(f"Refund of payment {key} failed, it is still owed: {e}")
+            self._count('refund_error')
+            return False
+        if not result.approved:
+            logging.error(f"Gateway refused to refund payment {key}: {result.error}")
+            self._finish(key, REFUND_DUE, attempt.provider_reference, f'{reason}; refund refused: {result.error}')
+            self._count('refund_refused')
+            return False
+        self._finish(key, REFUNDED, attempt.provider_reference, reason)
+        self._count('refunded')
+        return True
+
+
+class PaymentWorkerPool:
+    """Bounded thread pool for asynchronous payment authorization."""
+
+    def __init__(self, app, workers=4, max_pending=100):
+        self.app = app
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app):
+        return cls(app, workers=app.config['PAYMENT_WORKERS'], max_pending=app.config['PAYMENT_MAX_PENDING'])
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) in an app context. Returns None instead of queueing when the pool is full."""
+        with self._lock:
+            if len(self._futures) >= self.max_pending:
+                return None
+            if self._executor is None:
+                # Created on first use so forked gunicorn workers each get their own threads.
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='payment-worker')
+            future = self._executor.submit(self._run, fn, args)
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    @property
+    def pending(self):
+        return len(self._futures)
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _run(self, fn, args):
+        with self.app.app_context():
+            try:
+                return fn(*args)
+            except Exception:
+                db.session.rollback()
+                logging.exception(f"Payment job {fn.__name__} failed.")
+                raise
+
+    def wait(self, timeout=None):
+        """Block until every queued job has finished."""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def get_payment_service(app=None):
+    return (app or current_app).extensions['payments']
+
+
+def get_payment_pool(app=None):
+    return (app or current_app).extensions['payment_pool']
+
+
+def _transition(order_id, status):
+    # Conditional so an order only ever leaves the pending state once.
+    return Order.query.filter_by(id=order_id, status=PENDING).update(
+        {'status': status, 'paid': status == PAID}, synchronize_session=False) > 0
+
+
+def refund_unfilled(key, amount_cents, user_id, product_ids):
+    """Refund a charge whose order could not be filled because `product_ids` sold out. The caller has rolled back."""
+    reason = f'sold out: {sorted(product_ids)}'
+    if get_payment_service().refund(key, reason):
+        logging.warning(f"Refunded ${format_cents(amount_cents)} to user {user_id}: products {sorted(product_ids)} sold out.")
+        return True
+    logging.error(f"User {user_id} was charged ${format_cents(amount_cents)} for products {sorted(product_ids)} "
+                  f"that sold out; payment {key} is marked refund_due.")
+    return False
+
+
+def retry_refunds():
+    """Try again to refund every charge left refund_due. Returns (refunded, still due)."""
+    service = get_payment_service()
+    keys = [key for (key,) in db.session.query(PaymentAttempt.idempotency_key).filter_by(status=REFUND_DUE)]
+    refunded = sum(service.refund(key, 'retried refund') for key in keys)
+    return refunded, len(keys) - refunded
+
+
+def settle_order(order_id, reservation, lines, key, amount_cents, user_id, user_email, wallet_number, payment_details):
+    """Charge a pending order and move it to paid or failed."""
+    try:
+        result = get_payment_service().charge(key, amount_cents, wallet_number, payment_details,
+                                              user_id=user_id, order_id=order_id)
+    except PaymentError as e:
+        logging.warning(f"Payment for order {order_id} got no answer: {e}")
+        result = PaymentResult(False, error=str(e))
+    quantities = aggregate(lines)
+    if result.approved:
+        taken = commit_reservation(reservation)
+        if not taken:
+            try:
+                decrement_stock(quantities)
+                taken = True
+            except OutOfStock as e:
+                db.session.rollback()
+                refund_unfilled(key, amount_cents, user_id, e.product_ids)
+        if taken:
+            if _transition(order_id, PAID):
+                record_orders([order_id])
+                enqueue_order_confirmations(user_email, [order_id])
+            db.session.commit()
+            logging.info(f"Order {order_id} paid by user {user_id} for ${format_cents(amount_cents)}.")
+            dispatch_emails()
+            return PAID
+    release_reservation(reservation)
+    if _transition(order_id, FAILED):
+        get_cart_store().restore(user_id, quantities)
+    db.session.commit()
+    logging.warning(f"Payment for order {order_id} failed: {result.error}")
+    return FAILED
+
+
+def expire_pending_orders(max_age, now=None):
+    """Fail orders whose payment never settled, e.g. because the worker process died."""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=max_age)
+    return Order.query.filter(Order.status == PENDING, Order.created_at < cutoff,
+                              Order.idempotency_key.like('checkout:%')).update(
+        {'status': FAILED, 'paid': False}, synchronize_session=False)
+
+
+def init_payments(app):
+    app.extensions['payments'] = PaymentService.from_config(app)
+    app.extensions['payment_pool'] = PaymentWorkerPool.from_config(app)
+
+    @app.cli.command('expire-pending-payments')
+    @click.option('--older-than', type=int, default=None, help='Age in seconds (default STOCK_RESERVATION_TTL).')
+    def expire_pending_payments(older_than):
+        """Mark checkout orders stuck in pending as failed."""
+        count = expire_pending_orders(older_than or app.config['STOCK_RESERVATION_TTL'])
+        db.session.commit()
+        click.echo(f"Marked {count} pending orders as failed.")
+
+    @app.cli.command('retry-refunds')
+    def retry_refunds_command():
+        """Refund charges still owed to customers whose orders could not be filled."""
+        refunded, due = retry_refunds()
+        click.echo(f"Refunded {refunded} payments; {due} still due.")
@@ -0,0 +1,76 @@
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from flask import current_app
+
+# Money is stored and added up as integer minor units (cents), so a total is
+# exact however many lines it has; floats only appear at the edges (the legacy
+# `price`/`total_amount` properties and JSON). PricingEngine is the one place
+# that turns cart or order lines into an order total: it sums the lines in a
+# single pass, then applies discount rules and tax, each rounded half up to
+# the cent. Checkout, the cart page and bulk orders all price through it.
+
+CENT = Decimal('0.01')
+
+Quote = namedtuple('Quote', 'subtotal discount tax total')
+
+
+def to_cents(amount):
+    """Convert a price in major units (float, str or Decimal) to integer cents."""
+    return int((Decimal(str(amount)).quantize(CENT, ROUND_HALF_UP) * 100).to_integral_value())
+
+
+def format_cents(cents):
+    """'1234' -> '12.34', exact for any integer."""
+    sign = '-' if cents < 0 else ''
+    return f'{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}'
+
+
+def _percent_of(cents, percent):
+    return int((Decimal(cents) * percent / 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+class PercentDiscount:
+    """Take `percent` off subtotals of at least `min_subtotal` cents."""
+
+    def __init__(self, percent, min_subtotal=0):
+        self.percent = Decimal(str(percent))
+        self.min_subtotal = min_subtotal
+
+    def __call__(self, subtotal):
+        return _percent_of(subtotal, self.percent) if subtotal >= self.min_subtotal else 0
+
+
+class PricingEngine:
+    def __init__(self, discounts=(), tax_rate=0):
+        # discounts: callables taking the subtotal in cents and returning the cents to take off.
+        self.discounts = list(discounts)
+        self.tax_rate = Decimal(str(tax_rate))
+
+    @classmethod
+    def from_config(cls, config):
+        discounts = []
+        if Decimal(str(config['DISCOUNT_PERCENT'])):
+            discounts.append(PercentDiscount(config['DISCOUNT_PERCENT'], config['DISCOUNT_MIN_SUBTOTAL_CENTS']))
+        return cls(discounts, config['TAX_RATE'])
+
+    def price(self, subtotal):
+        """Apply discounts and tax to a subtotal in cents."""
+        discount = min(sum(rule(subtotal) for rule in self.discounts), subtotal)
+        tax = _percent_of(subtotal - discount, self.tax_rate)
+        return Quote(subtotal, discount, tax, subtotal - discount + tax)
+
+    def quote(self, lines):
+        """Price (unit_cents, quantity) pairs."""
+        return self.price(sum(unit * quantity for unit, quantity in lines))
+
+
+def get_pricing(app=None):
+    return (app or current_app).extensions['pricing']
+
+
+def init_pricing(app):
+    engine = PricingEngine.from_config(app.config)
+    app.extensions['pricing'] = engine
+    app.add_template_filter(lambda cents: '$' + format_cents(cents or 0), 'money')
+    return engine
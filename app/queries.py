@@ -0,0 +1,32 @@
+from sqlalchemy.orm import joinedload, selectinload
+
+from .models import CartItem, Order, OrderItem
+
+# Loaders for pages that list cart or order lines together with their products.
+# Each one issues a fixed number of SELECTs however many lines there are,
+# instead of one lazy `item.product` load per line.
+
+
+def cart_items_with_products(user_id):
+    return (CartItem.query
+            .options(joinedload(CartItem.product))
+            .filter_by(user_id=user_id)
+            .order_by(CartItem.id)
+            .all())
+
+
+def order_with_items(order_id):
+    return (Order.query
+            .options(selectinload(Order.items).joinedload(OrderItem.product))
+            .filter_by(id=order_id)
+            .first())
+
+
+def orders_with_items(order_ids):
+    if not order_ids:
+        return []
+    return (Order.query
+            .options(selectinload(Order.items).joinedload(OrderItem.product))
+            .filter(Order.id.in_(order_ids))
+            .order_by(Order.id)
+            .all())
@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+# Order confirmations are shown on the order page and sent as a text and an
+# HTML email, and every one of them lists the same order lines. The lines are
+# rendered once per order by the _order_items partials and the result is kept
+# in a small LRU, keyed by order id, so the page and both email bodies reuse
+# it. Lines never change after checkout, and product names are read once when
+# an order is first rendered, so stock and catalog changes do not touch the
+# cache: an order keeps showing the names it was first shown with.
+#
+# Templates are compiled when the app is created (RENDER_PRECOMPILE) and the
+# compiled code is kept in a Jinja bytecode cache on disk
+# (RENDER_BYTECODE_CACHE), so new worker processes load it instead of parsing
+# the template sources again.
+
+ITEMS_HTML = '_order_items.html'
+ITEMS_TEXT = '_order_items.txt'
+CONFIRMATION_HTML = 'order_confirmation_email.html'
+CONFIRMATION_TEXT = 'order_confirmation_email.txt'
+
+
+class OrderRenderer:
+    def __init__(self, jinja_env, max_orders=1024):
+        self.jinja_env = jinja_env
+        self.max_orders = max_orders
+        self._orders = OrderedDict()
+        self._lock = threading.Lock()
+
+    def template(self, name):
+        # The environment keeps compiled templates, so this is a dict lookup after the first call.
+        return self.jinja_env.get_template(name)
+
+    def _entry(self, order):
+        with self._lock:
+            entry = self._orders.get(order.id)
+            if entry is not None:
+                self._orders.move_to_end(order.id)
+                return entry
+        # (name, quantity, line total in cents), read off the ORM objects once.
+        entry = {'lines': [(item.product.name, item.quantity, item.price_cents * item.quantity)
+                           for item in order.items]}
+        with self._lock:
+            entry = self._orders.setdefault(order.id, entry)
+            while len(self._orders) > self.max_orders:
+                self._orders.popitem(last=False)
+        return entry
+
+    def _block(self, order, name):
+        entry = self._entry(order)
+        block = entry.get(name)
+        if block is None:
+            block = entry[name] = self.template(name).render(lines=entry['lines'])
+        return block
+
+    def items_html(self, order):
+        return Markup(self._block(order, ITEMS_HTML))
+
+    def items_text(self, order):
+        return self._block(order, ITEMS_TEXT)
+
+    def confirmation(self, order):
+        """(text, html) email bodies for `order`."""
+        return (self.template(CONFIRMATION_TEXT).render(order=order, items_text=self.items_text(order)),
+                self.template(CONFIRMATION_HTML).render(order=order, items_html=self.items_html(order)))
+
+    def confirmations(self, orders):
+        """order id -> (text, html) for a batch of orders, each order's lines rendered once."""
+        return {order.id: self.confirmation(order) for order in orders}
+
+    def forget(self, sender=None, **kwargs):
+        with self._lock:
+            self._orders.clear()
+
+
+def precompile(jinja_env):
+    """Compile every app template (not the admin panel's) into the environment's cache."""
+    start = time.perf_counter()
+    names = jinja_env.list_templates(filter_func=lambda name: not name.startswith('admin/'))
+    for name in names:
+        try:
+            jinja_env.get_template(name)
+        except Exception as e:
+            logging.error(f"Failed to compile template {name}: {e}")
+    logging.info(f"Compiled {len(names)} templates in {(time.perf_counter() - start) * 1000:.0f} ms.")
+
+
+def get_renderer(app=None):
+    return (app or current_app).extensions['order_renderer']
+
+
+def init_rendering(app):
+    directory = app.config['RENDER_BYTECODE_CACHE']
+    if directory and directory != 'off':
+        # 'tmp' is Jinja's private per-user directory under the system temp dir.
+        if directory == 'tmp':
+            directory = None
+        else:
+            os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    renderer = OrderRenderer(app.jinja_env, app.config['RENDER_CACHE_SIZE'])
+    app.extensions['order_renderer'] = renderer
+    if app.config['RENDER_PRECOMPILE']:
+        precompile(app.jinja_env)
+    return renderer
@@ -0,0 +1,136 @@
+import random
+import time
+
+from flask import current_app, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+
+# Read/write splitting. Each URL in DATABASE_REPLICA_URLS is a read replica
+# of the primary database, with an engine of its own named replica<n> (not a
+# SQLALCHEMY_BINDS entry: no tables are bound to it and create_all leaves it
+# alone). A GET to one of the READ_ENDPOINTS picks a replica for the request
+# and RoutingSession sends its SELECTs there. Everything else goes to
+# the primary: other endpoints, DML, SELECT ... FOR UPDATE, and every
+# statement once the session has flushed, so a request reads its own writes.
+#
+# Replicas lag behind the primary, so a client whose request committed a
+# write is pinned to the primary for REPLICA_STICKY_SECONDS: the commit
+# stamps the Flask session cookie and reads from that client skip the
+# replicas until the stamp runs out. That keeps the order page right after
+# checkout and the cart right after adding to it. Without replicas none of
+# this is installed.
+
+REPLICA_KEY = 'replica'
+STICKY_KEY = '_primary_until'
+
+READ_ENDPOINTS = {
+    'main.index',
+    'main.api_products',
+    'main.cart',
+    'main.order_confirmation',
+    'main.order_history',
+    'main.api_orders',
+    # Admin panel (app/admin.py): model list views, the sales dashboard and the order export
+    'user.index_view',
+    'product.index_view',
+    'order.index_view',
+    'orderitem.index_view',
+    'cartitem.index_view',
+    'sales.index',
+    'order_export.export',
+}
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends reads to the replica engine in info['replica']."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get(REPLICA_KEY)
+        if replica is not None and bind is None and not self._flushing and not _writes(clause):
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _writes(clause):
+    if clause is None:
+        return False
+    return getattr(clause, 'is_dml', False) or getattr(clause, '_for_update_arg', None) is not None
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    # Later reads in this request must see what was just written.
+    session.info.pop(REPLICA_KEY, None)
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _on_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info.pop(REPLICA_KEY, None)
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('wrote', False):
+        session.info['committed_write'] = True
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('wrote', None)
+
+
+def get_replicas(app=None):
+    """name -> engine for the configured replicas; empty without any."""
+    return (app or current_app).extensions.get('replicas', {})
+
+
+def read_engine():
+    """The engine this request reads from: its replica, or the primary."""
+    db = current_app.extensions['sqlalchemy']
+    return db.session.info.get(REPLICA_KEY) or db.engine
+
+
+def use_primary():
+    """Send the rest of this request's queries to the primary, e.g. for a row the replica does not have yet.
+
+    Returns whether the request had been reading from a replica.
+    """
+    return current_app.extensions['sqlalchemy'].session.info.pop(REPLICA_KEY, None) is not None
+
+
+def route_reads(app, replicas):
+    """Send `app`'s read endpoints to `replicas`; also used for the admin panel's app."""
+    db = app.extensions['sqlalchemy']
+    engines = list(replicas.values())
+    sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+
+    @app.before_request
+    def _route_reads():
+        if request.method not in ('GET', 'HEAD') or request.endpoint not in READ_ENDPOINTS:
+            return
+        if session.get(STICKY_KEY, 0) > time.time():
+            return
+        db.session.info[REPLICA_KEY] = random.choice(engines)
+
+    @app.after_request
+    def _stick_after_write(response):
+        if db.session.registry.has() and db.session.info.pop('committed_write', False):
+            session[STICKY_KEY] = time.time() + sticky_seconds
+        return response
+
+
+def init_replicas(app):
+    # Imported here: app.models imports this module for RoutingSession.
+    from . import engine_options
+    from .instrumentation import instrument_engine
+    replicas = {f'{REPLICA_KEY}{n}': create_engine(url, **engine_options(url))
+                for n, url in enumerate(app.config['DATABASE_REPLICA_URLS'])}
+    app.extensions['replicas'] = replicas
+    if replicas:
+        for name, engine in replicas.items():
+            instrument_engine(app, engine, name)
+        route_reads(app, replicas)
+    return replicas
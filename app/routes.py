@@ -1,128 +1,355 @@
-from flask import Blueprint, render_template, redirect, url_for, request, session, flash, send_from_directory, current_app
+from flask import Blueprint, render_template, redirect, url_for, request, session, flash, current_app, jsonify, abort
 from flask_login import login_user, logout_user, login_required, current_user
-from .models import db, Product, User, Order, OrderItem, CartItem
-from werkzeug.security import generate_password_hash, check_password_hash
-from .payment_gateway import process_payment
-from .email_utils import send_order_confirmation, send_verification_email
+from .models import db, Product, User, Order, OrderItem
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from .payment_gateway import PaymentError, PaymentInProgress
+from .payments import PENDING, PAID, get_payment_service, get_payment_pool, refund_unfilled, settle_order
+from .inventory import OutOfStock, reserve, commit_reservation, release_reservation, release_expired, decrement_stock, aggregate
+from .analytics import record_orders
+from .bulk_orders import BulkOrderError, parse_bulk_request, place_bulk_orders
+from .queries import order_with_items
+from .cart_store import get_cart_store
+from .pricing import format_cents, get_pricing
+from .auth import HasherBusy, get_password_hasher
+from .order_history import InvalidCursor as HistoryCursor, fetch_orders, serialize_order
+from .throttling import rate_limit
+from .search import search_products
+from .http_cache import content_etag, get_http_cache
+from .rendering import get_renderer
+from .replicas import use_primary
+from .catalog import InvalidCursor, fetch_page, get_catalog_cache, parse_sort, serialize_product
+from .email_outbox import enqueue_order_confirmations, enqueue_verification_email, dispatch as dispatch_emails
+from datetime import datetime
 import logging
-import os
+import re
+import uuid
 
 main_bp = Blueprint('main', __name__)
 
+PAYMENT_KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def _catalog_args():
+    field, descending = parse_sort(request.args.get('sort'))
+    sort = ('-' if descending else '') + field
+    return sort, request.args.get('after') or None, request.args.get('limit', type=int)
+
+def _read_catalog_from_primary(cache):
+    # Replicas may lag a product change this process just made; a page read from one
+    # would be cached stale for CATALOG_CACHE_TTL.
+    if cache.changed_within(current_app.config['REPLICA_STICKY_SECONDS']):
+        use_primary()
+
 @main_bp.route('/')
 def index():
-    products = Product.query.all()
-    return render_template('index.html', products=products)
+    sort, after, limit = _catalog_args()
+    cache = get_catalog_cache()
+    key = ('html', sort, after, limit)
+    entry = cache.get(key)
+    if entry is None:
+        version = cache.version
+        _read_catalog_from_primary(cache)
+        try:
+            products, next_cursor = fetch_page(sort, after, limit)
+        except InvalidCursor:
+            return redirect(url_for('main.index', sort=sort))
+        catalog = render_template('_product_grid.html', products=products, next_cursor=next_cursor,
+                                  sort=sort, limit=limit, paged=bool(after))
+        entry = (catalog, content_etag(catalog), datetime.utcnow())
+        cache.put(key, entry, version)
+    catalog, catalog_etag, rendered_at = entry
+    signed_in = current_user.is_authenticated
+    return get_http_cache().respond(lambda: render_template('index.html', catalog=catalog, sort=sort),
+                                    'index', catalog_etag, sort, signed_in,
+                                    last_modified=rendered_at, shared=not signed_in)
+
+@main_bp.route('/api/products')
+def api_products():
+    sort, after, limit = _catalog_args()
+    cache = get_catalog_cache()
+    key = ('json', sort, after, limit)
+    payload = cache.get(key)
+    if payload is None:
+        version = cache.version
+        _read_catalog_from_primary(cache)
+        try:
+            products, next_cursor = fetch_page(sort, after, limit)
+        except InvalidCursor:
+            abort(400, description='Invalid cursor.')
+        payload = {'products': [serialize_product(p) for p in products], 'next': next_cursor, 'sort': sort}
+        cache.put(key, payload, version)
+    return jsonify(payload)
+
+def _search_args():
+    config = current_app.config
+    limit = request.args.get('limit', type=int) or config['CATALOG_PAGE_SIZE']
+    return request.args.get('q', '').strip(), min(max(limit, 1), config['CATALOG_MAX_PAGE_SIZE'])
+
+@main_bp.route('/search')
+def search():
+    query, limit = _search_args()
+    products = search_products(query, limit) if query else []
+    return render_template('search.html', query=query, products=products)
+
+@main_bp.route('/api/search')
+def api_search():
+    query, limit = _search_args()
+    products = search_products(query, limit) if query else []
+    return jsonify({'query': query, 'products': [serialize_product(p) for p in products]})
 
 @main_bp.route('/add_to_cart/<int:product_id>', methods=['POST'])
 @login_required
+@rate_limit('cart', per='user')
 def add_to_cart(product_id):
     quantity = int(request.form.get('quantity', 1))
-    cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    if cart_item:
-        cart_item.quantity += quantity
-    else:
-        cart_item = CartItem(user_id=current_user.id, product_id=product_id, quantity=quantity)
-        db.session.add(cart_item)
-    db.session.commit()
+    if not get_cart_store().add(current_user.id, product_id, quantity):
+        abort(404)
     flash('Product added to cart!')
     return redirect(url_for('main.index'))
 
 @main_bp.route('/cart')
 @login_required
 def cart():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-    items = []
-    total = 0
-    for item in cart_items:
-        if item.product:
-            items.append({'product': item.product, 'quantity': item.quantity, 'subtotal': item.product.price * item.quantity})
-            total += item.product.price * item.quantity
-    return render_template('cart.html', items=items, total=total)
+    cart = get_cart_store().get(current_user.id)
+    items = list(cart)
+    quote = get_pricing().price(cart.total_cents)
+    return get_http_cache().respond(lambda: render_template('cart.html', items=items, quote=quote),
+                                    'cart', current_user.id, quote,
+                                    [(i.product_id, i.name, i.quantity, i.price_cents) for i in items])
 
 @main_bp.route('/remove_from_cart/<int:product_id>', methods=['POST'])
 @login_required
 def remove_from_cart(product_id):
-    cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    if cart_item:
-        db.session.delete(cart_item)
-        db.session.commit()
+    if get_cart_store().remove(current_user.id, product_id):
         flash('Item removed from cart.')
     return redirect(url_for('main.cart'))
 
+def _checkout_items(user_id):
+    cart = get_cart_store().get(user_id)
+    products = cart.products
+    if products is None and cart:
+        products = {p.id: p for p in Product.query.filter(Product.id.in_(list(cart.lines)))}
+    items = []
+    subtotal = 0
+    for line in cart:
+        product = products.get(line.product_id)
+        if not product or product.stock < line.quantity:
+            return [], None, (line.product_id, product.name if product else line.product_id)
+        line_cents = product.price_cents * line.quantity
+        items.append({'product': product, 'product_id': product.id, 'quantity': line.quantity,
+                      'price_cents': product.price_cents, 'subtotal_cents': line_cents})
+        subtotal += line_cents
+    return items, get_pricing().price(subtotal), None
+
 @main_bp.route('/checkout', methods=['GET', 'POST'])
 @login_required
+@rate_limit('checkout', per='user')
 def checkout():
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
-    if not cart_items:
+    user_id, user_email = current_user.id, current_user.email
+    items, quote, unavailable = _checkout_items(user_id)
+    if not items and not unavailable:
         flash('Your cart is empty!')
         return redirect(url_for('main.index'))
-    items = []
-    total = 0
-    for item in cart_items:
-        product = item.product
-        if not product or product.stock < item.quantity:
-            logging.warning(f"User {current_user.id} attempted to order out-of-stock product {item.product_id}.")
-            flash(f'Product {product.name if product else item.product_id} is out of stock!')
-            return redirect(url_for('main.cart'))
-        items.append({'product': product, 'quantity': item.quantity, 'subtotal': product.price * item.quantity})
-        total += product.price * item.quantity
+    if unavailable:
+        logging.warning(f"User {user_id} attempted to order out-of-stock product {unavailable[0]}.")
+        flash(f'Product {unavailable[1]} is out of stock!')
+        return redirect(url_for('main.cart'))
     error = None
+    payment_key = request.form.get('payment_key', '')
+    if not PAYMENT_KEY_RE.match(payment_key):
+        payment_key = uuid.uuid4().hex
     if request.method == 'POST':
         wallet_number = request.form.get('wallet_number')
         payment_details = request.form.get('payment_details')
+        order_key = f'checkout:{user_id}:{payment_key}'
         if not wallet_number or not payment_details:
             error = 'Please enter all payment details.'
         elif len(wallet_number) != 10 or not wallet_number.isdigit():
             error = 'Wallet number must be 10 digits.'
+        elif (existing := db.session.query(Order.id).filter_by(idempotency_key=order_key).scalar()):
+            # The same checkout form was submitted again; don't charge or order twice.
+            return redirect(url_for('main.order_confirmation', order_id=existing))
         else:
-            payment_success = process_payment(total, current_user, wallet_number, payment_details)
-            if payment_success:
-                order = Order(user_id=current_user.id, total_amount=total, paid=True)
-                db.session.add(order)
-                db.session.flush()
-                for item in items:
-                    order_item = OrderItem(order_id=order.id, product_id=item['product'].id, quantity=item['quantity'], price=item['product'].price)
-                    db.session.add(order_item)
-                    item['product'].stock -= item['quantity']
-                # Clear cart
-                CartItem.query.filter_by(user_id=current_user.id).delete()
+            lines = [(item['product_id'], item['quantity']) for item in items]
+            release_expired()
+            try:
+                token = reserve(lines, user_id=user_id)
+            except OutOfStock as e:
+                db.session.rollback()
+                logging.warning(f"User {user_id} lost the race for products {e.product_ids} at checkout.")
+                flash('Some items in your cart just sold out. Please review your cart.')
+                return redirect(url_for('main.cart'))
+            charge_key = f'{user_id}:{payment_key}'
+            if current_app.config['PAYMENT_MODE'] == 'async':
+                order_id = _create_order(user_id, quote, items, PENDING, order_key)
+                get_cart_store().clear(user_id)
                 db.session.commit()
-                logging.info(f"Order {order.id} placed by user {current_user.id} for ${total}.")
-                email_sent = send_order_confirmation(current_user.email, order)
-                if not email_sent:
-                    logging.error(f"Order {order.id}: Failed to send confirmation email to {current_user.email}.")
-                    flash('Order placed, but failed to send confirmation email. Please contact support.', 'warning')
-                else:
-                    flash('Order placed successfully!')
-                return redirect(url_for('main.order_confirmation', order_id=order.id))
+                job = (order_id, token, lines, charge_key, quote.total, user_id, user_email, wallet_number, payment_details)
+                if get_payment_pool().submit(settle_order, *job) is None:
+                    # Pool is saturated: settle in this request rather than queue without bound.
+                    settle_order(*job)
+                flash('Order received! We are confirming your payment.')
+                return redirect(url_for('main.order_confirmation', order_id=order_id))
+            # Commit the hold so the stock stays reserved while the payment runs.
+            db.session.commit()
+            try:
+                result = get_payment_service().charge(charge_key, quote.total, wallet_number, payment_details, user_id=user_id)
+            except PaymentInProgress:
+                result = None
+                error = 'This payment is already being processed.'
+            except PaymentError as e:
+                # Keep the same payment key so a retry cannot charge twice.
+                result = None
+                logging.warning(f"Payment gateway unavailable for user {user_id}: {e}")
+                error = 'The payment provider is not responding. Please try again.'
+            if result is not None and result.approved:
+                if not commit_reservation(token):
+                    # The hold expired during payment; try to take the stock again.
+                    try:
+                        decrement_stock(aggregate(lines))
+                    except OutOfStock as e:
+                        db.session.rollback()
+                        if refund_unfilled(charge_key, quote.total, user_id, e.product_ids):
+                            flash('Your reservation expired and some items sold out. Your payment has been refunded.', 'danger')
+                        else:
+                            flash('Your reservation expired and some items sold out. Your payment will be refunded.', 'danger')
+                        return redirect(url_for('main.cart'))
+                order_id = _create_order(user_id, quote, items, PAID, order_key)
+                record_orders([order_id])
+                get_cart_store().clear(user_id)
+                enqueue_order_confirmations(user_email, [order_id])
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    # A concurrent submit of the same form created the order first.
+                    db.session.rollback()
+                    release_reservation(token)
+                    db.session.commit()
+                    order_id = db.session.query(Order.id).filter_by(idempotency_key=order_key).scalar()
+                    return redirect(url_for('main.order_confirmation', order_id=order_id))
+                logging.info(f"Order {order_id} placed by user {user_id} for ${format_cents(quote.total)}.")
+                dispatch_emails()
+                flash('Order placed successfully!')
+                return redirect(url_for('main.order_confirmation', order_id=order_id))
             else:
-                logging.warning(f"Payment failed for user {current_user.id} during checkout.")
-                error = 'Payment failed! Please check your details.'
-    return render_template('checkout.html', items=items, total=total, error=error)
+                release_reservation(token)
+                db.session.commit()
+                if result is not None:
+                    logging.warning(f"Payment failed for user {user_id} during checkout.")
+                    error = 'Payment failed! Please check your details.'
+                    payment_key = uuid.uuid4().hex
+                # The commit expired the loaded products; reload them in one query.
+                items, quote, _ = _checkout_items(user_id)
+    return render_template('checkout.html', items=items, quote=quote, error=error, payment_key=payment_key)
+
+def _create_order(user_id, quote, items, status, idempotency_key):
+    order = Order(user_id=user_id, total_cents=quote.total, discount_cents=quote.discount, tax_cents=quote.tax,
+                  status=status, paid=status == PAID, idempotency_key=idempotency_key)
+    db.session.add(order)
+    db.session.flush()
+    db.session.execute(insert(OrderItem), [
+        {'order_id': order.id, 'product_id': item['product_id'], 'quantity': item['quantity'], 'price_cents': item['price_cents']}
+        for item in items
+    ])
+    return order.id
+
+@main_bp.route('/api/bulk_orders', methods=['POST'])
+@login_required
+def bulk_orders():
+    # Bulk orders are invoiced, not charged, so only accounts billed that way may place them.
+    if not (current_user.is_wholesale or current_user.is_admin):
+        return jsonify({'error': 'Bulk orders are only available to wholesale accounts.'}), 403
+    config = current_app.config
+    try:
+        request_id, orders = parse_bulk_request(request.get_json(silent=True),
+                                                config['BULK_ORDER_MAX_ORDERS'], config['BULK_ORDER_MAX_LINES'])
+    except BulkOrderError as e:
+        return jsonify({'error': str(e)}), 400
+    user_id = current_user.id
+    results = place_bulk_orders(user_id, current_user.email, request_id, orders)
+    db.session.commit()
+    created = sum(1 for r in results if r['status'] == 'created')
+    logging.info(f"Bulk request from user {user_id}: {created}/{len(results)} orders created.")
+    dispatch_emails()
+    return jsonify({'created': created, 'rejected': len(results) - created, 'orders': results})
 
 @main_bp.route('/order_confirmation/<int:order_id>')
 @login_required
 def order_confirmation(order_id):
-    order = Order.query.get_or_404(order_id)
-    return render_template('order_confirmation.html', order=order)
+    # Items never change after checkout, so the order row alone says whether the page did.
+    stamp_query = db.session.query(Order.status, Order.paid, Order.created_at, Order.updated_at).filter_by(id=order_id)
+    stamp = stamp_query.first()
+    if stamp is None and use_primary():
+        # The replica may not have the order yet.
+        stamp = stamp_query.first()
+    if stamp is None:
+        abort(404)
+
+    def render():
+        order = order_with_items(order_id)
+        return render_template('order_confirmation.html', order=order, items_html=get_renderer().items_html(order))
+    return get_http_cache().respond(render, 'order', order_id, stamp.status, stamp.paid, stamp.updated_at,
+                                    last_modified=stamp.updated_at or stamp.created_at)
+
+@main_bp.route('/orders')
+@login_required
+def order_history():
+    try:
+        orders, next_cursor = fetch_orders(current_user.id, request.args.get('before') or None,
+                                           request.args.get('limit', type=int))
+    except HistoryCursor:
+        return redirect(url_for('main.order_history'))
+    return render_template('order_history.html', orders=orders, next_cursor=next_cursor)
+
+@main_bp.route('/api/orders')
+@login_required
+def api_orders():
+    try:
+        orders, next_cursor = fetch_orders(current_user.id, request.args.get('before') or None,
+                                           request.args.get('limit', type=int))
+    except HistoryCursor:
+        abort(400, description='Invalid cursor.')
+    return jsonify({'orders': [serialize_order(o) for o in orders], 'next': next_cursor})
+
+@main_bp.route('/api/orders/<int:order_id>/status')
+@login_required
+def order_status(order_id):
+    row = db.session.query(Order.status, Order.paid).filter_by(id=order_id, user_id=current_user.id).first()
+    if row is None:
+        abort(404)
+    return jsonify({'order_id': order_id, 'status': row.status or (PAID if row.paid else PENDING)})
 
 @main_bp.route('/login', methods=['GET', 'POST'])
+@rate_limit('login')
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        hasher = get_password_hasher()
+        try:
+            valid = user is not None and hasher.verify(user.password, password)
+        except HasherBusy:
+            flash('Too many sign-ins right now. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503
+        if valid:
             if not user.is_verified:
                 flash('Please verify your email before logging in.', 'warning')
                 return redirect(url_for('main.login'))
+            try:
+                if hasher.needs_rehash(user.password):
+                    # PASSWORD_HASH_METHOD changed; move this user to the new cost.
+                    user.password = hasher.hash(password)
+                    db.session.commit()
+            except HasherBusy:
+                pass
             login_user(user)
             return redirect(url_for('main.index'))
         flash('Invalid credentials!')
     return render_template('login.html')
 
 @main_bp.route('/register', methods=['GET', 'POST'])
+@rate_limit('register')
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -132,10 +359,17 @@ def register():
             flash('Username or email already exists!')
             return redirect(url_for('main.register'))
         is_admin = username.lower() == 'admin'
-        user = User(username=username, email=email, password=generate_password_hash(password), is_admin=is_admin)
+        try:
+            pwhash = get_password_hasher().hash(password)
+        except HasherBusy:
+            flash('Too many sign-ups right now. Please try again in a moment.', 'warning')
+            return render_template('register.html'), 503
+        user = User(username=username, email=email, password=pwhash, is_admin=is_admin)
         db.session.add(user)
+        db.session.flush()
+        enqueue_verification_email(user)
         db.session.commit()
-        send_verification_email(user)
+        dispatch_emails()
         flash('Registration successful! Please check your email to verify your account.')
         return redirect(url_for('main.login'))
     return render_template('register.html')
@@ -162,10 +396,12 @@ def logout():
 
 @main_bp.route('/favicon.ico')
 def favicon():
-    try:
-        return send_from_directory(os.path.join(current_app.root_path, 'static'), 'favicon.ico')
-    except:
-        return '', 204  # No content if favicon not found
+    # Pages link the fingerprinted /static copy; this is for browsers that ask for /favicon.ico anyway.
+    # A missing file falls through to the 404 handler, which answers 204.
+    response = current_app.send_static_file('favicon.ico')
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 3600
+    return response
 
 # Global error handler for 500 errors
 @main_bp.app_errorhandler(500)
@@ -0,0 +1,101 @@
+import logging
+
+import click
+from flask import current_app
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from .models import db
+from .instrumentation import log_event
+from .search import create_search_tables
+
+# Schema creation is an explicit deploy step (`flask init-db`) rather than part
+# of every create_app() call, so cold starts do not pay for it. Local setups can
+# set AUTO_CREATE_SCHEMA=true to get the old create-on-startup behaviour.
+
+
+def add_missing_columns(engine):
+    # Columns added to existing models since the table was created. Column
+    # constraints such as UNIQUE are not added, so uniqueness is declared as an
+    # index, which create_schema builds; new columns must be nullable or have a default.
+    existing = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not existing.has_table(table.name):
+                continue
+            present = {column['name'] for column in existing.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {engine.dialect.identifier_preparer.format_table(table)} ADD COLUMN {ddl}'))
+                    added.append(f'{table.name}.{column.name}')
+    if added:
+        log_event('schema_columns_added', columns=added)
+    return added
+
+
+# Money columns that used to be floats in major units: (table, float column, integer cents column).
+MONEY_COLUMNS = [
+    ('product', 'price', 'price_cents'),
+    ('order', 'total_amount', 'total_cents'),
+    ('order_item', 'price', 'price_cents'),
+    ('payment_attempt', 'amount', 'amount_cents'),
+    ('daily_sales', 'revenue', 'revenue_cents'),
+    ('product_sales', 'revenue', 'revenue_cents'),
+]
+
+
+def migrate_money_columns(engine):
+    # Copies each float column into its cents column, rounded to the nearest
+    # cent, then drops the float column (and indexes on it). Tables that no
+    # longer have the float column are skipped, so this is safe to re-run.
+    existing = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    migrated = []
+    with engine.begin() as conn:
+        for table_name, legacy, cents in MONEY_COLUMNS:
+            if not existing.has_table(table_name):
+                continue
+            present = {column['name'] for column in existing.get_columns(table_name)}
+            if legacy not in present:
+                continue
+            table, old, new = preparer.quote(table_name), preparer.quote(legacy), preparer.quote(cents)
+            if cents not in present:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {new} INTEGER NOT NULL DEFAULT 0'))
+            conn.execute(text(f'UPDATE {table} SET {new} = CAST(ROUND({old} * 100) AS INTEGER) WHERE {old} IS NOT NULL'))
+            for index in existing.get_indexes(table_name):
+                if legacy in index['column_names']:
+                    conn.execute(text(f'DROP INDEX {preparer.quote(index["name"])}'))
+            conn.execute(text(f'ALTER TABLE {table} DROP COLUMN {old}'))
+            migrated.append(f'{table_name}.{legacy}')
+    if migrated:
+        log_event('schema_money_migrated', columns=migrated)
+    return migrated
+
+
+def create_schema():
+    """Create missing tables and columns, then any indexes added to tables that already existed."""
+    db.create_all()
+    migrate_money_columns(db.engine)
+    add_missing_columns(db.engine)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    if current_app.config.get('SEARCH_BACKEND') == 'database':
+        create_search_tables(db.engine)
+
+
+def init_schema(app):
+    if app.config['AUTO_CREATE_SCHEMA']:
+        try:
+            with app.app_context():
+                create_schema()
+        except Exception as e:
+            log_event('create_all_error', logging.ERROR, error=str(e))
+
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the database tables and indexes."""
+        create_schema()
+        click.echo("Database schema is up to date.")
@@ -0,0 +1,388 @@
+import bisect
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import text
+
+from .models import db, Product
+from .signals import products_changed
+
+# Product search over name and description, chosen by SEARCH_BACKEND:
+#   memory   - an inverted index held in each app process (default). It is
+#              built from the product table on the first request (or on the
+#              first search) and kept current from products_changed: changed
+#              ids are marked stale and re-read in one query before the next
+#              search, so a burst of stock updates costs one reload. The
+#              signal only reaches this process, so changes made by other
+#              workers or straight in the database show up when the index is
+#              rebuilt in the background, every SEARCH_INDEX_TTL seconds.
+#   database - SQLite FTS5 or a PostgreSQL tsvector GIN index, created by
+#              `flask init-db`; for deployments where holding the index in
+#              every process is not worth it. Prefix matching only.
+#
+# The memory index scores with BM25, name terms counting NAME_WEIGHT times
+# description terms. Every query word must match; a word also matches terms
+# it is a prefix of (so results appear while typing) and, from
+# TYPO_MIN_LENGTH letters, terms one edit away, each at a lower weight than an
+# exact match. Typo candidates come from a deletion index (every term with one
+# letter removed), so finding them never scans the vocabulary.
+
+WORD_RE = re.compile(r'\w+')
+
+NAME_WEIGHT = 3
+PREFIX_WEIGHT = 0.7
+TYPO_WEIGHT = 0.5
+PREFIX_MIN_LENGTH = 2
+TYPO_MIN_LENGTH = 4
+MAX_PREFIX_TERMS = 50
+MAX_QUERY_WORDS = 8
+OUT_OF_STOCK_FACTOR = 1 - 1e-9
+
+
+def tokenize(value):
+    """Lowercased words with accents stripped: 'Café Crème' -> ['cafe', 'creme']."""
+    if not value:
+        return []
+    if not value.isascii():
+        value = ''.join(c for c in unicodedata.normalize('NFKD', value) if not unicodedata.combining(c))
+    return WORD_RE.findall(value.casefold())
+
+
+def _deletions(term):
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def within_one_edit(a, b):
+    """True if a and b differ by one insertion, deletion, substitution or adjacent swap."""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or (a[i:i + 2] == b[i:i + 2][::-1] and a[i + 2:] == b[i + 2:])
+    return a[i:] == b[i + 1:]
+
+
+class SearchIndex:
+    """Inverted index of products. Not tied to the database; MemorySearch feeds it rows."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}                # term -> {product id: weighted term frequency}
+        self._docs = {}                    # product id -> (terms, weighted length)
+        self._out_of_stock = set()
+        self._vocabulary = []              # sorted terms, for prefix matches
+        self._deletes = defaultdict(set)   # term or term minus one letter -> terms, for typo matches
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, product_id, name, description, stock):
+        frequencies = defaultdict(int)
+        for term in tokenize(name):
+            frequencies[term] += NAME_WEIGHT
+        for term in tokenize(description):
+            frequencies[term] += 1
+        with self._lock:
+            self.remove(product_id)
+            for term, frequency in frequencies.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    bisect.insort(self._vocabulary, term)
+                    if len(term) >= TYPO_MIN_LENGTH - 1:
+                        for key in _deletions(term) | {term}:
+                            self._deletes[key].add(term)
+                postings[product_id] = frequency
+            length = sum(frequencies.values())
+            self._docs[product_id] = (tuple(frequencies), length)
+            self._total_length += length
+            if stock <= 0:
+                self._out_of_stock.add(product_id)
+
+    def remove(self, product_id):
+        with self._lock:
+            doc = self._docs.pop(product_id, None)
+            if doc is None:
+                return
+            terms, length = doc
+            self._total_length -= length
+            self._out_of_stock.discard(product_id)
+            for term in terms:
+                postings = self._postings[term]
+                del postings[product_id]
+                if postings:
+                    continue
+                del self._postings[term]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, term)]
+                for key in _deletions(term) | {term}:
+                    variants = self._deletes.get(key)
+                    if variants is not None:
+                        variants.discard(term)
+                        if not variants:
+                            del self._deletes[key]
+
+    def _expand(self, word):
+        """Terms the query word matches, with the weight of each kind of match."""
+        matches = {}
+        if len(word) >= PREFIX_MIN_LENGTH:
+            start = bisect.bisect_left(self._vocabulary, word)
+            completions = []
+            for term in self._vocabulary[start:start + MAX_PREFIX_TERMS * 20]:
+                if not term.startswith(word):
+                    break
+                completions.append(term)
+            # Prefer the commonest completions when a short prefix matches many terms.
+            if len(completions) > MAX_PREFIX_TERMS:
+                completions = heapq.nlargest(MAX_PREFIX_TERMS, completions, key=lambda t: len(self._postings[t]))
+            matches.update((term, PREFIX_WEIGHT) for term in completions)
+        if len(word) >= TYPO_MIN_LENGTH:
+            candidates = set()
+            for key in _deletions(word) | {word}:
+                candidates.update(self._deletes.get(key, ()))
+            for term in candidates:
+                if term not in matches and within_one_edit(word, term):
+                    matches[term] = TYPO_WEIGHT
+        if word in self._postings:
+            matches[word] = 1.0
+        return matches
+
+    def search(self, query, limit=24):
+        """Ids of the best `limit` products matching every word of `query`, best first."""
+        words = tokenize(query)[:MAX_QUERY_WORDS]
+        if not words:
+            return []
+        with self._lock:
+            count = len(self._docs)
+            if not count:
+                return []
+            docs = self._docs
+            k1 = self.k1
+            base, slope = k1 * (1 - self.b), k1 * self.b * count / self._total_length
+            expansions = [self._expand(word) for word in words]
+            # Rarest word first: later words only score products still in the running.
+            expansions.sort(key=lambda terms: sum(len(self._postings[t]) for t in terms))
+            scores = None
+            for terms in expansions:
+                word_scores = {}
+                for term, weight in terms.items():
+                    postings = self._postings[term]
+                    boost = weight * math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)) * (k1 + 1)
+                    if scores is None:
+                        candidates = postings.items()
+                    else:
+                        candidates = [(pid, postings[pid]) for pid in scores if pid in postings]
+                    for product_id, frequency in candidates:
+                        score = boost * frequency / (frequency + base + slope * docs[product_id][1])
+                        # A word scores by its best matching term, not the sum of all of them.
+                        if score > word_scores.get(product_id, 0.0):
+                            word_scores[product_id] = score
+                if scores is not None:
+                    for product_id in word_scores:
+                        word_scores[product_id] += scores[product_id]
+                scores = word_scores
+                if not scores:
+                    return []
+            # Sold-out products drop just below in-stock ones that match equally well.
+            for product_id in self._out_of_stock if len(self._out_of_stock) < len(scores) else list(scores):
+                if product_id in scores and product_id in self._out_of_stock:
+                    scores[product_id] *= OUT_OF_STOCK_FACTOR
+            best = heapq.nlargest(limit, scores, key=scores.get)
+        return best
+
+
+class MemorySearch:
+    name = 'memory'
+
+    def __init__(self, app, batch_size=5000, ttl=None, clock=time.monotonic):
+        self.app = app
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.clock = clock
+        self.index = SearchIndex()
+        self.ready = False
+        self.built_at = None
+        self._rebuilding = False
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._warming = None
+
+    def products_changed(self, sender, product_ids=(), **kwargs):
+        with self._lock:
+            self._stale.update(product_ids)
+
+    def _rows(self, product_ids=None):
+        query = db.session.query(Product.id, Product.name, Product.description, Product.stock)
+        if product_ids is not None:
+            query = query.filter(Product.id.in_(product_ids))
+        return query.execution_options(yield_per=self.batch_size)
+
+    def _load(self, index):
+        start = time.perf_counter()
+        built_at = self.clock()
+        with self._lock:
+            # Changes committed from here on are re-read after the build.
+            self._stale.clear()
+        for row in self._rows():
+            index.add(row.id, row.name, row.description, row.stock)
+        self.built_at = built_at
+        logging.info(f"Search index built: {len(index)} products in {time.perf_counter() - start:.2f}s.")
+
+    def build(self):
+        """Index every product. Runs once per process; later calls return at once."""
+        if self.ready:
+            return
+        with self._build_lock:
+            if self.ready:
+                return
+            self._load(self.index)
+            self.ready = True
+
+    def rebuild(self):
+        """Read every product into a new index and swap it in; searches use the old one meanwhile."""
+        with self._build_lock:
+            self._rebuilding = True
+            try:
+                index = SearchIndex()
+                self._load(index)
+                self.index = index
+            finally:
+                self._rebuilding = False
+
+    def _in_background(self, target, what):
+        def run():
+            try:
+                with self.app.app_context():
+                    target()
+            except Exception:
+                logging.exception(f"{what} the search index failed.")
+        self._warming = threading.Thread(target=run, name='search-index', daemon=True)
+        self._warming.start()
+
+    def warm(self):
+        """Build the index on a background thread."""
+        self._in_background(self.build, 'Building')
+
+    def expired(self):
+        return self.ttl is not None and self.built_at is not None and self.clock() - self.built_at >= self.ttl
+
+    def refresh(self):
+        if self._rebuilding:
+            # The new index reads these rows itself; anything it misses stays stale for later.
+            return
+        with self._lock:
+            stale, self._stale = self._stale, set()
+        if not stale:
+            return
+        found = set()
+        for row in self._rows(stale):
+            self.index.add(row.id, row.name, row.description, row.stock)
+            found.add(row.id)
+        for product_id in stale - found:
+            self.index.remove(product_id)
+
+    def search(self, query, limit):
+        self.build()
+        if self.expired() and not self._build_lock.locked():
+            self.built_at = self.clock()     # one rebuild per TTL, even if it fails
+            self._in_background(self.rebuild, 'Rebuilding')
+        self.refresh()
+        return self.index.search(query, limit)
+
+
+class DatabaseSearch:
+    name = 'database'
+
+    def search(self, query, limit):
+        words = tokenize(query)[:MAX_QUERY_WORDS]
+        if not words:
+            return []
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            # Words are \w+ only, so quoting them is enough to keep FTS5 syntax out.
+            statement = text('SELECT rowid FROM product_fts WHERE product_fts MATCH :match '
+                             f'ORDER BY bm25(product_fts, {NAME_WEIGHT:.1f}, 1.0) LIMIT :limit')
+            match = ' '.join(f'"{word}"*' for word in words)
+        elif dialect == 'postgresql':
+            statement = text(f"SELECT id FROM product WHERE {PG_DOCUMENT} @@ to_tsquery('simple', :match) "
+                             f"ORDER BY ts_rank({PG_DOCUMENT}, to_tsquery('simple', :match)) DESC, id LIMIT :limit")
+            match = ' & '.join(f'{word}:*' for word in words)
+        else:
+            raise RuntimeError(f'SEARCH_BACKEND=database is not supported on {dialect}.')
+        return [row[0] for row in db.session.execute(statement, {'match': match, 'limit': limit})]
+
+
+PG_DOCUMENT = ("(setweight(to_tsvector('simple', name), 'A') || "
+               "setweight(to_tsvector('simple', coalesce(description, '')), 'B'))")
+
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE product_fts USING fts5(name, description, content='product', content_rowid='id')",
+    "CREATE TRIGGER product_fts_insert AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER product_fts_delete AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END",
+    # Only name and description changes touch the index, not stock updates.
+    "CREATE TRIGGER product_fts_update AFTER UPDATE OF name, description ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "INSERT INTO product_fts(product_fts) VALUES ('rebuild')",
+]
+
+
+def create_search_tables(engine):
+    """Create the full-text index SEARCH_BACKEND=database reads; safe to re-run."""
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'product_fts'")).first()
+            if not exists:
+                for statement in SQLITE_FTS:
+                    conn.execute(text(statement))
+        elif engine.dialect.name == 'postgresql':
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_product_search ON product USING gin ({PG_DOCUMENT})'))
+
+
+def get_search(app=None):
+    return (app or current_app).extensions['search']
+
+
+def search_products(query, limit):
+    """Products matching `query`, best first."""
+    ids = get_search().search(query, limit)
+    if not ids:
+        return []
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(ids))}
+    return [products[i] for i in ids if i in products]
+
+
+def init_search(app):
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'memory':
+        search = MemorySearch(app, ttl=app.config.get('SEARCH_INDEX_TTL') or None)
+        products_changed.connect(search.products_changed)
+        if app.config['SEARCH_WARM']:
+            @app.before_request
+            def _warm_search_index():
+                if search._warming is None and not search.ready:
+                    search.warm()
+    elif backend == 'database':
+        search = DatabaseSearch()
+    else:
+        raise ValueError(f'Unknown SEARCH_BACKEND {backend!r}.')
+    app.extensions['search'] = search
+    return search
@@ -0,0 +1,48 @@
+from blinker import Namespace
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import Product, User
+
+# Fired after a transaction that changed products (or users) commits, with
+# product_ids (user_ids) = set of ids. Caches subscribe to these to invalidate themselves.
+_signals = Namespace()
+products_changed = _signals.signal('products-changed')
+users_changed = _signals.signal('users-changed')
+
+
+def mark_products_changed(session, product_ids):
+    session.info.setdefault('changed_products', set()).update(product_ids)
+
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+@event.listens_for(Product, 'after_delete')
+def _product_flushed(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        mark_products_changed(session, [target.id])
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_flushed(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_after_commit(session):
+    changed = session.info.pop('changed_products', None)
+    if changed:
+        products_changed.send(session, product_ids=changed)
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        users_changed.send(session, user_ids=changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('changed_products', None)
+    session.info.pop('changed_users', None)
@@ -0,0 +1,292 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import current_app, g, request
+from flask_login import current_user
+from sqlalchemy.pool import QueuePool
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from .cart_store import LocalKV
+from .instrumentation import get_metrics
+from .models import db
+from .payments import get_payment_pool
+
+# Two guards in front of the views.
+#
+# Rate limits cap how often one client may hit an expensive write endpoint
+# (sign-up, sign-in, add to cart, checkout), keyed by user id when signed in
+# and by client address otherwise. RATE_LIMIT_STORE picks the backend:
+#   memory      - token buckets in this process (default); each worker
+#                 process enforces the limit on its own
+#   kv          - sliding-window counters in LocalKV, the in-process stand-in
+#                 for a shared store, for tests and single-process deployments
+#   redis://... - the same counters in Redis, shared by every process
+#
+# Admission control sheds whole requests before they reach a view when the
+# process is saturated, which takes a threaded server (gunicorn gthread, as in
+# the Procfile): a sync worker never has more than one request in flight.
+# Load is the fullest of: requests in flight against ADMISSION_MAX_IN_FLIGHT,
+# checked-out database connections against the pool, and queued payment jobs
+# against PAYMENT_MAX_PENDING. Low-priority endpoints (sign-up, JSON listings,
+# bulk orders) are refused with 503 first, normal ones only when the load is
+# higher, and checkout, order status and /metrics never.
+
+Rate = namedtuple('Rate', 'limit period')
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+RATE_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$')
+
+HIGH, NORMAL, LOW = 'high', 'normal', 'low'
+
+PRIORITIES = {
+    'main.checkout': HIGH,
+    'main.order_confirmation': HIGH,
+    'main.order_status': HIGH,
+    'main.favicon': HIGH,
+    'static': HIGH,
+    'metrics_endpoint': HIGH,
+    'slow_queries_endpoint': HIGH,
+    'main.register': LOW,
+    'main.api_products': LOW,
+    'main.api_orders': LOW,
+    'main.api_search': LOW,
+    'main.bulk_orders': LOW,
+}
+
+# Config key holding each rule's rate, e.g. '10/minute'
+RULES = {
+    'login': 'RATE_LIMIT_LOGIN',
+    'register': 'RATE_LIMIT_REGISTER',
+    'cart': 'RATE_LIMIT_CART',
+    'checkout': 'RATE_LIMIT_CHECKOUT',
+}
+
+
+def parse_rate(text):
+    """'10/minute' -> Rate(10, 60); also '5/hour', '100/day', '3/10seconds'."""
+    match = RATE_RE.match(text or '')
+    if not match:
+        raise ValueError(f'Invalid rate {text!r}; expected e.g. "10/minute".')
+    limit, count, unit = match.groups()
+    return Rate(int(limit), int(count or 1) * PERIODS[unit])
+
+
+class MemoryLimiter:
+    """Token buckets: `limit` requests at once, refilled at limit/period per second."""
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, rate):
+        """Take a token for `key`. Returns 0 if allowed, else seconds until a token is free."""
+        now = self.clock()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (rate.limit, now))
+            tokens = min(rate.limit, tokens + (now - stamp) * rate.limit / rate.period)
+            if tokens >= 1:
+                tokens, wait = tokens - 1, 0
+            else:
+                wait = (1 - tokens) * rate.period / rate.limit
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class KVLimiter:
+    """Sliding-window counters in a Redis-like store, so every process shares one count per key.
+
+    A request is allowed when the hits in the current fixed window plus the
+    previous window's hits, weighted by how much of it still overlaps the
+    sliding window, stay within the limit. Refused hits are not counted.
+    """
+
+    def __init__(self, client, prefix='ratelimit:', clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def hit(self, key, rate):
+        now = self.clock()
+        window = int(now // rate.period)
+        elapsed = now - window * rate.period
+        current = f'{self.prefix}{key}:{window}'
+        count = self.client.incr(current)
+        if count == 1:
+            self.client.expire(current, rate.period * 2)
+        previous = int(self.client.get(f'{self.prefix}{key}:{window - 1}') or 0)
+        weight = (rate.period - elapsed) / rate.period
+        if count + previous * weight <= rate.limit:
+            return 0
+        self.client.incr(current, -1)
+        if count > rate.limit or not previous:
+            return rate.period - elapsed
+        # Time until enough of the previous window has slid out.
+        return max(count + previous * weight - rate.limit, 0) * rate.period / previous
+
+
+class RateLimiter:
+    def __init__(self, backend, rules, metrics=None, enabled=True):
+        self.backend = backend
+        self.rules = rules
+        self.metrics = metrics
+        self.enabled = enabled
+
+    def check(self, rule, key):
+        """Raise TooManyRequests if `key` has used up `rule`."""
+        rate = self.rules.get(rule)
+        if not self.enabled or rate is None:
+            return
+        wait = self.backend.hit(f'{rule}:{key}', rate)
+        if wait:
+            if self.metrics is not None:
+                self.metrics.increment('app_rate_limited_total', rule=rule)
+            logging.info(f"Rate limit {rule} hit by {key}; retry in {wait:.1f}s.")
+            raise TooManyRequests('Too many requests. Please slow down and try again shortly.',
+                                  retry_after=max(1, math.ceil(wait)))
+
+
+def client_key(per):
+    if per == 'user' and current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return f'ip:{request.remote_addr}'
+
+
+def rate_limit(rule, per='ip', methods=('POST',)):
+    """Apply the RATE_LIMIT_<RULE> limit to a view, keyed by client address or (per='user') user id."""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method in methods:
+                get_rate_limiter().check(rule, client_key(per))
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def create_rate_limiter(app):
+    url = app.config['RATE_LIMIT_STORE']
+    if url == 'memory':
+        backend = MemoryLimiter()
+    elif url == 'kv':
+        backend = KVLimiter(LocalKV())
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RATE_LIMIT_STORE is a Redis URL but the redis package is not installed.')
+        backend = KVLimiter(redis.Redis.from_url(url))
+    else:
+        raise ValueError(f'Unknown RATE_LIMIT_STORE {url!r}.')
+    rules = {rule: parse_rate(app.config[key]) for rule, key in RULES.items() if app.config.get(key)}
+    return RateLimiter(backend, rules, get_metrics(app), app.config['RATE_LIMIT_ENABLED'])
+
+
+class AdmissionControl:
+    """Counts requests in flight and refuses the ones whose priority is shed at the current load."""
+
+    def __init__(self, max_in_flight=64, shed_at=None, metrics=None):
+        self.max_in_flight = max_in_flight
+        self.shed_at = shed_at or {LOW: 0.75, NORMAL: 0.9}
+        self.metrics = metrics
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # name -> callable returning how full that resource is, 0.0 to 1.0
+        self.sources = {}
+        if max_in_flight:
+            self.sources['in_flight'] = lambda: self.in_flight / self.max_in_flight
+
+    def load(self):
+        """(utilization, source) of the fullest resource."""
+        worst = (0.0, None)
+        for name, read in self.sources.items():
+            try:
+                value = read()
+            except Exception:
+                continue
+            if value > worst[0]:
+                worst = (value, name)
+        return worst
+
+    def enter(self, priority):
+        with self._lock:
+            self.in_flight += 1
+        threshold = self.shed_at.get(priority)
+        if threshold is None:
+            return
+        load, source = self.load()
+        if load >= threshold:
+            if self.metrics is not None:
+                self.metrics.increment('app_requests_shed_total', priority=priority, reason=source)
+            logging.warning(f"Shedding {priority}-priority request to {request.path}: {source} at {load:.0%}.")
+            raise ServiceUnavailable('The service is busy. Please try again in a moment.', retry_after=1)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def pool_utilization(pool, max_overflow):
+    capacity = pool.size() + max_overflow
+    return pool.checkedout() / capacity if capacity > 0 else 0.0
+
+
+def configured_max_overflow(app, bind=None):
+    """max_overflow the engine for `bind` was created with: from its engine options, else QueuePool's default."""
+    options = app.config['SQLALCHEMY_ENGINE_OPTIONS'] if bind is None else app.config['SQLALCHEMY_BINDS'].get(bind)
+    return options.get('max_overflow', 10) if isinstance(options, dict) else 10
+
+
+def create_admission_control(app):
+    control = AdmissionControl(app.config['ADMISSION_MAX_IN_FLIGHT'],
+                               {LOW: app.config['ADMISSION_SHED_LOW'], NORMAL: app.config['ADMISSION_SHED_NORMAL']},
+                               get_metrics(app))
+    with app.app_context():
+        for name, engine in db.engines.items():
+            max_overflow = configured_max_overflow(app, name)
+            # Unbounded pools (max_overflow=-1) never run out, so they are not a load signal.
+            if isinstance(engine.pool, QueuePool) and max_overflow >= 0:
+                control.sources[f'db_pool:{name}' if name else 'db_pool'] = (
+                    lambda pool=engine.pool, max_overflow=max_overflow: pool_utilization(pool, max_overflow))
+    payments = get_payment_pool(app)
+    if payments.max_pending:
+        control.sources['payment_queue'] = lambda: payments.pending / payments.max_pending
+    return control
+
+
+def get_rate_limiter(app=None):
+    return (app or current_app).extensions['rate_limiter']
+
+
+def get_admission_control(app=None):
+    return (app or current_app).extensions['admission_control']
+
+
+def init_throttling(app):
+    limiter = create_rate_limiter(app)
+    app.extensions['rate_limiter'] = limiter
+    if not app.config['ADMISSION_CONTROL']:
+        return limiter
+    control = create_admission_control(app)
+    app.extensions['admission_control'] = control
+    get_metrics(app).gauges['app_requests_in_flight'] = lambda: control.in_flight
+
+    @app.before_request
+    def _admit():
+        g._admitted = True
+        control.enter(PRIORITIES.get(request.endpoint, NORMAL))
+
+    @app.teardown_request
+    def _release(exc):
+        if g.pop('_admitted', False):
+            control.leave()
+
+    return limiter
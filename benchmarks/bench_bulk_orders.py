@@ -0,0 +1,92 @@
+"""Orders/sec for POST /api/bulk_orders versus the per-line ORM loop used by /checkout.
+
+    python benchmarks/bench_bulk_orders.py --products 20000 --orders 500 --lines 20
+
+The catalog is seeded with seed.seed_catalog() into a temporary SQLite file
+(or --database-url). Both paths place the same randomly generated orders.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from app.models import db, User, Product, Order, OrderItem
+from seed import seed_catalog
+
+
+def legacy_place(user_id, orders):
+    # What /checkout does per order: one ORM row per line and an ORM stock decrement.
+    for lines in orders:
+        products = {p.id: p for p in Product.query.filter(Product.id.in_([pid for pid, _ in lines]))}
+        total = sum(products[pid].price * qty for pid, qty in lines)
+        order = Order(user_id=user_id, total_amount=total, paid=False)
+        db.session.add(order)
+        db.session.flush()
+        for pid, qty in lines:
+            db.session.add(OrderItem(order_id=order.id, product_id=pid, quantity=qty, price=products[pid].price))
+            products[pid].stock -= qty
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--orders', type=int, default=500)
+    parser.add_argument('--lines', type=int, default=20, help='lines per order')
+    parser.add_argument('--per-request', type=int, default=100, help='orders per bulk request')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'bulk.db')}"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'EMAIL_DELIVERY': 'external'})
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        first_id = (db.session.query(db.func.max(Product.id)).scalar() or 0) + 1
+        seed_catalog(args.products, stock=10 ** 6)
+        print(f"seeded {args.products} products in {time.perf_counter() - start:.2f}s")
+        user = User(username=f'bench-{time.time_ns()}', email=f'bench-{time.time_ns()}@example.com',
+                    password=generate_password_hash('pw'), is_verified=True, is_wholesale=True)
+        db.session.add(user)
+        db.session.commit()
+        user_id, username = user.id, user.username
+
+    rng = random.Random(1)
+    product_ids = range(first_id, first_id + args.products)
+    orders = [[(pid, rng.randint(1, 5)) for pid in rng.sample(product_ids, args.lines)] for _ in range(args.orders)]
+
+    with app.app_context():
+        start = time.perf_counter()
+        legacy_place(user_id, orders)
+        legacy = time.perf_counter() - start
+
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'pw'})
+    start = time.perf_counter()
+    created = 0
+    for offset in range(0, len(orders), args.per_request):
+        body = {'orders': [{'lines': [{'product_id': pid, 'quantity': qty} for pid, qty in lines]}
+                           for lines in orders[offset:offset + args.per_request]]}
+        rv = client.post('/api/bulk_orders', json=body)
+        created += rv.get_json()['created']
+    bulk = time.perf_counter() - start
+    tmp.cleanup()
+
+    total_lines = args.orders * args.lines
+    print(f"per-line ORM loop: {args.orders} orders / {total_lines} lines in {legacy:.2f}s "
+          f"= {args.orders / legacy:.0f} orders/s")
+    print(f"bulk endpoint:     {created} orders / {total_lines} lines in {bulk:.2f}s "
+          f"= {created / bulk:.0f} orders/s ({args.per_request} orders/request)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Cart churn against each cart store: add/remove/view requests per second and DB writes.
+
+    python benchmarks/bench_cart_store.py --users 50 --ops 40
+
+Each user adds and removes random products and views the cart through the
+Flask test client. Runs against a temporary SQLite file (or --database-url).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from app.cart_store import get_cart_store
+from app.models import db, User, Product
+from seed import seed_catalog
+
+
+def run(store, url, users, ops, products):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'EMAIL_DELIVERY': 'external',
+                      'CART_STORE': store, 'CART_FLUSH_INTERVAL': 0, 'RATE_LIMIT_ENABLED': False})
+    tag = f'{store}-{time.time_ns()}'
+    with app.app_context():
+        db.create_all()
+        if not Product.query.first():
+            seed_catalog(products)
+        password = generate_password_hash('pw')
+        db.session.add_all([User(username=f'{tag}-{i}', email=f'{tag}-{i}@example.com', password=password,
+                                 is_verified=True) for i in range(users)])
+        db.session.commit()
+        engine = db.engine
+    clients = []
+    for i in range(users):
+        client = app.test_client()
+        client.post('/login', data={'username': f'{tag}-{i}', 'password': 'pw'})
+        clients.append(client)
+
+    writes = []
+    listener = lambda conn, cursor, statement, *args: writes.append(1) if not statement.lstrip().startswith('SELECT') else None
+    event.listen(engine, 'before_cursor_execute', listener)
+    rng = random.Random(0)
+    start = time.perf_counter()
+    requests = 0
+    for _ in range(ops):
+        for client in clients:
+            roll = rng.random()
+            if roll < 0.5:
+                client.post(f'/add_to_cart/{rng.randint(1, products)}', data={'quantity': 1})
+            elif roll < 0.7:
+                client.post(f'/remove_from_cart/{rng.randint(1, products)}')
+            else:
+                client.get('/cart')
+            requests += 1
+    elapsed = time.perf_counter() - start
+    churn_writes = len(writes)
+    with app.app_context():
+        flushed = get_cart_store(app).flush()
+    event.remove(engine, 'before_cursor_execute', listener)
+    print(f"{store:<8} {requests / elapsed:8.0f} req/s  {churn_writes:6d} writes during churn  "
+          f"{len(writes) - churn_writes:4d} writes to flush {flushed} carts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--ops', type=int, default=40, help='requests per user')
+    parser.add_argument('--products', type=int, default=500)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'carts.db')}"
+    for store in ('sql', 'memory'):
+        run(store, url, args.users, args.ops, args.products)
+
+
+if __name__ == '__main__':
+    main()
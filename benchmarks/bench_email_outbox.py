@@ -0,0 +1,83 @@
+"""Compare inline per-request email sends with the batched outbox worker.
+
+Runs entirely offline against app.smtp_sink.LocalSMTPSink:
+
+    python benchmarks/bench_email_outbox.py --messages 500 --batch-size 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.models import db, User, Order
+from app.email_utils import send_order_confirmation
+from app.email_outbox import enqueue_order_confirmation, EmailWorkerPool
+from app.smtp_sink import LocalSMTPSink
+
+
+def make_app(sink, db_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
+        'EMAIL_DELIVERY': 'external',
+        'MAIL_SERVER': sink.host,
+        'MAIL_PORT': sink.port,
+        'MAIL_USE_TLS': False,
+        'MAIL_USERNAME': '',
+        'MAIL_PASSWORD': '',
+        'SERVER_NAME': 'localhost',
+    })
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com', password='x', is_verified=True)
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Order(user_id=user.id, total_amount=99.0, paid=True))
+        db.session.commit()
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    with LocalSMTPSink() as sink, tempfile.TemporaryDirectory() as tmp:
+        app = make_app(sink, os.path.join(tmp, 'bench.db'))
+
+        with app.app_context():
+            order = db.session.get(Order, 1)
+            start = time.perf_counter()
+            for _ in range(args.messages):
+                send_order_confirmation('bench@example.com', order)
+            inline = time.perf_counter() - start
+        inline_connections = sink.connections
+
+        with app.app_context():
+            order = db.session.get(Order, 1)
+            start = time.perf_counter()
+            for _ in range(args.messages):
+                enqueue_order_confirmation('bench@example.com', order)
+                db.session.commit()
+            enqueue = time.perf_counter() - start
+
+        pool = EmailWorkerPool(app, batch_size=args.batch_size)
+        start = time.perf_counter()
+        sent = pool.drain()
+        drained = time.perf_counter() - start
+
+    print(f"inline send:   {args.messages} msgs in {inline:.3f}s "
+          f"({args.messages / inline:.0f} msg/s, {inline / args.messages * 1000:.2f} ms/request, "
+          f"{inline_connections} SMTP connections)")
+    print(f"outbox enqueue: {args.messages} msgs in {enqueue:.3f}s "
+          f"({enqueue / args.messages * 1000:.2f} ms/request)")
+    print(f"outbox drain:  {sent} msgs in {drained:.3f}s ({sent / drained:.0f} msg/s, "
+          f"{sink.connections - inline_connections} SMTP connections)")
+
+
+if __name__ == '__main__':
+    main()
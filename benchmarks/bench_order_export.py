@@ -0,0 +1,84 @@
+"""Rows/sec and peak Python memory of the admin order export at growing order counts.
+
+    python benchmarks/bench_order_export.py --orders 10000 100000 --lines 3
+
+Orders are bulk-inserted into a temporary SQLite file (or --database-url), then
+exported through /admin/order_export/orders.csv and read chunk by chunk. If the
+export streams, peak memory stays flat as the order count grows.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import insert, func
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from app.models import db, User, Product, Order, OrderItem
+from seed import seed_catalog
+
+
+def grow(target, lines, products, rng):
+    start = datetime(2024, 1, 1)
+    have = db.session.query(func.count(Order.id)).scalar()
+    user_id = User.query.filter_by(username='exporter').one().id
+    for first in range(have, target, 5000):
+        count = min(5000, target - first)
+        db.session.execute(insert(Order), [
+            {'user_id': user_id, 'created_at': start + timedelta(minutes=first + i), 'total_cents': 1000,
+             'paid': True, 'status': 'paid'} for i in range(count)])
+        ids = [i for (i,) in db.session.query(Order.id).order_by(Order.id.desc()).limit(count)]
+        db.session.execute(insert(OrderItem), [
+            {'order_id': oid, 'product_id': rng.randint(1, products), 'quantity': 1, 'price_cents': 1000 // lines}
+            for oid in ids for _ in range(lines)])
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--orders', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--lines', type=int, default=3, help='lines per order')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'export.db')}"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'EMAIL_DELIVERY': 'external'})
+    with app.app_context():
+        db.create_all()
+        if not Product.query.first():
+            seed_catalog(args.products)
+        if not User.query.filter_by(username='exporter').first():
+            db.session.add(User(username='exporter', email='exporter@example.com',
+                                password=generate_password_hash('pw'), is_verified=True, is_admin=True))
+            db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'exporter', 'password': 'pw'})
+
+    rng = random.Random(0)
+    for target in sorted(args.orders):
+        with app.app_context():
+            grow(target, args.lines, args.products, rng)
+        tracemalloc.start()
+        start = time.perf_counter()
+        rv = client.get(f'/admin/order_export/orders.{args.format}', buffered=False)
+        rows = sum(chunk.count(b'\n') for chunk in rv.response)
+        rv.close()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{target:>9} orders  {rows:>9} rows  {rows / elapsed:9.0f} rows/s  peak {peak / 2**20:6.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""End-to-end load test: concurrent shoppers browse, fill carts and check out.
+
+    python benchmarks/bench_order_flow.py --products 5000 --users 200 --clients 16 --scenarios 10
+    python benchmarks/bench_order_flow.py --save-baseline            # record benchmarks/baselines/order_flow.json
+    python benchmarks/bench_order_flow.py --max-regression 0.25      # compare, exit 1 if p95 or throughput regress
+
+Each client logs in as its own seeded user and repeats a scenario: sometimes
+log in again, browse a few catalog pages, add products to the cart, view the
+cart, open checkout and pay, then view the confirmation. Per-endpoint
+throughput and latency percentiles are reported and optionally compared
+against a saved baseline.
+
+Everything runs offline. The mock payment gateway is deterministic (clients
+send their own seeded idempotency keys, and its outcome depends only on the
+key) with optional --payment-latency-ms, and email is rendered but not sent
+(MAIL_SUPPRESS_SEND). By default requests go through Flask's test client;
+--http serves the app on a local port with werkzeug and sends real HTTP.
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from app import create_app
+from app.models import db, User, Order
+from seed import seed_catalog
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baselines', 'order_flow.json')
+PASSWORD = 'loadtest'
+SORTS = ['', 'price', '-price', 'name']
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers.get('Location', ''), response.data
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                return response.status, response.headers.get('Location', ''), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('Location', ''), e.read()
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))]
+
+
+class Shopper:
+    def __init__(self, transport, username, rng, recorder, products, checkout_rate, login_rate):
+        self.transport = transport
+        self.username = username
+        self.rng = rng
+        self.recorder = recorder
+        self.products = products
+        self.checkout_rate = checkout_rate
+        self.login_rate = login_rate
+        self.recording = True
+
+    def call(self, endpoint, method, path, data=None, expect=(200, 302)):
+        start = time.perf_counter()
+        status, location, body = self.transport.request(method, path, data)
+        if self.recording:
+            self.recorder.record(endpoint, time.perf_counter() - start, status in expect)
+        return status, location, body
+
+    def login(self):
+        status, location, _ = self.call('POST /login', 'POST', '/login',
+                                        {'username': self.username, 'password': PASSWORD}, expect=(302,))
+        if status != 302:
+            raise RuntimeError(f'login failed for {self.username}: {status}')
+
+    def scenario(self):
+        rng = self.rng
+        if rng.random() < self.login_rate:
+            # A returning visitor: a new session starts with a login.
+            self.call('GET /logout', 'GET', '/logout', expect=(302,))
+            self.login()
+        for _ in range(rng.randint(1, 3)):
+            sort = rng.choice(SORTS)
+            self.call('GET /', 'GET', f'/?sort={sort}' if sort else '/')
+        for _ in range(rng.randint(1, 4)):
+            self.call('POST /add_to_cart', 'POST', f'/add_to_cart/{rng.randint(1, self.products)}',
+                      {'quantity': rng.randint(1, 3)}, expect=(302,))
+        self.call('GET /cart', 'GET', '/cart')
+        if rng.random() >= self.checkout_rate:
+            return
+        self.call('GET /checkout', 'GET', '/checkout')
+        form = {'wallet_number': '1234567890', 'payment_details': 'loadtest',
+                'payment_key': '%032x' % rng.getrandbits(128)}
+        status, location, _ = self.call('POST /checkout', 'POST', '/checkout', form, expect=(302, 200))
+        if status == 302 and '/order_confirmation/' in location:
+            self.call('GET /order_confirmation', 'GET', urllib.parse.urlparse(location).path)
+
+
+def seed(app, args, tag):
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        seed_catalog(args.products, stock=10 ** 7, seed=args.seed)
+        password = generate_password_hash(PASSWORD)
+        db.session.execute(insert(User), [
+            {'username': f'{tag}-{i}', 'email': f'{tag}-{i}@example.com', 'password': password, 'is_verified': True}
+            for i in range(args.users)])
+        db.session.commit()
+        print(f"seeded {args.products} products and {args.users} users in {time.perf_counter() - start:.2f}s")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        endpoints[endpoint] = {
+            'requests': len(values),
+            'errors': recorder.errors[endpoint],
+            'rps': round(len(values) / elapsed, 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p90_ms': round(percentile(values, 0.90) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2),
+        }
+    total = sum(e['requests'] for e in endpoints.values())
+    return {'elapsed_s': round(elapsed, 3), 'requests': total, 'rps': round(total / elapsed, 2),
+            'errors': sum(e['errors'] for e in endpoints.values()), 'endpoints': endpoints}
+
+
+def print_report(summary, baseline=None):
+    print(f"\n{'endpoint':<26}{'reqs':>7}{'err':>5}{'rps':>9}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for endpoint, e in summary['endpoints'].items():
+        line = (f"{endpoint:<26}{e['requests']:>7}{e['errors']:>5}{e['rps']:>9.1f}{e['p50_ms']:>9.1f}"
+                f"{e['p90_ms']:>9.1f}{e['p95_ms']:>9.1f}{e['p99_ms']:>9.1f}{e['max_ms']:>9.1f}")
+        before = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if before and before['p95_ms']:
+            line += f"   p95 {100 * (e['p95_ms'] / before['p95_ms'] - 1):+.0f}%"
+        print(line)
+    line = f"\ntotal {summary['requests']} requests in {summary['elapsed_s']:.2f}s = {summary['rps']:.1f} req/s"
+    if baseline and baseline.get('rps'):
+        line += f" ({100 * (summary['rps'] / baseline['rps'] - 1):+.0f}% vs baseline {baseline.get('revision')})"
+    print(line + f", {summary['errors']} errors")
+
+
+def regressions(summary, baseline, tolerance):
+    found = []
+    if baseline['rps'] and summary['rps'] < baseline['rps'] * (1 - tolerance):
+        found.append(f"throughput {summary['rps']} < {baseline['rps']} req/s")
+    for endpoint, before in baseline['endpoints'].items():
+        now = summary['endpoints'].get(endpoint)
+        if now and before['p95_ms'] and now['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            found.append(f"{endpoint} p95 {now['p95_ms']}ms > {before['p95_ms']}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent shoppers')
+    parser.add_argument('--scenarios', type=int, default=10, help='scenarios per client')
+    parser.add_argument('--warmup', type=int, default=1, help='unrecorded scenarios per client')
+    parser.add_argument('--checkout-rate', type=float, default=0.5, help='share of scenarios that check out')
+    parser.add_argument('--login-rate', type=float, default=0.2, help='share of scenarios that start with a login')
+    parser.add_argument('--payment-latency-ms', type=float, default=0.0)
+    parser.add_argument('--payment-success-rate', type=float, default=0.9)
+    parser.add_argument('--cart-store', default='sql')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--http', action='store_true', help='serve over a local socket instead of the test client')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, help='fail if p95 or throughput is this much worse (0.25 = 25%%)')
+    args = parser.parse_args()
+    if args.clients > args.users:
+        parser.error('--clients cannot exceed --users')
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'order_flow.db')}"
+    options = {}
+    if url.startswith('sqlite'):
+        options['connect_args'] = {'timeout': 60}
+    else:
+        options = {'pool_size': args.clients, 'max_overflow': args.clients}
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': url, 'SQLALCHEMY_ENGINE_OPTIONS': options,
+        'EMAIL_DELIVERY': 'inline', 'MAIL_SUPPRESS_SEND': True,
+        'MOCK_PAYMENT_LATENCY_MS': args.payment_latency_ms, 'MOCK_PAYMENT_SUCCESS_RATE': args.payment_success_rate,
+        'CART_STORE': args.cart_store, 'CART_FLUSH_INTERVAL': 0,
+        # Every shopper comes from 127.0.0.1 and the clients deliberately fill the pool; measure the app, not its throttles.
+        'RATE_LIMIT_ENABLED': False, 'ADMISSION_CONTROL': False,
+    })
+    tag = f'load-{time.time_ns()}'
+    seed(app, args, tag)
+
+    server = None
+    if args.http:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        transport = lambda: HttpTransport(base_url)
+    else:
+        transport = lambda: TestClientTransport(app)
+
+    recorder = Recorder()
+    shoppers = [Shopper(transport(), f'{tag}-{i}', random.Random(args.seed * 100003 + i), recorder,
+                        args.products, args.checkout_rate, args.login_rate) for i in range(args.clients)]
+    barrier = threading.Barrier(args.clients + 1)
+    failures = []
+
+    def run(shopper):
+        try:
+            shopper.recording = False
+            shopper.login()
+            for _ in range(args.warmup):
+                shopper.scenario()
+            shopper.recording = True
+            barrier.wait()
+            for _ in range(args.scenarios):
+                shopper.scenario()
+        except threading.BrokenBarrierError:
+            pass
+        except Exception as e:
+            failures.append(repr(e))
+            barrier.abort()
+
+    threads = [threading.Thread(target=run, args=(s,)) for s in shoppers]
+    for t in threads:
+        t.start()
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        sys.exit(f"a client failed during setup: {failures[:1]}")
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+    if failures:
+        print(f"{len(failures)} clients failed, first: {failures[0]}")
+
+    summary = summarize(recorder, elapsed)
+    with app.app_context():
+        summary['orders'] = {status or 'paid': count for status, count in
+                             db.session.query(Order.status, db.func.count(Order.id)).group_by(Order.status)}
+    summary.update({
+        'revision': git_revision(),
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'database': url.split(':', 1)[0],
+        'args': {k: v for k, v in vars(args).items() if k not in ('baseline', 'save_baseline', 'max_regression')},
+    })
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('args') != summary['args']:
+            print(f"note: baseline {args.baseline} was recorded with different arguments")
+    print(f"{args.clients} clients x {args.scenarios} scenarios on {summary['database']}"
+          f"{' over HTTP' if args.http else ''}; orders: {summary['orders']}")
+    print_report(summary, baseline)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+    if args.max_regression is not None and baseline:
+        found = regressions(summary, baseline, args.max_regression)
+        if found:
+            sys.exit("regression: " + '; '.join(found))
+    if failures or summary['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
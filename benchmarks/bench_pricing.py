@@ -0,0 +1,95 @@
+"""Cart totals on large carts: the old per-item float loop versus PricingEngine and SQL SUM.
+
+    python benchmarks/bench_pricing.py --lines 100 1000 10000 --repeat 20
+
+For each cart size a cart of random products is put in cart_item, then the
+total is computed:
+  float-loop  - what cart()/checkout() used to do: one dict per line and a
+                running `total += price * quantity` in floats
+  engine      - the cart lines' integer cents priced with PricingEngine.quote()
+  sql-sum     - SUM(price_cents * quantity) in the database, then PricingEngine.price()
+It prints the time per total and how far the float total drifted from the
+exact one. Runs against a temporary SQLite file (or --database-url).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import func, insert
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from app.models import db, User, Product, CartItem
+from app.pricing import PricingEngine, format_cents
+from seed import seed_catalog
+
+
+def float_loop(rows):
+    items, total = [], 0
+    for product, quantity in rows:
+        items.append({'product': product, 'quantity': quantity, 'subtotal': product.price * quantity})
+        total += product.price * quantity
+    return total
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--lines', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'pricing.db')}"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'EMAIL_DELIVERY': 'external'})
+    engine = PricingEngine()
+    rng = random.Random(0)
+    with app.app_context():
+        db.create_all()
+        if db.session.query(func.count(Product.id)).scalar() < args.products:
+            seed_catalog(args.products)
+        user = User(username=f'bench-{time.time_ns()}', email=f'bench-{time.time_ns()}@example.com',
+                    password=generate_password_hash('pw'))
+        db.session.add(user)
+        db.session.commit()
+        product_ids = [pid for (pid,) in db.session.query(Product.id)]
+
+        print(f"{'lines':>6} {'float-loop':>11} {'engine':>9} {'sql-sum':>9}  {'float drift':>12}")
+        for size in args.lines:
+            CartItem.query.filter_by(user_id=user.id).delete()
+            db.session.execute(insert(CartItem), [{'user_id': user.id, 'product_id': pid, 'quantity': rng.randint(1, 9)}
+                                                  for pid in rng.sample(product_ids, size)])
+            db.session.commit()
+            items = CartItem.query.filter_by(user_id=user.id).all()
+            products = {p.id: p for p in Product.query.filter(Product.id.in_([i.product_id for i in items]))}
+            rows = [(products[i.product_id], i.quantity) for i in items]
+            lines = [(product.price_cents, quantity) for product, quantity in rows]
+
+            float_total, float_ms = timed(lambda: float_loop(rows), args.repeat)
+            quote, engine_ms = timed(lambda: engine.quote(lines), args.repeat)
+            subtotal = (db.session.query(func.sum(Product.price_cents * CartItem.quantity))
+                        .join(CartItem, CartItem.product_id == Product.id)
+                        .filter(CartItem.user_id == user.id))
+            sql_quote, sql_ms = timed(lambda: engine.price(subtotal.scalar()), args.repeat)
+            assert quote == sql_quote
+            drift = float_total - quote.total / 100
+            print(f"{size:>6} {float_ms:9.3f}ms {engine_ms:7.3f}ms {sql_ms:7.3f}ms  {drift:+.2e}  "
+                  f"(exact ${format_cents(quote.total)})")
+
+
+if __name__ == '__main__':
+    main()
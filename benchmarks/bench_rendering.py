@@ -0,0 +1,141 @@
+"""Order confirmation rendering: per-call render_template versus the shared rendering service.
+
+    python benchmarks/bench_rendering.py --orders 200 --lines 5 20 --repeat 3
+
+Orders with --lines items each are put in a temporary SQLite file (or
+--database-url) and loaded once with their items and products. Every order
+then gets what a paid order costs: the confirmation page plus the text and
+HTML email bodies.
+  per-call  - render_template for each of the three, each one looping over
+              the items again (what the app did before app/rendering.py)
+  service   - OrderRenderer: the item lists are rendered once per order and
+              reused by the page and both emails
+  batch     - OrderRenderer.confirmations() on all orders at once, as the
+              email worker does for a claimed batch (emails only)
+It prints confirmations per second for each. The last table compares
+compiling every template in a new app with a cold and a warm Jinja
+bytecode cache.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import render_template
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from app.models import db, User, Product, Order, OrderItem
+from app.queries import orders_with_items
+from app.rendering import OrderRenderer, get_renderer, precompile
+from seed import seed_catalog
+
+# The templates as they were before the item lists were split out.
+LEGACY_ITEMS_HTML = ('{% for item in order.items %}<li class="list-group-item">{{ item.product.name }} '
+                     '(x{{ item.quantity }}) - {{ (item.price_cents * item.quantity)|money }}</li>{% endfor %}')
+LEGACY_ITEMS_TEXT = ('{% for item in order.items %}\n- {{ item.product.name }} (x{{ item.quantity }}) - '
+                     '{{ (item.price_cents * item.quantity)|money }}\n{% endfor %}')
+
+
+def seed_orders(count, lines, products):
+    user = User(username=f'bench{lines}', email=f'bench{lines}@example.com', password=generate_password_hash('pw'))
+    db.session.add(user)
+    db.session.flush()
+    ids = []
+    for n in range(count):
+        order = Order(user_id=user.id, total_amount=0, paid=True, status='paid')
+        db.session.add(order)
+        db.session.flush()
+        db.session.execute(insert(OrderItem), [
+            {'order_id': order.id, 'product_id': (n * lines + i) % products + 1, 'quantity': i % 3 + 1, 'price_cents': 999}
+            for i in range(lines)])
+        ids.append(order.id)
+    db.session.commit()
+    return ids
+
+
+def legacy_templates(app):
+    """Copies of the three templates with the item loops inlined again."""
+    sources = {}
+    for name, block, inline in (('order_confirmation.html', '{{ items_html }}', LEGACY_ITEMS_HTML),
+                                ('order_confirmation_email.html', '{{ items_html }}', LEGACY_ITEMS_HTML),
+                                ('order_confirmation_email.txt', '{{ items_text }}', LEGACY_ITEMS_TEXT)):
+        source = app.jinja_env.loader.get_source(app.jinja_env, name)[0]
+        sources[name] = app.jinja_env.from_string(source.replace(block, inline))
+    return sources
+
+
+def per_call(app, orders, legacy):
+    for order in orders:
+        render_template(legacy['order_confirmation.html'], order=order)
+        render_template(legacy['order_confirmation_email.txt'], order=order)
+        render_template(legacy['order_confirmation_email.html'], order=order)
+
+
+def service(app, orders, legacy):
+    renderer = OrderRenderer(app.jinja_env)
+    for order in orders:
+        render_template('order_confirmation.html', order=order, items_html=renderer.items_html(order))
+        renderer.confirmation(order)
+
+
+def batch(app, orders, legacy):
+    OrderRenderer(app.jinja_env).confirmations(orders)
+
+
+def throughput(fn, app, orders, legacy, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(app, orders, legacy)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(orders) / best
+
+
+def compile_all(url, cache_dir):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'RENDER_PRECOMPILE': False, 'RENDER_BYTECODE_CACHE': cache_dir})
+    start = time.perf_counter()
+    precompile(app.jinja_env)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--lines', type=int, nargs='+', default=[5, 20])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'rendering.db')}"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'RENDER_PRECOMPILE': True, 'RENDER_BYTECODE_CACHE': 'off',
+                      'EMAIL_DELIVERY': 'external', 'SEARCH_WARM': False})
+    products = 500
+    with app.app_context():
+        db.create_all()
+        seed_catalog(products)
+        legacy = legacy_templates(app)
+        print(f"{'lines':>5} {'per-call/s':>11} {'service/s':>10} {'batch/s':>9} {'speedup':>8}")
+        for lines in args.lines:
+            orders = orders_with_items(seed_orders(args.orders, lines, products))
+            with app.test_request_context('/'):
+                rates = [throughput(fn, app, orders, legacy, args.repeat) for fn in (per_call, service, batch)]
+            print(f"{lines:>5} {rates[0]:>11.0f} {rates[1]:>10.0f} {rates[2]:>9.0f} {rates[1] / rates[0]:>7.2f}x")
+            get_renderer(app).forget()
+
+    cache_dir = os.path.join(tmp.name, 'jinja')
+    cold = compile_all(url, cache_dir)
+    warm = compile_all(url, cache_dir)
+    print(f"\ncompile all templates in a new app: no bytecode cache {compile_all(url, 'off'):.1f} ms, "
+          f"cold cache {cold:.1f} ms, warm cache {warm:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
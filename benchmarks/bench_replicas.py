@@ -0,0 +1,130 @@
+"""Read/write splitting: how many statements a browsing-heavy mix leaves on the primary.
+
+    python benchmarks/bench_replicas.py --users 50 --ops 40 --replicas 2
+
+Two or more SQLite files stand in for a primary and its replicas; the
+replicas are copies taken after seeding, refreshed every --replicate-every
+requests the way replication would catch up. Each user, through the Flask
+test client, mostly browses (catalog pages, the product API, cart, order
+history) and now and then adds to the cart, so a share of the reads come
+from clients pinned to the primary by their own writes. The same mix runs
+without replicas and with --replicas of them, and each line shows
+statements per database, the primary's share of all SELECTs, and
+requests per second. The mix replays minutes of traffic in seconds, so
+--sticky-seconds (REPLICA_STICKY_SECONDS) defaults to half a second.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from app import create_app
+from app.models import db, User
+from app.replicas import get_replicas
+from seed import seed_catalog
+
+SORTS = ['id', 'price', '-price', 'name']
+
+
+def replicate(primary, replicas):
+    source = sqlite3.connect(primary)
+    for path in replicas:
+        target = sqlite3.connect(path)
+        source.backup(target)
+        target.close()
+    source.close()
+
+
+def run(directory, replicas, args):
+    primary = os.path.join(directory, 'primary.db')
+    copies = [os.path.join(directory, f'replica{n}.db') for n in range(replicas)]
+    replicate(primary, copies)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{primary}',
+                      'DATABASE_REPLICA_URLS': [f'sqlite:///{path}' for path in copies],
+                      'REPLICA_STICKY_SECONDS': args.sticky_seconds, 'EMAIL_DELIVERY': 'external',
+                      'RATE_LIMIT_ENABLED': False, 'ADMISSION_CONTROL': False, 'SEARCH_WARM': False,
+                      'CATALOG_CACHE_TTL': 0})
+    statements = Counter()
+    with app.app_context():
+        engines = {'primary': db.engine, **get_replicas(app)}
+    for name, engine in engines.items():
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *a, name=name: statements.update(
+                         [(name, statement.lstrip()[:6].upper() == 'SELECT')]))
+    clients = []
+    for i in range(args.users):
+        client = app.test_client()
+        client.post('/login', data={'username': f'bench-{i}', 'password': 'pw'})
+        clients.append(client)
+    statements.clear()
+
+    rng = random.Random(0)
+    requests = 0
+    copying = 0.0
+    start = time.perf_counter()
+    for _ in range(args.ops):
+        for client in clients:
+            roll = rng.random()
+            if roll < args.write_ratio:
+                client.post(f'/add_to_cart/{rng.randint(1, args.products)}', data={'quantity': 1})
+            elif roll < 0.5:
+                client.get('/', query_string={'sort': rng.choice(SORTS)})
+            elif roll < 0.7:
+                client.get('/api/products', query_string={'sort': rng.choice(SORTS)})
+            elif roll < 0.9:
+                client.get('/cart')
+            else:
+                client.get('/orders')
+            requests += 1
+            if copies and requests % args.replicate_every == 0:
+                copy_start = time.perf_counter()
+                replicate(primary, copies)
+                copying += time.perf_counter() - copy_start
+    elapsed = time.perf_counter() - start - copying
+
+    selects = sum(n for (_, is_select), n in statements.items() if is_select)
+    primary_selects = statements[('primary', True)]
+    binds = sorted({bind for bind, _ in statements})
+    per_bind = '  '.join(f"{bind} {statements[(bind, True)] + statements[(bind, False)]:6d}" for bind in binds)
+    print(f"{replicas} replicas: {per_bind}   primary serves {primary_selects / max(selects, 1):5.1%} of SELECTs   "
+          f"{requests / elapsed:6.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--ops', type=int, default=40, help='requests per user')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--write-ratio', type=float, default=0.1, help='share of requests that add to the cart')
+    parser.add_argument('--sticky-seconds', type=float, default=0.5)
+    parser.add_argument('--replicate-every', type=int, default=200, help='requests between replica refreshes')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp.name, 'primary.db')}",
+                      'EMAIL_DELIVERY': 'external', 'SEARCH_WARM': False})
+    with app.app_context():
+        db.create_all()
+        seed_catalog(args.products)
+        password = generate_password_hash('pw')
+        db.session.add_all([User(username=f'bench-{i}', email=f'bench-{i}@example.com', password=password,
+                                 is_verified=True) for i in range(args.users)])
+        db.session.commit()
+        db.engine.dispose()
+    for replicas in sorted({0, args.replicas}):
+        run(tmp.name, replicas, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Product search latency against catalog size: in-process index, SQLite FTS5 and a LIKE scan.
+
+    python benchmarks/bench_search.py --products 1000 10000 50000 --repeat 50
+
+The catalog is grown with seed.seed_catalog in a temporary SQLite file (or
+--database-url). At each size the in-memory index is rebuilt from the table,
+then every query below runs --repeat times through each backend:
+  memory   - app.search.MemorySearch (build time is printed separately)
+  fts      - SEARCH_BACKEND=database, the product_fts table (SQLite only)
+  like     - name/description LIKE '%word%' for every word, what a search
+             without an index would do
+Each line shows the median and p95 milliseconds per query.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import and_, func, or_
+
+from app import create_app
+from app.models import db, Product
+from app.search import DatabaseSearch, MemorySearch, create_search_tables, tokenize
+from seed import seed_catalog
+
+QUERIES = {
+    'word': 'keyboard',
+    'two words': 'wireless mouse',
+    'prefix': 'ergon',
+    'typo': 'headphnes',
+    'sku': '000123',
+}
+
+
+def like_search(query, limit):
+    words = tokenize(query)
+    criteria = [or_(Product.name.ilike(f'%{w}%'), Product.description.ilike(f'%{w}%')) for w in words]
+    return [pid for (pid,) in db.session.query(Product.id).filter(and_(*criteria)).limit(limit)]
+
+
+def timings(fn, query, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(query, 24)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--products', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'search.db')}"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'SEARCH_WARM': False})
+    with app.app_context():
+        db.create_all()
+        fts = db.engine.dialect.name in ('sqlite', 'postgresql')
+        if fts:
+            create_search_tables(db.engine)
+        for size in sorted(args.products):
+            have = db.session.query(func.count(Product.id)).scalar()
+            if have < size:
+                seed_catalog(size - have, seed=have)
+            memory = MemorySearch(app)
+            start = time.perf_counter()
+            memory.build()
+            print(f"\n{size} products: index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+            backends = [('memory', memory.search), ('like', like_search)]
+            if fts:
+                backends.insert(1, ('fts', DatabaseSearch().search))
+            for label, query in QUERIES.items():
+                cells = []
+                for name, fn in backends:
+                    median, p95 = timings(fn, query, args.repeat)
+                    cells.append(f"{name} {median:7.2f} / {p95:7.2f}")
+                print(f"  {label:<10} {query!r:<18} " + '   '.join(cells))
+
+
+if __name__ == '__main__':
+    main()
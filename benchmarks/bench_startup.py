@@ -0,0 +1,106 @@
+"""Cold-start cost of the WSGI entry point: importing run.py and serving the first request.
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --max-import-ms 800 --max-first-request-ms 150
+
+Every run is a fresh interpreter, as on a serverless cold start. The schema is
+created once up front (like `flask init-db` at deploy time) in a temporary
+SQLite file, or use --database-url. With the --max-* options the script exits
+non-zero when the median exceeds the limit, so it can gate CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import run
+imported = time.perf_counter()
+client = run.app.test_client()
+status = client.get('/').status_code
+first = time.perf_counter()
+client.get('/admin/')
+admin = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_request_ms': (first - imported) * 1000,
+                  'first_admin_ms': (admin - first) * 1000, 'status': status}))
+"""
+
+
+def child_env(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url, EMAIL_DELIVERY='external')
+    env.pop('SUPABASE_DATABASE_URL', None)
+    return env
+
+
+def run_once(env):
+    out = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import run'], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            if depth <= 2:
+                rows.append((int(parts[1]) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='show the N slowest top-level imports')
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-first-request-ms', type=float)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'startup.db')}"
+    from app import create_app
+    from app.schema import create_schema
+    with create_app({'SQLALCHEMY_DATABASE_URI': url}).app_context():
+        create_schema()
+
+    env = child_env(url)
+    runs = [run_once(env) for _ in range(args.runs)]
+    if any(r['status'] != 200 for r in runs):
+        sys.exit(f"first request failed: {[r['status'] for r in runs]}")
+
+    print(f"{'metric':<18}{'median':>10}{'p90':>10}{'max':>10}")
+    medians = {}
+    for key in ('import_ms', 'first_request_ms', 'first_admin_ms'):
+        values = sorted(r[key] for r in runs)
+        medians[key] = statistics.median(values)
+        p90 = values[min(len(values) - 1, int(len(values) * 0.9))]
+        print(f"{key:<18}{medians[key]:>10.1f}{p90:>10.1f}{values[-1]:>10.1f}")
+
+    if args.top:
+        print("\nslowest imports (cumulative ms):")
+        for ms, name in slowest_imports(env, args.top):
+            print(f"  {ms:8.1f}  {name}")
+
+    failed = []
+    if args.max_import_ms and medians['import_ms'] > args.max_import_ms:
+        failed.append(f"import {medians['import_ms']:.1f}ms > {args.max_import_ms}ms")
+    if args.max_first_request_ms and medians['first_request_ms'] > args.max_first_request_ms:
+        failed.append(f"first request {medians['first_request_ms']:.1f}ms > {args.max_first_request_ms}ms")
+    if failed:
+        sys.exit("startup regression: " + '; '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
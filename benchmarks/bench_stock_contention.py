@@ -0,0 +1,127 @@
+"""Hammer one hot SKU from many threads and count oversells.
+
+    python benchmarks/bench_stock_contention.py --threads 64 --stock 100
+    python benchmarks/bench_stock_contention.py --database-url postgresql://localhost/bench
+    python benchmarks/bench_stock_contention.py --mode naive   # the old read-modify-write path
+
+Each simulated checkout reserves one unit, waits --payment-ms, then commits or
+(with --failure-rate) releases the hold. A fresh product row is created for
+every run, so pointing it at a shared development database is harmless.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.models import db, Product
+from app.inventory import OutOfStock, reserve, commit_reservation, release_reservation
+
+
+def reservation_checkout(product_id, payment_seconds, failure_rate):
+    try:
+        token = reserve([(product_id, 1)])
+        db.session.commit()
+    except OutOfStock:
+        db.session.rollback()
+        return False
+    time.sleep(payment_seconds)
+    if random.random() < failure_rate:
+        release_reservation(token)
+        db.session.commit()
+        return False
+    committed = commit_reservation(token)
+    db.session.commit()
+    return committed
+
+
+def naive_checkout(product_id, payment_seconds, failure_rate):
+    product = db.session.get(Product, product_id)
+    if product.stock < 1:
+        db.session.rollback()
+        return False
+    time.sleep(payment_seconds)
+    if random.random() < failure_rate:
+        db.session.rollback()
+        return False
+    product.stock -= 1
+    db.session.commit()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--checkouts', type=int, default=20, help='attempts per thread')
+    parser.add_argument('--stock', type=int, default=100)
+    parser.add_argument('--payment-ms', type=float, default=2.0)
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--mode', choices=['reservation', 'naive'], default='reservation')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or f"sqlite:///{os.path.join(tmp.name, 'contention.db')}"
+    options = {'pool_size': args.threads, 'max_overflow': 0}
+    if url.startswith('sqlite'):
+        options['connect_args'] = {'timeout': 60}
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'SQLALCHEMY_ENGINE_OPTIONS': options,
+                      'EMAIL_DELIVERY': 'external'})
+    with app.app_context():
+        db.create_all()
+        product = Product(name='Hot SKU', price=1.0, stock=args.stock)
+        db.session.add(product)
+        db.session.commit()
+        product_id = product.id
+
+    checkout = reservation_checkout if args.mode == 'reservation' else naive_checkout
+    sold, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def worker():
+        won = 0
+        with app.app_context():
+            barrier.wait()
+            for _ in range(args.checkouts):
+                try:
+                    won += checkout(product_id, args.payment_ms / 1000, args.failure_rate)
+                except Exception as e:
+                    db.session.rollback()
+                    with lock:
+                        errors.append(repr(e))
+        with lock:
+            sold.append(won)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        remaining = db.session.get(Product, product_id).stock
+    units_sold = sum(sold)
+    oversold = max(0, units_sold - args.stock) + max(0, -remaining)
+    attempts = args.threads * args.checkouts
+    print(f"mode={args.mode} backend={url.split(':')[0]}")
+    print(f"{attempts} checkout attempts from {args.threads} threads in {elapsed:.2f}s "
+          f"({attempts / elapsed:.0f} attempts/s)")
+    print(f"initial stock {args.stock}, sold {units_sold}, remaining {remaining}, "
+          f"lost units {args.stock - units_sold - remaining}")
+    print(f"oversells: {oversold}  errors: {len(errors)}")
+    if errors:
+        print(f"first error: {errors[0]}")
+    tmp.cleanup()
+    sys.exit(1 if oversold else 0)
+
+
+if __name__ == '__main__':
+    main()
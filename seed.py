@@ -1,35 +1,83 @@
+import argparse
+import random
+
+from sqlalchemy import insert
+
 from app import create_app
-from app.models import db, Product, User
-
-app = create_app()
-
-with app.app_context():
-    db.create_all()
-    if not Product.query.first():
-        products = [
-            Product(
-                name='Wireless Mouse', price=25.99, stock=20, description='A smooth and responsive wireless mouse.',
-                image_url='https://images.unsplash.com/photo-1517336714731-489689fd1ca8?auto=format&fit=crop&w=400&q=80'
-            ),
-            Product(
-                name='Mechanical Keyboard', price=79.99, stock=15, description='RGB backlit mechanical keyboard.',
-                image_url='https://images.unsplash.com/photo-1519389950473-47ba0277781c?auto=format&fit=crop&w=400&q=80'
-            ),
-            Product(
-                name='USB-C Charger', price=18.50, stock=30, description='Fast charging USB-C wall charger.',
-                image_url='https://images.unsplash.com/photo-1519125323398-675f0ddb6308?auto=format&fit=crop&w=400&q=80'
-            ),
-            Product(
-                name='Noise Cancelling Headphones', price=129.99, stock=10, description='Over-ear headphones with active noise cancellation.',
-                image_url='https://images.unsplash.com/photo-1517841905240-472988babdf9?auto=format&fit=crop&w=400&q=80'
-            ),
-            Product(
-                name='Webcam 1080p', price=49.99, stock=25, description='Full HD webcam for video calls and streaming.',
-                image_url='https://images.unsplash.com/photo-1515378791036-0648a3ef77b2?auto=format&fit=crop&w=400&q=80'
-            )
-        ]
-        db.session.add_all(products)
+from app.models import db, Product
+from app.schema import create_schema
+
+SAMPLE_PRODUCTS = [
+    dict(
+        name='Wireless Mouse', price=25.99, stock=20, description='A smooth and responsive wireless mouse.',
+        image_url='https://images.unsplash.com/photo-1517336714731-489689fd1ca8?auto=format&fit=crop&w=400&q=80'
+    ),
+    dict(
+        name='Mechanical Keyboard', price=79.99, stock=15, description='RGB backlit mechanical keyboard.',
+        image_url='https://images.unsplash.com/photo-1519389950473-47ba0277781c?auto=format&fit=crop&w=400&q=80'
+    ),
+    dict(
+        name='USB-C Charger', price=18.50, stock=30, description='Fast charging USB-C wall charger.',
+        image_url='https://images.unsplash.com/photo-1519125323398-675f0ddb6308?auto=format&fit=crop&w=400&q=80'
+    ),
+    dict(
+        name='Noise Cancelling Headphones', price=129.99, stock=10, description='Over-ear headphones with active noise cancellation.',
+        image_url='https://images.unsplash.com/photo-1517841905240-472988babdf9?auto=format&fit=crop&w=400&q=80'
+    ),
+    dict(
+        name='Webcam 1080p', price=49.99, stock=25, description='Full HD webcam for video calls and streaming.',
+        image_url='https://images.unsplash.com/photo-1515378791036-0648a3ef77b2?auto=format&fit=crop&w=400&q=80'
+    ),
+]
+
+ADJECTIVES = ['Compact', 'Wireless', 'Ergonomic', 'Portable', 'Rugged', 'Smart', 'Premium', 'Slim', 'Pro', 'Eco']
+NOUNS = ['Mouse', 'Keyboard', 'Charger', 'Headphones', 'Webcam', 'Monitor', 'Speaker', 'Cable', 'Hub', 'Stand',
+         'Microphone', 'Router', 'Lamp', 'Tablet', 'Drive']
+
+
+def seed_sample_products():
+    if Product.query.first():
+        print('Products already exist. No changes made.')
+        return
+    db.session.add_all([Product(**product) for product in SAMPLE_PRODUCTS])
+    db.session.commit()
+    print('Sample products added!')
+
+
+def seed_catalog(count, stock=1000, batch_size=5000, seed=0):
+    """Bulk-insert `count` synthetic products, e.g. for load tests and benchmarks."""
+    rng = random.Random(seed)
+    for start in range(0, count, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, count)):
+            name = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i:06d}'
+            rows.append({
+                'name': name,
+                'price_cents': rng.randint(100, 50000),
+                'stock': stock,
+                'description': f'Synthetic catalog item {name}.',
+                'image_url': None,
+            })
+        db.session.execute(insert(Product), rows)
         db.session.commit()
-        print('Sample products added!')
-    else:
-        print('Products already exist. No changes made.')
\ No newline at end of file
+    print(f'Added {count} synthetic products.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Populate the database.')
+    parser.add_argument('--products', type=int, default=0,
+                        help='add this many synthetic products instead of the sample catalog')
+    parser.add_argument('--stock', type=int, default=1000, help='stock for each synthetic product')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        create_schema()
+        if args.products:
+            seed_catalog(args.products, stock=args.stock)
+        else:
+            seed_sample_products()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import pytest
+from app import create_app
+from app.models import db
+from app.schema import create_schema
+
+# Test modules describe their app with two fixtures and get `app` and
+# `make_app` from here:
+#   app_config - config on top of TESTING and an in-memory database
+#   seed       - a function that adds the module's rows; it runs in the app
+#                context and is committed afterwards
+# A test that needs other settings calls make_app(**config) itself.
+
+@pytest.fixture
+def app_config():
+    return {}
+
+@pytest.fixture
+def seed():
+    return lambda: None
+
+@pytest.fixture
+def make_app(app_config, seed):
+    default_seed = seed
+    def make_app(seed=None, **config):
+        app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', **app_config, **config})
+        with app.app_context():
+            create_schema()
+            (seed or default_seed)()
+            db.session.commit()
+        return app
+    return make_app
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
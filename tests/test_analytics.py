@@ -0,0 +1,107 @@
+import re
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from app.analytics import rebuild_rollups
+from app.models import db, User, Product, CartItem, Order, OrderItem, DailySales, ProductSales, StockAlert
+from app.payments import get_payment_pool
+
+@pytest.fixture
+def app_config():
+    return {'EMAIL_DELIVERY': 'external', 'LOW_STOCK_THRESHOLD': 3}
+
+@pytest.fixture
+def seed():
+    def seed():
+        password = generate_password_hash('pw')
+        db.session.add(User(username='buyer', email='buyer@example.com', password=password, is_verified=True))
+        db.session.add(User(username='boss', email='boss@example.com', password=password,
+                            is_verified=True, is_admin=True))
+        db.session.add_all([Product(name='Lamp', price=10.0, stock=5), Product(name='Rug', price=2.5, stock=50)])
+    return seed
+
+def login(app, username='buyer'):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'pw'})
+    return client
+
+def buy(app, client, *lines):
+    with app.app_context():
+        db.session.add_all([CartItem(user_id=1, product_id=pid, quantity=qty) for pid, qty in lines])
+        db.session.commit()
+    key = re.search(rb'name="payment_key" value="([0-9a-f]+)"', client.get('/checkout').data).group(1).decode()
+    return client.post('/checkout', data={'wallet_number': '1234567890', 'payment_details': 'x', 'payment_key': key})
+
+def rollups(app):
+    with app.app_context():
+        return ({d.day: (d.orders, d.units, d.revenue_cents) for d in DailySales.query},
+                {p.product_id: (p.name, p.orders, p.units, p.revenue_cents) for p in ProductSales.query},
+                {a.product_id: a.stock for a in StockAlert.query})
+
+def test_checkout_updates_rollups_and_alerts(app):
+    client = login(app)
+    buy(app, client, (1, 2), (2, 4))
+    buy(app, client, (1, 1))
+    daily, products, alerts = rollups(app)
+    assert daily == {datetime.utcnow().date(): (2, 7, 4000)}
+    assert products == {1: ('Lamp', 2, 3, 3000), 2: ('Rug', 1, 4, 1000)}
+    assert alerts == {1: 2}
+
+def test_restock_clears_alert(app):
+    buy(app, login(app), (1, 3))
+    assert rollups(app)[2] == {1: 2}
+    with app.app_context():
+        db.session.get(Product, 1).stock = 20
+        db.session.commit()
+    assert rollups(app)[2] == {}
+
+def test_failed_and_async_payments(make_app):
+    app = make_app(MOCK_PAYMENT_SUCCESS_RATE=0)
+    buy(app, login(app), (1, 1))
+    assert rollups(app)[:2] == ({}, {})
+    app = make_app(PAYMENT_MODE='async')
+    buy(app, login(app), (2, 2))
+    get_payment_pool(app).wait()
+    assert rollups(app)[1] == {2: ('Rug', 1, 2, 500)}
+
+def test_bulk_orders_are_recorded(app):
+    client = login(app, 'boss')
+    client.post('/api/bulk_orders', json={'orders': [{'lines': [{'product_id': 2, 'quantity': 3}]},
+                                                     {'lines': [{'product_id': 2, 'quantity': 1}]}]})
+    assert rollups(app)[1] == {2: ('Rug', 2, 4, 1000)}
+
+def test_rebuild_matches_incremental_and_skips_unsold_orders(app):
+    client = login(app)
+    buy(app, client, (1, 1), (2, 2))
+    login(app, 'boss').post('/api/bulk_orders', json={'orders': [{'lines': [{'product_id': 2, 'quantity': 3}]}]})
+    with app.app_context():
+        for status, key in (('failed', 'checkout:1:a'), ('pending', 'checkout:1:b')):
+            order = Order(user_id=1, total_amount=10.0, status=status, idempotency_key=key,
+                          created_at=datetime(2020, 1, 1))
+            db.session.add(order)
+            db.session.flush()
+            db.session.add(OrderItem(order_id=order.id, product_id=1, quantity=1, price=10.0))
+        db.session.commit()
+    before = rollups(app)
+    with app.app_context():
+        assert rebuild_rollups(batch_size=1) == 4
+        db.session.commit()
+    assert rollups(app) == before
+    result = app.test_cli_runner().invoke(args=['rebuild-analytics'])
+    assert result.exit_code == 0 and rollups(app) == before
+
+def test_dashboard_reads_only_rollups(app):
+    buy(app, login(app), (1, 4))
+    client = login(app, 'boss')
+    client.get('/admin/sales/')
+    with app.app_context():
+        engine = db.engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    rv = client.get('/admin/sales/')
+    event.remove(engine, 'before_cursor_execute', listener)
+    assert rv.status_code == 200 and b'Lamp' in rv.data and b'$40.00' in rv.data
+    assert [s for s in statements if re.search(r'(FROM|JOIN) ("order"|order_item|product)\b', s)] == []
@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from app.auth import PasswordHasher, UserCache, get_password_hasher, get_user_cache
+from app.models import db, User
+
+@pytest.fixture
+def app_config():
+    return {'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'}
+
+@pytest.fixture
+def seed():
+    return lambda: db.session.add(User(username='alice', email='alice@example.com',
+                                       password=generate_password_hash('pw', method='pbkdf2:sha256:1000'),
+                                       is_verified=True))
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'alice', 'password': 'pw'})
+    return client
+
+def user_queries(app, fn):
+    with app.app_context():
+        engine = db.engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return [s for s in statements if 'FROM user' in s]
+
+def test_cached_user_skips_the_user_query(app, client):
+    assert len(user_queries(app, lambda: client.get('/'))) == 1
+    assert user_queries(app, lambda: client.get('/')) == []
+    responses = []
+    assert user_queries(app, lambda: responses.append(client.get('/cart'))) == []
+    assert responses[0].status_code == 200
+
+def test_user_changes_invalidate_the_cache(app, client):
+    client.get('/')
+    with app.app_context():
+        db.session.get(User, 1).is_admin = True
+        db.session.commit()
+    assert len(user_queries(app, lambda: client.get('/'))) == 1
+    with app.app_context():
+        assert get_user_cache(app).load(1).is_admin
+
+def test_cache_entries_expire(app):
+    now = [0.0]
+    cache = UserCache(ttl=10, clock=lambda: now[0])
+    with app.app_context():
+        cache.load(1)
+        db.session.remove()
+        assert user_queries(app, lambda: cache.load(1)) == []
+        now[0] = 11
+        assert len(user_queries(app, lambda: cache.load(1))) == 1
+
+def test_busy_hasher_returns_503(app):
+    hasher = get_password_hasher(app)
+    hasher.queue_timeout = 0
+    while hasher._slots.acquire(blocking=False):
+        pass
+    rv = app.test_client().post('/login', data={'username': 'alice', 'password': 'pw'})
+    assert rv.status_code == 503
+
+def test_login_rehashes_when_the_method_changes(app):
+    get_password_hasher(app).method = 'pbkdf2:sha256:2000'
+    rv = app.test_client().post('/login', data={'username': 'alice', 'password': 'pw'})
+    assert rv.status_code == 302
+    with app.app_context():
+        assert db.session.get(User, 1).password.startswith('pbkdf2:sha256:2000$')
+    assert app.test_client().post('/login', data={'username': 'alice', 'password': 'pw'}).status_code == 302
+
+def test_process_pool_hashes_and_verifies():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1)
+    try:
+        pwhash = hasher.hash('secret')
+        assert hasher.verify(pwhash, 'secret')
+        assert not hasher.verify(pwhash, 'wrong')
+        assert not hasher.needs_rehash(pwhash)
+    finally:
+        hasher.shutdown()
+
+def test_shorthand_method_does_not_rehash_every_login(app):
+    hasher = get_password_hasher(app)
+    hasher.method = 'pbkdf2:sha256'
+    client = app.test_client()
+    client.post('/login', data={'username': 'alice', 'password': 'pw'})
+    with app.app_context():
+        pwhash = db.session.get(User, 1).password
+    assert pwhash.startswith('pbkdf2:sha256:') and not hasher.needs_rehash(pwhash)
+    client.post('/login', data={'username': 'alice', 'password': 'pw'})
+    with app.app_context():
+        assert db.session.get(User, 1).password == pwhash
@@ -0,0 +1,110 @@
+import pytest
+from sqlalchemy import event, insert
+from werkzeug.security import generate_password_hash
+from app import bulk_orders
+from app.models import db, User, Product, Order, OrderItem, EmailOutbox
+
+@pytest.fixture
+def app_config():
+    return {'EMAIL_DELIVERY': 'external'}
+
+@pytest.fixture
+def seed():
+    def seed():
+        db.session.add(User(username='wholesale', email='b2b@example.com',
+                            password=generate_password_hash('pw'), is_verified=True, is_wholesale=True))
+        db.session.add_all([Product(name=f'SKU{i}', price=2.5, stock=10) for i in range(1, 6)])
+    return seed
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'wholesale', 'password': 'pw'})
+    return client
+
+def order(*lines, reference=None):
+    return {'reference': reference, 'lines': [{'product_id': p, 'quantity': q} for p, q in lines]}
+
+def test_mixed_request_returns_per_order_results(app, client):
+    rv = client.post('/api/bulk_orders', json={'orders': [
+        order((1, 4), (2, 1), (1, 1), reference='PO-1'),
+        order((99, 1), reference='PO-2'),
+        order((3, 11), reference='PO-3'),
+        {'reference': 'PO-4', 'lines': [{'product_id': 1, 'quantity': 0}]},
+        order((3, 10), reference='PO-5'),
+    ]})
+    data = rv.get_json()
+    assert rv.status_code == 200
+    assert [r['status'] for r in data['orders']] == ['created', 'rejected', 'rejected', 'rejected', 'created']
+    assert data['orders'][0]['total_amount'] == 15.0
+    assert data['orders'][1]['product_ids'] == [99]
+    assert data['orders'][2]['error'] == 'out_of_stock'
+    with app.app_context():
+        assert {p.id: p.stock for p in Product.query} == {1: 5, 2: 9, 3: 0, 4: 10, 5: 10}
+        assert [o.status for o in Order.query] == ['invoiced', 'invoiced']
+        assert OrderItem.query.count() == 4
+        assert EmailOutbox.query.count() == 2
+
+def test_replayed_request_id_does_not_duplicate(app, client):
+    body = {'request_id': 'batch-42', 'orders': [order((1, 2)), order((2, 2))]}
+    first = client.post('/api/bulk_orders', json=body).get_json()
+    second = client.post('/api/bulk_orders', json=body).get_json()
+    assert [r['order_id'] for r in first['orders']] == [r['order_id'] for r in second['orders']]
+    assert all(r.get('replayed') for r in second['orders'])
+    with app.app_context():
+        assert Order.query.count() == 2
+        assert db.session.get(Product, 1).stock == 8
+
+def test_concurrent_replay_returns_the_winners_orders(make_app, tmp_path, monkeypatch):
+    app = make_app(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'bulk.db'}")
+    with app.app_context():
+        engine = db.engine
+    client = app.test_client()
+    client.post('/login', data={'username': 'wholesale', 'password': 'pw'})
+    take_stock = bulk_orders._take_stock
+    def racing(orders, results):
+        # The other submit commits its order after this one's replay lookup came back empty.
+        with engine.begin() as conn:
+            conn.execute(insert(Order).values(user_id=1, total_cents=500, idempotency_key='bulk:1:batch-7:0'))
+        monkeypatch.setattr(bulk_orders, '_take_stock', take_stock)
+        return take_stock(orders, results)
+    monkeypatch.setattr(bulk_orders, '_take_stock', racing)
+    rv = client.post('/api/bulk_orders', json={'request_id': 'batch-7', 'orders': [order((1, 2))]})
+    assert rv.status_code == 200
+    assert rv.get_json()['orders'][0] == {'index': 0, 'reference': None, 'status': 'created',
+                                          'order_id': 1, 'replayed': True}
+    with app.app_context():
+        assert Order.query.count() == 1
+        assert db.session.get(Product, 1).stock == 10
+        assert EmailOutbox.query.count() == 0
+
+def test_customers_without_a_wholesale_account_are_refused(app):
+    with app.app_context():
+        db.session.add(User(username='joe', email='joe@example.com', password=generate_password_hash('pw'),
+                            is_verified=True))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'joe', 'password': 'pw'})
+    rv = client.post('/api/bulk_orders', json={'orders': [order((1, 10))]})
+    assert rv.status_code == 403
+    with app.app_context():
+        assert Order.query.count() == 0
+        assert db.session.get(Product, 1).stock == 10
+
+def test_bad_payload(client):
+    assert client.post('/api/bulk_orders', json={'orders': []}).status_code == 400
+    assert client.post('/api/bulk_orders', data='nope').status_code == 400
+
+def test_statement_count_does_not_grow_with_orders(app, client):
+    with app.app_context():
+        engine = db.engine
+    client.get('/')  # load current_user into the user cache first
+    counts = []
+    for size in (2, 40):
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', listener)
+        client.post('/api/bulk_orders', json={'orders': [order((1 + i % 5, 1)) for i in range(size)]})
+        event.remove(engine, 'before_cursor_execute', listener)
+        counts.append(len(statements))
+    assert counts[0] == counts[1]
@@ -0,0 +1,146 @@
+import threading
+import time
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Product, CartItem, Order
+from app.cart_store import Cart, CartLine, KVCartStore, LocalKV, get_cart_store
+
+@pytest.fixture
+def app_config(request):
+    return {'CART_STORE': getattr(request, 'param', 'memory'), 'CART_FLUSH_INTERVAL': 0}
+
+@pytest.fixture
+def seed():
+    def seed():
+        db.session.add(User(username='carter', email='carter@example.com',
+                            password=generate_password_hash('pw'), is_verified=True))
+        db.session.add_all([Product(name='Mug', price=4.0, stock=10), Product(name='Tray', price=12.5, stock=10)])
+    return seed
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'carter', 'password': 'pw'})
+    return client
+
+def statements_during(app, fn):
+    with app.app_context():
+        engine = db.engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return [s for s in statements if 'FROM user' not in s]
+
+def cart_rows(app):
+    with app.app_context():
+        return sorted((c.product_id, c.quantity) for c in CartItem.query)
+
+def test_cart_total_is_kept_incrementally():
+    cart = Cart([CartLine(1, 'Mug', 400, 2)])
+    cart.add(2, 1, 'Tray', 1250)
+    cart.add(1, 1)
+    assert (cart.total_cents, cart.count) == (2450, 4)
+    cart.reprice(1, 'Mug', 500, 0)
+    cart.remove(2)
+    assert cart.total_cents == 1500
+    assert Cart.from_json(cart.to_json()).total_cents == 1500
+    # Carts stored before prices were cents
+    legacy = Cart.from_json('{"total": 0.3, "lines": [[1, "Mug", 0.1, 3, 5.0]]}')
+    assert (legacy.total_cents, legacy.lines[1].priced_at) == (30, 0.0)
+
+@pytest.mark.parametrize('app_config', ['sql', 'memory'], indirect=True)
+def test_adding_a_missing_product_is_not_found(app, client):
+    assert client.post('/add_to_cart/999', data={'quantity': 1}).status_code == 404
+    assert client.post('/add_to_cart/1', data={'quantity': 1}).status_code == 302
+    with app.app_context():
+        assert [(line.product_id, line.quantity) for line in get_cart_store(app).get(1)] == [(1, 1)]
+
+def test_cart_changes_do_not_write_to_the_database(app, client):
+    client.post('/add_to_cart/1', data={'quantity': 2})
+    assert statements_during(app, lambda: client.post('/add_to_cart/1', data={'quantity': 1})) == []
+    assert statements_during(app, lambda: client.post('/remove_from_cart/2')) == []
+    rv = client.get('/cart')
+    assert b'Mug' in rv.data and b'$12.00' in rv.data
+    assert statements_during(app, lambda: client.get('/cart')) == []
+    assert client.post('/add_to_cart/99').status_code == 404
+    assert cart_rows(app) == []
+
+def test_flush_persists_and_a_fresh_store_reads_through(app, client):
+    client.post('/add_to_cart/1', data={'quantity': 2})
+    client.post('/add_to_cart/2', data={'quantity': 1})
+    store = get_cart_store(app)
+    with app.app_context():
+        assert store.flush() == 1
+        assert store.flush() == 0
+    assert cart_rows(app) == [(1, 2), (2, 1)]
+    store.client = LocalKV()  # as after a restart
+    rv = client.get('/cart')
+    assert b'Tray' in rv.data and b'$20.50' in rv.data
+
+def test_flush_does_not_resurrect_a_cart_checked_out_meanwhile(app, client):
+    client.post('/add_to_cart/1', data={'quantity': 2})
+    with app.app_context():
+        get_cart_store(app).flush()
+    client.post('/add_to_cart/2', data={'quantity': 1})
+    store = get_cart_store(app)
+    mget = store.client.mget
+    def checkout_after_snapshot(keys):
+        values = mget(keys)
+        if keys == ['cart:1']:
+            store.clear(1)
+        return values
+    store.client.mget = checkout_after_snapshot
+    with app.app_context():
+        assert store.flush() == 0
+        db.session.commit()
+        assert not store.get(1)
+    assert cart_rows(app) == []
+
+def test_concurrent_adds_are_not_lost(app, client):
+    client.post('/add_to_cart/1', data={'quantity': 1})
+    store = get_cart_store(app)
+    get = store.client.get
+    def slow_get(key):
+        value = get(key)
+        time.sleep(0.001)  # let another thread in between reading and writing the cart
+        return value
+    store.client.get = slow_get
+    def add_many():
+        for _ in range(50):
+            store.add(1, 1, 1)
+    threads = [threading.Thread(target=add_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        assert store.get(1).lines[1].quantity == 401
+
+def test_price_change_reprices_cart(app, client):
+    client.post('/add_to_cart/1', data={'quantity': 3})
+    with app.app_context():
+        db.session.get(Product, 1).price = 5.0
+        db.session.commit()
+    with app.app_context():
+        assert get_cart_store(app).get(1).total_cents == 1500
+        # Another worker's store, sharing the key-value server, sees the change too.
+        db.session.get(Product, 1).price = 6.0
+        db.session.commit()
+        assert KVCartStore(get_cart_store(app).client).get(1).total_cents == 1800
+
+def test_checkout_consumes_the_cart(app, client):
+    client.post('/add_to_cart/2', data={'quantity': 2})
+    with app.app_context():
+        get_cart_store(app).flush()
+    rv = client.post('/checkout', data={'wallet_number': '1234567890', 'payment_details': 'x'})
+    assert rv.status_code == 302
+    with app.app_context():
+        assert Order.query.one().total_amount == 25.0
+        assert db.session.get(Product, 2).stock == 8
+        assert not get_cart_store(app).get(1)
+    assert cart_rows(app) == []
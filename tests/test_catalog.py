@@ -0,0 +1,80 @@
+import base64
+import json
+import pytest
+from sqlalchemy import event
+from app.models import db, Product
+from app.inventory import reserve
+
+@pytest.fixture
+def app_config():
+    return {'CATALOG_PAGE_SIZE': 4}
+
+@pytest.fixture
+def seed():
+    return lambda: db.session.add_all([
+        Product(name=f'Item {i:02d}', price=float(i % 3), stock=5, description='x')
+        for i in range(10)
+    ])
+
+@pytest.fixture
+def statements(app):
+    executed = []
+    with app.app_context():
+        engine = db.engine
+    listener = lambda conn, cursor, statement, *args: executed.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', listener)
+
+def walk(client, sort):
+    ids, after = [], None
+    while True:
+        query = {'sort': sort, 'after': after} if after else {'sort': sort}
+        data = client.get('/api/products', query_string=query).get_json()
+        ids.extend(p['id'] for p in data['products'])
+        after = data['next']
+        if not after:
+            return ids
+
+@pytest.mark.parametrize('sort, key', [
+    ('id', lambda p: p.id),
+    ('price', lambda p: (p.price, p.id)),
+    ('-price', lambda p: (-p.price, -p.id)),
+    ('name', lambda p: (p.name, p.id)),
+])
+def test_keyset_pages_cover_catalog_in_order(app, sort, key):
+    with app.app_context():
+        expected = [p.id for p in sorted(Product.query.all(), key=key)]
+    assert walk(app.test_client(), sort) == expected
+
+def test_invalid_cursor(app):
+    client = app.test_client()
+    assert client.get('/api/products?after=!!!').status_code == 400
+    assert client.get('/?after=!!!').status_code == 302
+    for sort, key in [('id', ['1']), ('id', [True]), ('price', [1.5, 2]), ('price', [{}, 2]),
+                      ('name', [3, 2]), ('name', ['Item 01', 'x']), ('-name', [None, None])]:
+        after = base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+        assert client.get('/api/products', query_string={'sort': sort, 'after': after}).status_code == 400
+
+def test_cached_page_skips_database_until_stock_changes(app, statements):
+    client = app.test_client()
+    assert b'Item 00' in client.get('/').data
+    statements.clear()
+    assert b'Item 00' in client.get('/').data
+    assert statements == []
+
+    with app.app_context():
+        reserve([(1, 5)])
+        db.session.commit()
+    page = client.get('/').data
+    assert statements
+    assert b'Out of Stock' in page
+
+def test_orm_product_edit_invalidates(app):
+    client = app.test_client()
+    client.get('/api/products')
+    with app.app_context():
+        db.session.get(Product, 1).name = 'Renamed'
+        db.session.commit()
+    names = [p['name'] for p in client.get('/api/products').get_json()['products']]
+    assert 'Renamed' in names
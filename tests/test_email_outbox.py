@@ -0,0 +1,68 @@
+import pytest
+from app.models import db, User, Order, EmailOutbox
+from app.email_outbox import enqueue_order_confirmation, EmailWorkerPool
+from app.email_utils import get_mail
+from app.smtp_sink import LocalSMTPSink
+
+@pytest.fixture
+def app_config():
+    return {
+        'EMAIL_DELIVERY': 'external',
+        'EMAIL_MAX_ATTEMPTS': 2,
+        'EMAIL_RETRY_BACKOFF': 0,
+    }
+
+@pytest.fixture
+def seed():
+    def seed():
+        user = User(username='buyer', email='buyer@example.com', password='x', is_verified=True)
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Order(user_id=user.id, total_amount=12.5, paid=True))
+    return seed
+
+def queue_orders(app, count):
+    with app.app_context():
+        order = Order.query.first()
+        for _ in range(count):
+            enqueue_order_confirmation('buyer@example.com', order)
+        db.session.commit()
+
+def statuses(app):
+    with app.app_context():
+        return [m.status for m in EmailOutbox.query.order_by(EmailOutbox.id)]
+
+def test_enqueue_does_not_send_until_drained(app):
+    mail = get_mail(app)
+    with mail.record_messages() as outbox:
+        queue_orders(app, 3)
+        assert outbox == []
+        assert statuses(app) == ['pending'] * 3
+        assert app.extensions['email_outbox'].drain() == 3
+    assert [m.subject for m in outbox] == ['Order Confirmation'] * 3
+    assert statuses(app) == ['sent'] * 3
+
+def test_failed_sends_retry_then_dead_letter(app):
+    state = get_mail(app)
+    state.suppress = False
+    state.server, state.port = '127.0.0.1', 1
+    queue_orders(app, 1)
+    pool = app.extensions['email_outbox']
+    pool.drain()
+    assert statuses(app) == ['dead']
+    with app.app_context():
+        message = EmailOutbox.query.one()
+        assert message.attempts == 2
+        assert message.last_error
+
+def test_batch_is_sent_over_one_smtp_connection(app):
+    with LocalSMTPSink() as sink:
+        state = get_mail(app)
+        state.suppress, state.use_tls = False, False
+        state.server, state.port = sink.host, sink.port
+        queue_orders(app, 5)
+        pool = EmailWorkerPool(app, batch_size=10)
+        assert pool.drain() == 5
+    assert len(sink.messages) == 5
+    assert sink.connections == 1
+    assert statuses(app) == ['sent'] * 5
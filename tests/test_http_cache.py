@@ -0,0 +1,106 @@
+import re
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from flask import template_rendered
+from werkzeug.http import http_date
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Product, Order, OrderItem
+from app.payments import FAILED
+
+@pytest.fixture
+def app_config():
+    return {'HTTP_SHARED_MAX_AGE': 120}
+
+@pytest.fixture
+def seed():
+    def seed():
+        db.session.add(User(username='buyer', email='buyer@example.com', password=generate_password_hash('pw'),
+                            is_verified=True))
+        db.session.add_all([Product(name='Lamp', price=10.0, stock=5), Product(name='Rug', price=2.5, stock=50)])
+        db.session.flush()
+        order = Order(user_id=1, total_amount=10.0, status='pending', created_at=datetime(2024, 1, 1),
+                      updated_at=datetime(2024, 1, 1))
+        db.session.add(order)
+        db.session.flush()
+        db.session.add(OrderItem(order_id=order.id, product_id=1, quantity=1, price=10.0))
+    return seed
+
+@contextmanager
+def rendered(app):
+    templates = []
+    listener = lambda sender, template, context, **extra: templates.append(template.name)
+    template_rendered.connect(listener, app)
+    try:
+        yield templates
+    finally:
+        template_rendered.disconnect(listener, app)
+
+def login(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'buyer', 'password': 'pw'})
+    return client
+
+def test_anonymous_catalog_is_public_and_revalidates_without_rendering(app):
+    client = app.test_client()
+    rv = client.get('/')
+    assert rv.status_code == 200 and rv.headers['ETag'] and rv.headers['Last-Modified']
+    assert rv.cache_control.public and rv.cache_control.s_maxage == 120 and rv.cache_control.max_age == 0
+    assert 'Cookie' in rv.vary and 'Set-Cookie' not in rv.headers
+    with rendered(app) as templates:
+        again = client.get('/', headers={'If-None-Match': rv.headers['ETag']})
+        by_date = client.get('/', headers={'If-Modified-Since': rv.headers['Last-Modified']})
+    assert (again.status_code, by_date.status_code, again.data, templates) == (304, 304, b'', [])
+    assert client.get('/?sort=price', headers={'If-None-Match': rv.headers['ETag']}).status_code == 200
+    with app.app_context():
+        db.session.get(Product, 1).name = 'Desk lamp'
+        db.session.commit()
+    changed = client.get('/', headers={'If-None-Match': rv.headers['ETag']})
+    assert changed.status_code == 200 and b'Desk lamp' in changed.data
+
+def test_signed_in_pages_are_private(app):
+    anonymous = app.test_client().get('/')
+    client = login(app)
+    rv = client.get('/')
+    assert rv.cache_control.private and rv.cache_control.no_cache and not rv.cache_control.public
+    assert rv.headers['ETag'] != anonymous.headers['ETag']
+    assert client.get('/', headers={'If-None-Match': anonymous.headers['ETag']}).status_code == 200
+
+def test_cart_etag_follows_contents_and_flashes_are_not_cached(app):
+    client = login(app)
+    client.post('/add_to_cart/1')
+    assert 'no-store' in client.get('/').headers['Cache-Control']  # shows the flashed message
+    rv = client.get('/cart')
+    etag = rv.headers['ETag']
+    with rendered(app) as templates:
+        assert client.get('/cart', headers={'If-None-Match': etag}).status_code == 304
+    assert templates == []
+    client.post('/add_to_cart/2')
+    client.get('/')
+    rv = client.get('/cart', headers={'If-None-Match': etag})
+    assert rv.status_code == 200 and b'Rug' in rv.data
+
+def test_order_confirmation_tracks_status(app):
+    client = login(app)
+    rv = client.get('/order_confirmation/1')
+    assert rv.status_code == 200 and rv.headers['Last-Modified'] == http_date(datetime(2024, 1, 1))
+    etag = rv.headers['ETag']
+    assert client.get('/order_confirmation/1', headers={'If-None-Match': etag}).status_code == 304
+    with app.app_context():
+        Order.query.filter_by(id=1).update({'status': FAILED})
+        db.session.commit()
+        assert db.session.get(Order, 1).updated_at > datetime.utcnow() - timedelta(minutes=1)
+    assert client.get('/order_confirmation/1', headers={'If-None-Match': etag}).status_code == 200
+    assert client.get('/order_confirmation/1', headers={'If-Modified-Since': http_date(datetime(2024, 1, 2))}).status_code == 200
+    assert client.get('/order_confirmation/2').status_code == 404
+
+def test_static_urls_are_fingerprinted(app):
+    client = app.test_client()
+    url = re.search(r'href="(/static/favicon\.ico\?v=[0-9a-f]+)"', client.get('/').get_data(as_text=True)).group(1)
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.cache_control.immutable and rv.cache_control.max_age == 365 * 24 * 3600
+    assert not client.get('/static/favicon.ico?v=stale').cache_control.immutable
+    rv = client.get('/favicon.ico')
+    assert rv.status_code == 200 and rv.cache_control.max_age == 24 * 3600
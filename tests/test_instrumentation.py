@@ -0,0 +1,69 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+from flask import g
+from sqlalchemy import create_engine
+from app import engine_options
+from app.models import db, Product
+from app.instrumentation import RequestStats, TimedQueuePool
+
+@pytest.fixture
+def seed():
+    return lambda: db.session.add(Product(name='Gauge', price=3.0, stock=1))
+
+def test_engine_options_from_environment():
+    env = {'DB_POOL_SIZE': '12', 'DB_MAX_OVERFLOW': '3', 'DB_POOL_RECYCLE': '300',
+           'DB_POOL_PRE_PING': 'false', 'DB_STATEMENT_TIMEOUT_MS': '5000'}
+    options = engine_options('postgresql://u:p@db/app', env)
+    assert options['poolclass'] is TimedQueuePool
+    assert (options['pool_size'], options['max_overflow'], options['pool_recycle']) == (12, 3, 300)
+    assert options['pool_pre_ping'] is False
+    assert options['connect_args'] == {'options': '-c statement_timeout=5000'}
+    assert engine_options('sqlite:///local.db', env) == {}
+
+def test_metrics_endpoint_reports_queries_per_endpoint(app):
+    client = app.test_client()
+    client.get('/')
+    client.get('/api/products?sort=price')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'app_http_requests_total{endpoint="main.index",method="GET",status="200"} 1' in text
+    assert 'app_db_queries_total{endpoint="main.api_products"} 1' in text
+    assert '# TYPE app_db_query_seconds_total counter' in text
+
+def test_metrics_are_local_only(app):
+    client = app.test_client()
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.9'}).status_code == 404
+    app.config['METRICS_ALLOW_REMOTE'] = True
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.9'}).status_code == 200
+
+def test_request_log_line_is_json(app, caplog):
+    with caplog.at_level(logging.INFO, logger='app.requests'):
+        rv = app.test_client().get('/')
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record['event'] == 'request'
+    assert record['endpoint'] == 'main.index'
+    assert record['db_queries'] == 1
+    assert 'db;dur=' in rv.headers['Server-Timing']
+
+def test_slow_queries_are_sampled(make_app):
+    # The threshold is read when the engine is instrumented, so it has to be set up front.
+    app = make_app(DB_SLOW_QUERY_MS=1e-6)
+    client = app.test_client()
+    client.get('/')
+    samples = client.get('/metrics/slow_queries').get_json()
+    assert samples['main.index'][0]['statement'].startswith('SELECT')
+
+def test_pool_wait_is_charged_to_request(app, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=TimedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=5)
+    held = engine.connect()
+    threading.Timer(0.2, held.close).start()
+    with app.test_request_context():
+        g._db_stats = RequestStats()
+        start = time.perf_counter()
+        engine.connect().close()
+        assert g._db_stats.pool_wait_seconds >= 0.15
+        assert g._db_stats.pool_wait_seconds <= time.perf_counter() - start
@@ -0,0 +1,86 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from app.models import db, Product, StockReservation
+from app.inventory import (OutOfStock, reserve, commit_reservation, release_reservation,
+                           release_expired)
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'stock.db'}"}
+
+@pytest.fixture
+def seed():
+    return lambda: db.session.add_all([
+        Product(name='Hot', price=5.0, stock=3),
+        Product(name='Cold', price=7.0, stock=10),
+    ])
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        yield app
+
+def stock():
+    db.session.expire_all()
+    return {p.name: p.stock for p in Product.query.order_by(Product.id)}
+
+def test_reserve_and_commit(app):
+    token = reserve([(1, 2), (2, 1), (2, 1)])
+    db.session.commit()
+    assert stock() == {'Hot': 1, 'Cold': 8}
+    assert commit_reservation(token)
+    db.session.commit()
+    assert {r.status for r in StockReservation.query} == {'committed'}
+    assert not commit_reservation(token)
+
+def test_shortfall_leaves_stock_untouched(app):
+    with pytest.raises(OutOfStock) as exc:
+        reserve([(1, 4), (2, 1)])
+    assert exc.value.product_ids == [1]
+    db.session.commit()
+    assert stock() == {'Hot': 3, 'Cold': 10}
+    assert StockReservation.query.count() == 0
+
+def test_release_is_idempotent(app):
+    token = reserve([(1, 3)])
+    db.session.commit()
+    assert release_reservation(token) == {1: 3}
+    assert release_reservation(token) == {}
+    db.session.commit()
+    assert stock() == {'Hot': 3, 'Cold': 10}
+    assert not commit_reservation(token)
+
+def test_expired_holds_return_to_stock(app):
+    token = reserve([(1, 2)], ttl=60)
+    db.session.commit()
+    assert release_expired() == {}
+    assert release_expired(now=datetime.utcnow() + timedelta(seconds=61)) == {1: 2}
+    db.session.commit()
+    assert stock()['Hot'] == 3
+    assert not commit_reservation(token)
+
+def test_concurrent_reservations_never_oversell(app):
+    wins = []
+    barrier = threading.Barrier(8)
+
+    def buyer():
+        with app.app_context():
+            barrier.wait()
+            for _ in range(3):
+                try:
+                    token = reserve([(1, 1)])
+                    db.session.commit()
+                    wins.append(token)
+                except OutOfStock:
+                    db.session.rollback()
+
+    threads = [threading.Thread(target=buyer) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(wins) == 3
+    assert stock()['Hot'] == 0
@@ -0,0 +1,96 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Product, Order, OrderItem
+
+START = datetime(2024, 1, 1)
+
+@pytest.fixture
+def app_config():
+    return {'ORDER_HISTORY_PAGE_SIZE': 4, 'ORDER_EXPORT_BATCH': 3}
+
+@pytest.fixture
+def seed():
+    def seed():
+        password = generate_password_hash('pw')
+        db.session.add_all([
+            User(username='buyer', email='buyer@example.com', password=password, is_verified=True),
+            User(username='other', email='other@example.com', password=password, is_verified=True),
+            User(username='boss', email='boss@example.com', password=password, is_verified=True, is_admin=True),
+        ])
+        db.session.add_all([Product(name='Mug', price=4.0, stock=10), Product(name='Tray', price=12.5, stock=10)])
+        db.session.flush()
+        # Two orders share each timestamp so the id tiebreaker matters.
+        for i in range(10):
+            order = Order(user_id=1 if i != 5 else 2, created_at=START + timedelta(days=i // 2),
+                          total_amount=16.5, paid=True, status='paid')
+            db.session.add(order)
+            db.session.flush()
+            db.session.add_all([OrderItem(order_id=order.id, product_id=1, quantity=1, price=4.0),
+                                OrderItem(order_id=order.id, product_id=2, quantity=1, price=12.5)])
+    return seed
+
+def login(app, username):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'pw'})
+    return client
+
+def walk(client):
+    ids, before, pages = [], None, 0
+    while True:
+        data = client.get('/api/orders', query_string={'before': before} if before else {}).get_json()
+        ids.extend(o['id'] for o in data['orders'])
+        pages += 1
+        before = data['next']
+        if not before:
+            return ids, pages
+
+def test_history_pages_cover_own_orders_newest_first(app):
+    ids, pages = walk(login(app, 'buyer'))
+    with app.app_context():
+        expected = [o.id for o in Order.query.filter_by(user_id=1).order_by(Order.created_at.desc(), Order.id.desc())]
+    assert ids == expected and len(ids) == 9
+    assert pages == 3
+    assert walk(login(app, 'other'))[0] == [6]
+
+def test_history_page_statement_count_is_fixed(app):
+    client = login(app, 'buyer')
+    client.get('/orders')
+    with app.app_context():
+        engine = db.engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    rv = client.get('/orders')
+    event.remove(engine, 'before_cursor_execute', listener)
+    assert rv.status_code == 200 and b'Tray' in rv.data and b'Older orders' in rv.data
+    assert len(statements) == 2
+
+def test_invalid_cursor(app):
+    client = login(app, 'buyer')
+    assert client.get('/api/orders?before=!!!').status_code == 400
+    assert client.get('/orders?before=!!!').status_code == 302
+
+def test_export_streams_csv_and_ndjson(app):
+    client = login(app, 'boss')
+    assert b'Export orders' in client.get('/admin/order_export/').data
+    rv = client.get('/admin/order_export/orders.csv')
+    assert rv.status_code == 200 and rv.mimetype == 'text/csv'
+    assert rv.is_streamed
+    rows = list(csv.DictReader(io.StringIO(rv.get_data(as_text=True))))
+    assert len(rows) == 20
+    assert rows[0]['email'] == 'buyer@example.com' and rows[1]['product_name'] == 'Tray'
+    rv = client.get('/admin/order_export/orders.ndjson', query_string={'start': '2024-01-02', 'end': '2024-01-04', 'user_id': 1})
+    lines = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+    assert {line['order_id'] for line in lines} == {3, 4, 5}
+    assert client.get('/admin/order_export/orders.xml').status_code == 404
+    assert client.get('/admin/order_export/orders.csv?start=nope').status_code == 400
+
+def test_export_requires_admin(app):
+    rv = login(app, 'buyer').get('/admin/order_export/orders.csv')
+    assert rv.status_code == 302 and '/login' in rv.headers['Location']
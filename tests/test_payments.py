@@ -0,0 +1,203 @@
+import re
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+from app import create_app
+from app.models import db, User, Product, CartItem, Order, PaymentAttempt, EmailOutbox
+from app.payment_gateway import MockGateway, CircuitBreaker, GatewayTimeout
+from app.inventory import OutOfStock
+from app.payments import get_payment_service, get_payment_pool
+
+@pytest.fixture
+def app_config():
+    return {'EMAIL_DELIVERY': 'external'}
+
+@pytest.fixture
+def seed():
+    def seed():
+        db.session.add(User(username='payer', email='payer@example.com',
+                            password=generate_password_hash('pw'), is_verified=True))
+        db.session.add(Product(name='Kettle', price=20.0, stock=5))
+        db.session.flush()
+        db.session.add(CartItem(user_id=1, product_id=1, quantity=2))
+    return seed
+
+def login(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'payer', 'password': 'pw'})
+    return client
+
+def checkout_form(client):
+    key = re.search(rb'name="payment_key" value="([0-9a-f]+)"', client.get('/checkout').data).group(1).decode()
+    return {'wallet_number': '1234567890', 'payment_details': 'x', 'payment_key': key}
+
+def stock(app):
+    with app.app_context():
+        return db.session.get(Product, 1).stock
+
+def test_mock_gateway_replays_by_key_and_times_out():
+    gateway = MockGateway(success_rate=0.5)
+    first = gateway.authorize(10, 'key-1', '1234567890', 'x', timeout=1)
+    again = gateway.authorize(10, 'key-1', '1234567890', 'x', timeout=1)
+    assert (again.approved, again.reference, again.replayed) == (first.approved, first.reference, True)
+    assert len(gateway.charges) == 1
+    assert not gateway.authorize(10, 'key-2', '123', 'x', timeout=1).approved
+    with pytest.raises(GatewayTimeout):
+        MockGateway(latency=0.05).authorize(10, 'key-3', '1234567890', 'x', timeout=0.01)
+
+def test_circuit_breaker_opens_and_recovers():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+    now[0] = 11
+    assert breaker.allow()        # one trial call
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    now[0] = 22
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+def test_resubmitted_checkout_charges_once(app):
+    client = login(app)
+    form = checkout_form(client)
+    first = client.post('/checkout', data=form)
+    with app.app_context():
+        db.session.add(CartItem(user_id=1, product_id=1, quantity=1))
+        db.session.commit()
+    second = client.post('/checkout', data=form)
+    assert first.status_code == second.status_code == 302
+    assert first.headers['Location'] == second.headers['Location']
+    with app.app_context():
+        order = Order.query.one()
+        assert (order.status, order.paid) == ('paid', True)
+        assert PaymentAttempt.query.one().status == 'approved'
+    assert len(get_payment_service(app).gateway.charges) == 1
+    assert stock(app) == 3
+
+def test_declined_payment_releases_stock_and_issues_new_key(make_app):
+    app = make_app(MOCK_PAYMENT_SUCCESS_RATE=0)
+    client = login(app)
+    form = checkout_form(client)
+    rv = client.post('/checkout', data=form)
+    assert b'Payment failed' in rv.data
+    assert form['payment_key'].encode() not in rv.data
+    assert stock(app) == 5
+    with app.app_context():
+        assert Order.query.count() == 0
+        assert PaymentAttempt.query.one().status == 'declined'
+
+def test_timeout_can_be_retried_with_the_same_key(make_app):
+    app = make_app(MOCK_PAYMENT_LATENCY_MS=50, PAYMENT_TIMEOUT=0.01)
+    client = login(app)
+    form = checkout_form(client)
+    rv = client.post('/checkout', data=form)
+    assert b'not responding' in rv.data
+    assert form['payment_key'].encode() in rv.data
+    assert stock(app) == 5
+    gateway = get_payment_service(app).gateway
+    gateway.latency = 0
+    assert client.post('/checkout', data=form).status_code == 302
+    with app.app_context():
+        assert PaymentAttempt.query.one().attempts == 2
+        assert Order.query.one().paid
+
+def test_open_circuit_skips_the_gateway(make_app):
+    app = make_app(PAYMENT_CIRCUIT_FAILURES=1, MOCK_PAYMENT_LATENCY_MS=50, PAYMENT_TIMEOUT=0.01)
+    client = login(app)
+    client.post('/checkout', data=checkout_form(client))
+    service = get_payment_service(app)
+    assert service.breaker.state == 'open'
+    service.gateway.latency = 0
+    rv = client.post('/checkout', data=checkout_form(client))
+    assert b'not responding' in rv.data
+    assert service.gateway.charges == {}
+    with app.app_context():
+        assert [a.error for a in PaymentAttempt.query.order_by(PaymentAttempt.id)][-1] == 'circuit_open'
+
+def test_async_checkout_moves_order_from_pending_to_paid(app):
+    app.config['PAYMENT_MODE'] = 'async'
+    service = get_payment_service(app)
+    service.gateway.latency = 0.2
+    client = login(app)
+    rv = client.post('/checkout', data=checkout_form(client))
+    assert rv.status_code == 302
+    order_id = int(rv.headers['Location'].rsplit('/', 1)[1])
+    assert client.get(f'/api/orders/{order_id}/status').get_json()['status'] == 'pending'
+    get_payment_pool(app).wait()
+    assert client.get(f'/api/orders/{order_id}/status').get_json()['status'] == 'paid'
+    with app.app_context():
+        assert CartItem.query.count() == 0
+        assert EmailOutbox.query.count() == 1
+    assert stock(app) == 3
+
+def test_async_checkout_failure_restores_cart_and_stock(make_app):
+    app = make_app(PAYMENT_MODE='async', MOCK_PAYMENT_SUCCESS_RATE=0)
+    client = login(app)
+    client.post('/checkout', data=checkout_form(client))
+    get_payment_pool(app).wait()
+    with app.app_context():
+        assert Order.query.one().status == 'failed'
+        assert [(c.product_id, c.quantity) for c in CartItem.query] == [(1, 2)]
+    assert stock(app) == 5
+
+def sell_out_during_payment(monkeypatch, module):
+    # The hold expires while the charge is in flight and someone else buys the stock.
+    monkeypatch.setattr(module, 'commit_reservation', lambda token: False)
+    def decrement_stock(quantities):
+        raise OutOfStock(quantities)
+    monkeypatch.setattr(module, 'decrement_stock', decrement_stock)
+
+def test_charge_for_sold_out_checkout_is_refunded(app, monkeypatch):
+    import app.routes as routes
+    sell_out_during_payment(monkeypatch, routes)
+    client = login(app)
+    rv = client.post('/checkout', data=checkout_form(client), follow_redirects=True)
+    assert b'Your payment has been refunded' in rv.data
+    gateway = get_payment_service(app).gateway
+    assert list(gateway.refunds) == list(gateway.charges)
+    with app.app_context():
+        assert Order.query.count() == 0
+        assert PaymentAttempt.query.one().status == 'refunded'
+
+def test_async_order_that_sold_out_is_refunded_or_left_refund_due(app, monkeypatch):
+    import app.payments as payments
+    sell_out_during_payment(monkeypatch, payments)
+    app.config['PAYMENT_MODE'] = 'async'
+    gateway = get_payment_service(app).gateway
+    def refund_fails(*args):
+        raise GatewayTimeout('no answer')
+    monkeypatch.setattr(gateway, 'refund', refund_fails)
+    client = login(app)
+    client.post('/checkout', data=checkout_form(client))
+    get_payment_pool(app).wait()
+    with app.app_context():
+        assert Order.query.one().status == 'failed'
+        assert PaymentAttempt.query.one().status == 'refund_due'
+    monkeypatch.undo()
+    result = app.test_cli_runner().invoke(args=['retry-refunds'])
+    assert 'Refunded 1 payments; 0 still due.' in result.output
+    with app.app_context():
+        assert PaymentAttempt.query.one().status == 'refunded'
+    assert len(gateway.refunds) == 1
+
+def test_init_db_adds_unique_idempotency_index(tmp_path):
+    url = f"sqlite:///{tmp_path / 'legacy.db'}"
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        # "order" as it was before idempotency keys
+        conn.execute(text('CREATE TABLE "order" (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, created_at DATETIME, '
+                          'total_cents INTEGER NOT NULL, paid BOOLEAN)'))
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': url})
+    assert app.test_cli_runner().invoke(args=['init-db']).exit_code == 0
+    indexes = {index['name']: index for index in inspect(engine).get_indexes('order')}
+    assert indexes['ux_order_idempotency_key']['unique']
+    with engine.begin() as conn:
+        conn.execute(text('INSERT INTO "order" (user_id, total_cents, idempotency_key) VALUES (1, 100, \'k\')'))
+        with pytest.raises(IntegrityError):
+            conn.execute(text('INSERT INTO "order" (user_id, total_cents, idempotency_key) VALUES (1, 100, \'k\')'))
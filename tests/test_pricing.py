@@ -0,0 +1,91 @@
+import re
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from werkzeug.security import generate_password_hash
+from app import create_app
+from app.models import db, User, Product, CartItem, Order, OrderItem
+from app.pricing import PercentDiscount, PricingEngine, format_cents, to_cents
+
+@pytest.fixture
+def app_config():
+    return {'EMAIL_DELIVERY': 'external'}
+
+@pytest.fixture
+def seed():
+    def seed():
+        db.session.add(User(username='buyer', email='buyer@example.com',
+                            password=generate_password_hash('pw'), is_verified=True))
+        db.session.add_all([Product(name='Pin', price=0.1, stock=1000), Product(name='Lamp', price=19.99, stock=10)])
+    return seed
+
+def checkout(app, *lines):
+    with app.app_context():
+        db.session.add_all([CartItem(user_id=1, product_id=pid, quantity=qty) for pid, qty in lines])
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'buyer', 'password': 'pw'})
+    page = client.get('/checkout').data
+    key = re.search(rb'name="payment_key" value="([0-9a-f]+)"', page).group(1).decode()
+    client.post('/checkout', data={'wallet_number': '1234567890', 'payment_details': 'x', 'payment_key': key})
+    return page
+
+def test_conversions():
+    assert [to_cents(v) for v in (0.1, 19.99, '2.675', 1.005, 0)] == [10, 1999, 268, 101, 0]
+    assert [format_cents(c) for c in (0, 5, 1999, -250)] == ['0.00', '0.05', '19.99', '-2.50']
+
+def test_engine_applies_discount_then_tax_rounding_half_up():
+    engine = PricingEngine([PercentDiscount(10, min_subtotal=5000)], tax_rate='8.25')
+    assert engine.quote([(1999, 2), (10, 3)]) == (4028, 0, 332, 4360)
+    assert engine.quote([(1999, 3)]) == (5997, 600, 445, 5842)
+    assert PricingEngine().quote([]) == (0, 0, 0, 0)
+
+def test_totals_are_exact_in_cents(app):
+    checkout(app, (1, 3), (2, 1))
+    with app.app_context():
+        order = Order.query.one()
+        # 0.1 * 3 + 19.99 in floats is 20.290000000000003
+        assert (order.total_cents, order.total_amount) == (2029, 20.29)
+        assert sorted(i.price_cents for i in order.items) == [10, 1999]
+
+def test_checkout_charges_discount_and_tax(make_app):
+    app = make_app(TAX_RATE='10', DISCOUNT_PERCENT='5', DISCOUNT_MIN_SUBTOTAL_CENTS=3000)
+    page = checkout(app, (2, 2))
+    assert b'Discount: -$2.00' in page and b'Tax: $3.80' in page and b'Total: $41.78' in page
+    with app.app_context():
+        order = Order.query.one()
+        assert (order.total_cents, order.discount_cents, order.tax_cents) == (4178, 200, 380)
+        db.session.get(User, 1).is_wholesale = True
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'buyer', 'password': 'pw'})
+    data = client.post('/api/bulk_orders', json={'orders': [{'lines': [{'product_id': 1, 'quantity': 5}]}]}).get_json()
+    assert data['orders'][0]['total_cents'] == 55
+
+def test_init_db_migrates_float_columns(tmp_path):
+    url = f"sqlite:///{tmp_path / 'legacy.db'}"
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE product (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, '
+                          'price FLOAT NOT NULL, stock INTEGER NOT NULL, description TEXT, image_url VARCHAR(300))'))
+        conn.execute(text('CREATE INDEX ix_product_price_id ON product (price, id)'))
+        conn.execute(text('CREATE TABLE "order" (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, created_at DATETIME, '
+                          'total_amount FLOAT NOT NULL, paid BOOLEAN)'))
+        conn.execute(text('CREATE TABLE order_item (id INTEGER PRIMARY KEY, order_id INTEGER NOT NULL, '
+                          'product_id INTEGER NOT NULL, quantity INTEGER NOT NULL, price FLOAT NOT NULL)'))
+        conn.execute(text("INSERT INTO product (name, price, stock) VALUES ('Lamp', 19.99, 3), ('Pin', 0.29, 9)"))
+        conn.execute(text('INSERT INTO "order" (user_id, total_amount, paid) VALUES (1, 20.28, 1)'))
+        conn.execute(text('INSERT INTO order_item (order_id, product_id, quantity, price) VALUES (1, 1, 1, 19.99), (1, 2, 1, 0.29)'))
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': url})
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['init-db']).exit_code == 0
+    assert runner.invoke(args=['init-db']).exit_code == 0
+    columns = {c['name'] for c in inspect(engine).get_columns('product')}
+    assert 'price' not in columns and 'price_cents' in columns
+    with app.app_context():
+        assert [p.price_cents for p in Product.query.order_by(Product.id)] == [1999, 29]
+        assert Order.query.one().total_cents == 2028
+        assert sorted(i.price_cents for i in OrderItem.query) == [29, 1999]
+        db.session.add(Product(name='New', price=5, stock=1))
+        db.session.commit()
+        assert [p.name for p in Product.query.order_by(Product.price_cents)] == ['Pin', 'New', 'Lamp']
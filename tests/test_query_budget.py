@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from app.models import db, User, Product, CartItem, Order
+
+# Per-request SQL statement budgets. Each endpoint must stay within its budget
+# and issue the same number of statements whatever the cart size, so an N+1
+# lazy load slipping back into a view or template fails here.
+BUDGETS = {
+    'cart': 4,
+    'checkout_get': 4,
+    'checkout_post': 26,
+    'order_confirmation': 4,
+}
+CART_SIZES = [1, 8, 25]
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+
+def make_client(make_app, cart_size):
+    def seed():
+        user = User(username='shopper', email='shopper@example.com',
+                    password=generate_password_hash('pw'), is_verified=True)
+        db.session.add(user)
+        db.session.add_all([Product(name=f'P{i}', price=1.5, stock=100) for i in range(cart_size)])
+        db.session.flush()
+        db.session.add_all([CartItem(user_id=user.id, product_id=i + 1, quantity=2) for i in range(cart_size)])
+    app = make_app(seed=seed)
+    with app.app_context():
+        engine = db.engine
+    client = app.test_client()
+    client.post('/login', data={'username': 'shopper', 'password': 'pw'})
+    return app, client, engine
+
+def measure(make_app, cart_size):
+    app, client, engine = make_client(make_app, cart_size)
+    counts = {}
+    with count_queries(engine) as statements:
+        assert client.get('/cart').status_code == 200
+    counts['cart'] = len(statements)
+    with count_queries(engine) as statements:
+        assert client.get('/checkout').status_code == 200
+    counts['checkout_get'] = len(statements)
+    with count_queries(engine) as statements:
+        rv = client.post('/checkout', data={'wallet_number': '1234567890', 'payment_details': 'x'})
+        assert rv.status_code == 302
+    counts['checkout_post'] = len(statements)
+    with app.app_context():
+        order_id = Order.query.one().id
+    with count_queries(engine) as statements:
+        rv = client.get(f'/order_confirmation/{order_id}')
+        assert rv.status_code == 200
+        assert rv.data.count(b'(x2)') == cart_size
+    counts['order_confirmation'] = len(statements)
+    return counts
+
+def test_statement_budgets_are_flat_in_cart_size(make_app):
+    by_size = {size: measure(make_app, size) for size in CART_SIZES}
+    for endpoint, budget in BUDGETS.items():
+        counts = {size: by_size[size][endpoint] for size in CART_SIZES}
+        assert max(counts.values()) <= budget, f'{endpoint} over budget: {counts}'
+        assert len(set(counts.values())) == 1, f'{endpoint} grows with cart size: {counts}'
@@ -0,0 +1,103 @@
+import json
+import pytest
+from sqlalchemy import event
+from app.models import db, User, Product, Order, OrderItem, EmailOutbox
+from app.email_outbox import EmailWorkerPool, enqueue_order_confirmation
+from app.email_utils import get_mail
+from app.inventory import decrement_stock
+from app.rendering import ITEMS_HTML, get_renderer
+
+@pytest.fixture
+def app_config():
+    return {'EMAIL_DELIVERY': 'external', 'RENDER_BYTECODE_CACHE': 'off'}
+
+@pytest.fixture
+def seed():
+    def seed():
+        user = User(username='buyer', email='buyer@example.com', password='x', is_verified=True)
+        lamp = Product(name='Lamp <LED>', price=10.0, stock=50)
+        mug = Product(name='Mug', price=2.5, stock=50)
+        db.session.add_all([user, lamp, mug])
+        db.session.flush()
+        for quantity in (1, 2, 3):
+            order = Order(user_id=user.id, total_amount=12.5 * quantity, paid=True)
+            db.session.add(order)
+            db.session.flush()
+            db.session.add_all([OrderItem(order_id=order.id, product_id=lamp.id, quantity=quantity, price=10.0),
+                                OrderItem(order_id=order.id, product_id=mug.id, quantity=1, price=2.5)])
+    return seed
+
+def count_item_renders(renderer):
+    calls = []
+    template = renderer.template
+    def counting(name):
+        if name == ITEMS_HTML:
+            calls.append(name)
+        return template(name)
+    renderer.template = counting
+    return calls
+
+def test_page_and_emails_share_the_item_list(app):
+    renderer = get_renderer(app)
+    calls = count_item_renders(renderer)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+    page = client.get('/order_confirmation/2').get_data(as_text=True)
+    with get_mail(app).record_messages() as outbox:
+        with app.app_context():
+            enqueue_order_confirmation('buyer@example.com', db.session.get(Order, 2))
+            db.session.commit()
+        app.extensions['email_outbox'].drain()
+    message = outbox[0]
+    assert calls == [ITEMS_HTML]
+    assert 'Lamp &lt;LED&gt; (x2) - $20.00' in page and 'Lamp &lt;LED&gt; (x2) - $20.00' in message.html
+    assert '- Lamp <LED> (x2) - $20.00' in message.body and '- Mug (x1) - $2.50' in message.body
+
+def test_batch_loads_orders_once(app):
+    with app.app_context():
+        for order_id in (1, 2, 3, 2, 99):
+            db.session.add(EmailOutbox(kind='order_confirmation', recipient='buyer@example.com',
+                                       payload=json.dumps({'order_id': order_id}), status='pending'))
+        db.session.commit()
+        engine = db.engine
+    calls = count_item_renders(get_renderer(app))
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    with get_mail(app).record_messages() as outbox:
+        assert EmailWorkerPool(app, batch_size=10).drain() == 4
+    event.remove(engine, 'before_cursor_execute', listener)
+    assert len(calls) == 3
+    assert len([s for s in statements if s.lstrip().startswith('SELECT') and 'FROM "order"' in s]) == 1
+    assert ['(x3)' in m.body for m in outbox] == [False, False, True, False]
+    with app.app_context():
+        dead = EmailOutbox.query.filter_by(status='dead').one()
+        assert 'order 99 no longer exists' in dead.last_error
+
+def test_checkout_of_another_order_keeps_cached_lists(app):
+    renderer = get_renderer(app)
+    calls = count_item_renders(renderer)
+    with app.app_context():
+        for order_id in (1, 2):
+            renderer.items_html(db.session.get(Order, order_id))
+        decrement_stock({2: 1})
+        db.session.get(Product, 1).name = 'Desk Lamp'
+        db.session.commit()
+        assert 'Lamp &lt;LED&gt; (x1)' in renderer.items_html(db.session.get(Order, 1))
+        assert 'Lamp &lt;LED&gt; (x2)' in renderer.items_html(db.session.get(Order, 2))
+    assert calls == [ITEMS_HTML, ITEMS_HTML]
+
+def test_templates_are_precompiled_into_the_bytecode_cache(make_app, tmp_path):
+    app = make_app(RENDER_PRECOMPILE=True, RENDER_BYTECODE_CACHE=str(tmp_path / 'jinja'))
+    cached = list((tmp_path / 'jinja').iterdir())
+    assert len(cached) == len(app.jinja_env.list_templates(filter_func=lambda name: not name.startswith('admin/')))
+    # A second process loads the compiled code instead of parsing the sources.
+    parsed = []
+    fresh = make_app(RENDER_PRECOMPILE=True, RENDER_BYTECODE_CACHE=str(tmp_path / 'jinja'))
+    original = fresh.jinja_env._parse
+    fresh.jinja_env._parse = lambda *args: parsed.append(args) or original(*args)
+    fresh.jinja_env.cache.clear()
+    with fresh.app_context():
+        get_renderer(fresh).confirmation(db.session.get(Order, 1))
+    assert parsed == []
@@ -0,0 +1,121 @@
+import sqlite3
+import time
+import pytest
+from sqlalchemy import event, select, update
+from werkzeug.security import generate_password_hash
+from app import create_app
+from app.instrumentation import get_metrics
+from app.models import db, User, Product, Order, OrderItem
+from app.replicas import REPLICA_KEY, STICKY_KEY, get_replicas
+
+def replicate(tmp_path):
+    """Copy the primary file over the replica, standing in for replication catching up."""
+    source, target = sqlite3.connect(tmp_path / 'primary.db'), sqlite3.connect(tmp_path / 'replica.db')
+    source.backup(target)
+    source.close()
+    target.close()
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'primary.db'}",
+            'EMAIL_DELIVERY': 'external', 'CATALOG_CACHE_TTL': 0}
+
+@pytest.fixture
+def seed():
+    def seed():
+        db.session.add(User(username='ann', email='ann@example.com', password=generate_password_hash('pw'), is_verified=True))
+        db.session.add(Product(name='Lamp', price=10.0, stock=5))
+    return seed
+
+@pytest.fixture
+def app(make_app, app_config, tmp_path):
+    seeder = make_app()
+    with seeder.app_context():
+        db.engine.dispose()
+    replicate(tmp_path)
+    # Started after seeding, as a worker would be: its catalog cache has seen no product change.
+    yield create_app({'TESTING': True, **app_config, 'DATABASE_REPLICA_URLS': [f"sqlite:///{tmp_path / 'replica.db'}"]})
+
+def bind_statements(app):
+    """Record (bind, statement) for every statement either database runs."""
+    seen = []
+    with app.app_context():
+        engines = {'primary': db.engine, **get_replicas(app)}
+    for name, engine in engines.items():
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args, name=name: seen.append((name, statement)))
+    return seen
+
+def login(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'ann', 'password': 'pw'})
+    return client
+
+def test_read_endpoints_use_the_replica(app):
+    with app.app_context(), db.engine.begin() as conn:
+        # Written by another process: nothing here knows the replica is behind.
+        conn.execute(update(Product).values(name='Desk Lamp'))
+    seen = bind_statements(app)
+    page = app.test_client().get('/').get_data(as_text=True)
+    assert 'Lamp' in page and 'Desk Lamp' not in page
+    assert {bind for bind, _ in seen} == {'replica0'}
+    assert app.test_client().get('/api/products').get_json()['products'][0]['name'] == 'Lamp'
+    counters = {labels: n for (name, labels), n in get_metrics(app).counters.items() if name == 'app_db_bind_queries_total'}
+    assert set(counters) == {(('bind', 'replica0'),)}
+
+def test_catalog_is_not_cached_from_a_lagging_replica(app):
+    cache = app.extensions['catalog_cache']
+    cache.ttl = 60
+    with app.app_context():
+        db.session.get(Product, 1).name = 'Desk Lamp'
+        db.session.commit()
+    seen = bind_statements(app)
+    assert app.test_client().get('/api/products').get_json()['products'][0]['name'] == 'Desk Lamp'
+    assert 'Desk Lamp' in app.test_client().get('/').get_data(as_text=True)
+    assert {bind for bind, _ in seen} == {'primary'}
+    # Once the replica has had time to catch up, cache misses read from it again.
+    cache.invalidate()
+    app.config['REPLICA_STICKY_SECONDS'] = 0
+    app.test_client().get('/api/products')
+    assert seen[-1][0] == 'replica0'
+
+def test_client_reads_its_own_writes(app):
+    client = login(app)
+    assert client.post('/add_to_cart/1', data={'quantity': 2}).status_code == 302
+    # The replica has not seen the cart line, but this client is pinned to the primary.
+    assert 'Lamp' in client.get('/cart').get_data(as_text=True)
+    with client.session_transaction() as session:
+        assert session[STICKY_KEY] > time.time()
+        session[STICKY_KEY] = time.time() - 1
+    seen = bind_statements(app)
+    assert 'Lamp' not in client.get('/cart').get_data(as_text=True)
+    assert {bind for bind, _ in seen} == {'replica0'}
+
+def test_order_missing_on_replica_is_read_from_primary(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+    with app.app_context():
+        order = Order(user_id=1, total_amount=10.0, paid=True, status='paid')
+        db.session.add(order)
+        db.session.flush()
+        db.session.add(OrderItem(order_id=order.id, product_id=1, quantity=1, price=10.0))
+        db.session.commit()
+    rv = client.get('/order_confirmation/1')
+    assert rv.status_code == 200 and 'Lamp (x1)' in rv.get_data(as_text=True)
+    assert client.get('/order_confirmation/2').status_code == 404
+
+def test_writes_and_locking_reads_go_to_the_primary(app):
+    seen = bind_statements(app)
+    with app.test_request_context('/'):
+        db.session.info[REPLICA_KEY] = get_replicas(app)['replica0']
+        db.session.execute(select(Product.id)).all()
+        db.session.execute(select(Product.id).with_for_update()).all()
+        assert [bind for bind, _ in seen[-2:]] == ['replica0', 'primary']
+        db.session.get(Product, 1).stock = 4
+        db.session.flush()
+        assert db.session.execute(select(Product.stock)).scalar() == 4
+        assert REPLICA_KEY not in db.session.info
+        db.session.commit()
+        assert db.session.info.pop('committed_write')
+    assert {bind for bind, statement in seen if statement.startswith('UPDATE')} == {'primary'}
@@ -0,0 +1,107 @@
+import pytest
+from sqlalchemy import event, text
+from app.models import db, Product
+from app.search import SearchIndex, get_search, tokenize, within_one_edit
+
+PRODUCTS = [
+    ('Wireless Mouse', 'A smooth and responsive mouse.', 20),
+    ('Mechanical Keyboard', 'RGB backlit keyboard with wireless mode.', 15),
+    ('USB-C Charger', 'Fast charging wall charger.', 0),
+    ('Noise Cancelling Headphones', 'Over-ear headphones.', 10),
+    ('Café Crème Mug', 'Ceramic mug.', 5),
+]
+
+@pytest.fixture
+def seed():
+    return lambda: db.session.add_all([Product(name=n, description=d, price=5.0, stock=s) for n, d, s in PRODUCTS])
+
+def names(client, query):
+    return [p['name'] for p in client.get('/api/search', query_string={'q': query}).get_json()['products']]
+
+def test_tokenize_and_edit_distance():
+    assert tokenize('Café Crème, USB-C!') == ['cafe', 'creme', 'usb', 'c']
+    assert [within_one_edit('mouse', t) for t in ('mouse', 'mose', 'mousse', 'muose', 'house', 'moose', 'mice')] == [
+        True, True, True, True, True, True, False]
+
+def test_index_ranks_and_matches_every_word():
+    index = SearchIndex()
+    for pid, (name, description, stock) in enumerate(PRODUCTS, 1):
+        index.add(pid, name, description, stock)
+    assert index.search('wireless') == [1, 2]       # name beats description
+    assert index.search('keyb') == [2]              # prefix
+    assert index.search('keybaord') == [2]          # transposition
+    assert index.search('wireless mouse') == [1]
+    assert index.search('wireless lamp') == []
+    assert index.search('creme') == [5]
+    index.remove(1)
+    assert index.search('mouse') == []
+    assert index.search('') == []
+
+def test_search_endpoint_follows_product_changes(app):
+    client = app.test_client()
+    assert names(client, 'headphnes') == ['Noise Cancelling Headphones']
+    with app.app_context():
+        db.session.get(Product, 4).name = 'Studio Monitor Headphones'
+        db.session.add(Product(name='Wireless Charger', description='Qi pad.', price=20.0, stock=3))
+        db.session.delete(db.session.get(Product, 1))
+        db.session.commit()
+    assert names(client, 'studio') == ['Studio Monitor Headphones']
+    assert names(client, 'noise') == []
+    assert names(client, 'charger') == ['Wireless Charger', 'USB-C Charger']
+    assert names(client, 'mouse') == []
+
+def test_out_of_stock_ranks_below_equal_match(app):
+    with app.app_context():
+        db.session.add(Product(name='USB-A Charger', description='Fast charging wall charger.', price=5.0, stock=4))
+        db.session.commit()
+    client = app.test_client()
+    assert names(client, 'charger') == ['USB-A Charger', 'USB-C Charger']
+    with app.app_context():
+        db.session.get(Product, 3).stock = 9
+        db.session.get(Product, 6).stock = 0
+        db.session.commit()
+    assert names(client, 'charger') == ['USB-C Charger', 'USB-A Charger']
+
+def test_index_is_built_once(app):
+    client = app.test_client()
+    names(client, 'mouse')
+    with app.app_context():
+        engine = db.engine
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    names(client, 'keyboard')
+    event.remove(engine, 'before_cursor_execute', listener)
+    assert len(statements) == 1 and get_search(app).ready
+    rv = client.get('/search?q=mug')
+    assert rv.status_code == 200 and 'Café Crème Mug' in rv.get_data(as_text=True)
+
+def test_index_is_rebuilt_after_ttl_to_see_other_processes_changes(app):
+    search = get_search(app)
+    now = [0.0]
+    search.clock = lambda: now[0]
+    search.ttl = 60
+    client = app.test_client()
+    assert names(client, 'mouse') == ['Wireless Mouse']
+    with app.app_context():
+        # Another worker's edit: no products_changed signal reaches this process.
+        db.session.execute(text("UPDATE product SET name = 'Trackball' WHERE id = 1"))
+        db.session.commit()
+    assert names(client, 'trackball') == []
+    now[0] = 61
+    names(client, 'trackball')
+    search._warming.join()
+    assert names(client, 'trackball') == ['Trackball']
+
+def test_database_backend_uses_fts(make_app, tmp_path):
+    app = make_app(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'fts.db'}", SEARCH_BACKEND='database')
+    client = app.test_client()
+    assert names(client, 'wireless') == ['Wireless Mouse', 'Mechanical Keyboard']
+    assert names(client, 'head') == ['Noise Cancelling Headphones']
+    with app.app_context():
+        db.session.get(Product, 1).name = 'Trackball'
+        db.session.get(Product, 2).stock = 1
+        db.session.commit()
+    assert names(client, 'wireless') == ['Mechanical Keyboard']
+    assert names(client, 'trackball') == ['Trackball']
+    assert app.test_cli_runner().invoke(args=['init-db']).exit_code == 0
@@ -0,0 +1,49 @@
+import pytest
+from sqlalchemy import inspect
+from werkzeug.security import generate_password_hash
+from app import create_app
+from app.models import db, User, Product
+
+@pytest.fixture
+def app():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+    yield app
+
+def table_names(app):
+    with app.app_context():
+        return set(inspect(db.engine).get_table_names())
+
+def test_schema_is_created_by_cli_not_startup(app):
+    assert table_names(app) == set()
+    result = app.test_cli_runner().invoke(args=['init-db'])
+    assert result.exit_code == 0
+    assert {'user', 'product', 'order', 'email_outbox'} <= table_names(app)
+    # Running it again against an existing schema is a no-op.
+    assert app.test_cli_runner().invoke(args=['init-db']).exit_code == 0
+
+def test_admin_is_built_on_first_request(app):
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='boss', email='boss@example.com', password=generate_password_hash('pw'),
+                            is_verified=True, is_admin=True))
+        db.session.add(Product(name='Lamp', price=10.0, stock=3))
+        db.session.commit()
+    lazy_admin = app.wsgi_app.mounts['/admin']
+    client = app.test_client()
+    assert lazy_admin.admin_app is None
+    rv = client.get('/admin/product/')
+    assert rv.status_code == 302
+    assert '/login' in rv.headers['Location']
+    assert lazy_admin.admin_app is not None
+    client.post('/login', data={'username': 'boss', 'password': 'pw'})
+    rv = client.get('/admin/product/')
+    assert rv.status_code == 200
+    assert b'Lamp' in rv.data
+
+def test_mail_is_initialised_on_first_use(app):
+    assert 'mail' not in app.extensions
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    client.post('/register', data={'username': 'new', 'email': 'new@example.com', 'password': 'pw'})
+    assert 'mail' in app.extensions
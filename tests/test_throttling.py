@@ -0,0 +1,153 @@
+import threading
+import pytest
+from werkzeug.security import generate_password_hash
+from app.cart_store import LocalKV
+from app.instrumentation import get_metrics
+from app.models import db, User, Product
+from app.throttling import KVLimiter, MemoryLimiter, Rate, get_admission_control, parse_rate
+
+@pytest.fixture
+def app_config():
+    return {'EMAIL_DELIVERY': 'external', 'RATE_LIMIT_ENABLED': True}
+
+@pytest.fixture
+def seed():
+    def seed():
+        password = generate_password_hash('pw')
+        db.session.add_all([User(username=name, email=f'{name}@example.com', password=password, is_verified=True)
+                            for name in ('ann', 'bob')])
+        db.session.add(Product(name='Lamp', price=10.0, stock=50))
+    return seed
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def counters(app, name):
+    return {labels: n for (metric, labels), n in get_metrics(app).counters.items() if metric == name}
+
+def test_parse_rate():
+    assert parse_rate('10/minute') == (10, 60)
+    assert parse_rate('3 / 10seconds') == (3, 10)
+    assert parse_rate('100/day') == (100, 86400)
+    with pytest.raises(ValueError):
+        parse_rate('lots')
+
+def test_token_bucket_refills():
+    clock = Clock()
+    limiter = MemoryLimiter(clock=clock)
+    rate = Rate(2, 60)
+    assert [limiter.hit('k', rate) for _ in range(3)] == [0, 0, 30]
+    assert limiter.hit('other', rate) == 0
+    clock.now += 30
+    assert limiter.hit('k', rate) == 0
+    assert limiter.hit('k', rate) == 30
+
+def test_sliding_window_in_shared_store():
+    clock = Clock(600.0)
+    limiter = KVLimiter(LocalKV(), clock=clock)
+    rate = Rate(4, 60)
+    assert [limiter.hit('k', rate) for _ in range(5)] == [0, 0, 0, 0, 60]
+    # Halfway into the next window half of the previous one still counts.
+    clock.now += 90
+    assert [limiter.hit('k', rate) for _ in range(3)] == [0, 0, 15]
+    # Another process sharing the store sees the same counts.
+    assert KVLimiter(limiter.client, clock=clock).hit('k', rate) == 15
+
+def test_register_is_limited_per_address(make_app):
+    app = make_app(RATE_LIMIT_REGISTER='2/hour')
+    client = app.test_client()
+    statuses = [client.post('/register', data={'username': f'bot{i}', 'email': f'bot{i}@example.com', 'password': 'pw'},
+                            environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code for i in range(3)]
+    assert statuses == [302, 302, 429]
+    rv = client.post('/register', data={'username': 'real', 'email': 'real@example.com', 'password': 'pw'},
+                     environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert rv.status_code == 302
+    assert client.get('/register', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code == 200
+    with app.app_context():
+        assert sorted(u.username for u in User.query) == ['ann', 'bob', 'bot0', 'bot1', 'real']
+    assert counters(app, 'app_rate_limited_total') == {(('rule', 'register'),): 1}
+
+@pytest.mark.parametrize('store', ['memory', 'kv'])
+def test_cart_is_limited_per_user(make_app, store):
+    app = make_app(RATE_LIMIT_STORE=store, RATE_LIMIT_CART='2/minute')
+    clients = {}
+    for name in ('ann', 'bob'):
+        clients[name] = app.test_client()
+        clients[name].post('/login', data={'username': name, 'password': 'pw'})
+    assert [clients['ann'].post('/add_to_cart/1').status_code for _ in range(3)] == [302, 302, 429]
+    rv = clients['ann'].post('/add_to_cart/1')
+    assert int(rv.headers['Retry-After']) >= 1
+    assert clients['bob'].post('/add_to_cart/1').status_code == 302
+
+def test_admission_sheds_low_priority_first(app):
+    control = get_admission_control(app)
+    load = {'value': 0.8}
+    control.sources['db_pool'] = lambda: load['value']
+    client = app.test_client()
+    client.post('/login', data={'username': 'ann', 'password': 'pw'})
+    rv = client.get('/api/products')
+    assert rv.status_code == 503 and rv.headers['Retry-After'] == '1'
+    assert client.get('/').status_code == 200
+    load['value'] = 0.95
+    assert client.get('/').status_code == 503
+    assert client.get('/checkout').status_code == 302  # empty cart, but admitted
+    assert client.get('/metrics').status_code == 200
+    assert counters(app, 'app_requests_shed_total') == {
+        (('priority', 'low'), ('reason', 'db_pool')): 1, (('priority', 'normal'), ('reason', 'db_pool')): 1}
+    assert control.in_flight == 0
+
+def test_in_flight_and_payment_queue_are_load_sources(make_app):
+    app = make_app(ADMISSION_MAX_IN_FLIGHT=4, PAYMENT_MAX_PENDING=10)
+    control = get_admission_control(app)
+    control.in_flight = 3
+    assert control.load() == (0.75, 'in_flight')
+    control.in_flight = 0
+    assert control.load() == (0.0, None)
+    assert control.sources['payment_queue']() == 0
+
+def test_concurrent_requests_shed_low_priority(make_app):
+    app = make_app(ADMISSION_MAX_IN_FLIGHT=4)
+    entered, release = threading.Semaphore(0), threading.Event()
+    def slow():
+        entered.release()
+        release.wait(5)
+        return 'done'
+    app.add_url_rule('/slow', 'slow', slow)
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(app.test_client().get('/slow').status_code))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        assert entered.acquire(timeout=5)
+    # Two requests in flight on other threads: a third one puts the load at 3/4.
+    client = app.test_client()
+    assert client.get('/api/products').status_code == 503
+    assert client.get('/').status_code == 200
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200, 200]
+    assert get_admission_control(app).in_flight == 0
+    assert counters(app, 'app_requests_shed_total') == {(('priority', 'low'), ('reason', 'in_flight')): 1}
+
+def test_pool_load_uses_the_configured_overflow(make_app, tmp_path):
+    app = make_app(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'pool.db'}",
+                   SQLALCHEMY_ENGINE_OPTIONS={'pool_size': 2, 'max_overflow': 2})
+    source = get_admission_control(app).sources['db_pool']
+    with app.app_context():
+        connections = [db.engine.connect() for _ in range(3)]
+        assert source() == 0.75
+        for connection in connections:
+            connection.close()
+
+def test_proxy_address_is_used_when_trusted(make_app):
+    app = make_app(RATE_LIMIT_LOGIN='1/minute', PROXY_FIX_X_FOR=1)
+    client = app.test_client()
+    login = lambda address: client.post('/login', data={'username': 'ann', 'password': 'nope'},
+                                        headers={'X-Forwarded-For': address}).status_code
+    assert [login('1.2.3.4'), login('1.2.3.4'), login('5.6.7.8')] == [200, 429, 200]